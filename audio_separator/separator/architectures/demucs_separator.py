@@ -3,7 +3,7 @@ import sys
 from pathlib import Path
 import torch
 import numpy as np
-from audio_separator.separator.common_separator import CommonSeparator
+from audio_separator.separator.common_separator import CommonSeparator, context_attribute
 from audio_separator.separator.uvr_lib_v5.demucs.apply import apply_model, demucs_segments
 from audio_separator.separator.uvr_lib_v5.demucs.hdemucs import HDemucs
 from audio_separator.separator.uvr_lib_v5.demucs.pretrained import get_model as get_demucs_model
@@ -29,6 +29,11 @@ class DemucsSeparator(CommonSeparator):
     It initializes with configuration parameters and prepares the model for separation tasks.
     """
 
+    # The Demucs model is loaded for each input file, and the source map depends on the model's number of stems,
+    # so both are kept per request
+    demucs_model_instance = context_attribute("demucs_model_instance")
+    demucs_source_map = context_attribute("demucs_source_map", DEMUCS_4_SOURCE_MAPPER)
+
     def __init__(self, common_config, arch_config):
         # Any configuration values which can be shared between architectures should be set already in CommonSeparator,
         # e.g. user-specified functionality choices (self.output_single_stem) or common model parameters (self.primary_stem_name)
@@ -55,6 +60,13 @@ class DemucsSeparator(CommonSeparator):
         #                 18, 19, 20)
         self.shifts = arch_config.get("shifts", 2)
 
+        # Separates all shifted copies of the mix together in one batch rather than one after the other.
+        # Much faster with spare RAM / V-RAM, as each forward pass then processes every shift at once.
+        self.batch_shifts = arch_config.get("batch_shifts", False)
+
+        # Seed for the random shift offsets, so repeated separations of the same file give the same result.
+        self.shift_seed = arch_config.get("shift_seed", None)
+
         # This option controls the amount of overlap between prediction windows.
         #  - Higher values can provide better results, but will lead to longer processing times.
         #  - You can choose between 0.001-0.999
@@ -64,14 +76,18 @@ class DemucsSeparator(CommonSeparator):
         # Enables "Segments". Deselecting this option is only recommended for those with powerful PCs.
         self.segments_enabled = arch_config.get("segments_enabled", True)
 
-        self.logger.debug(f"Demucs arch params: segment_size={self.segment_size}, segments_enabled={self.segments_enabled}")
-        self.logger.debug(f"Demucs arch params: shifts={self.shifts}, overlap={self.overlap}")
+        # Number of segments stacked into a single forward pass of the model when segments are enabled.
+        # - Higher values use more RAM / V-RAM but make better use of the hardware.
+        # - Batch size value has no effect on output quality.
+        self.batch_size = arch_config.get("batch_size", 1)
 
-        self.demucs_source_map = DEMUCS_4_SOURCE_MAPPER
+        # Number of CPU threads processing segments in parallel, 0 processes them in the calling thread.
+        # The thread pool is shared by all Demucs separations running in the process.
+        self.num_workers = arch_config.get("num_workers", 0)
 
-        self.audio_file_path = None
-        self.audio_file_base = None
-        self.demucs_model_instance = None
+        self.logger.debug(f"Demucs arch params: segment_size={self.segment_size}, segments_enabled={self.segments_enabled}")
+        self.logger.debug(f"Demucs arch params: shifts={self.shifts}, overlap={self.overlap}, batch_size={self.batch_size}")
+        self.logger.debug(f"Demucs arch params: batch_shifts={self.batch_shifts}, shift_seed={self.shift_seed}, num_workers={self.num_workers}")
 
         # Add uvr_lib_v5 folder to system path so pytorch serialization can find the demucs module
         current_dir = os.path.dirname(__file__)
@@ -164,7 +180,7 @@ class DemucsSeparator(CommonSeparator):
         mix = (mix - ref.mean()) / ref.std()
         mix_infer = mix
 
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast_context():
             self.logger.debug("Running model inference...")
             sources = apply_model(
                 model=self.demucs_model_instance,
@@ -176,9 +192,14 @@ class DemucsSeparator(CommonSeparator):
                 set_progress_bar=None,
                 device=self.torch_device,
                 progress=True,
+                segment_batch_size=self.batch_size,
+                batch_shifts=self.batch_shifts,
+                shift_seed=self.shift_seed,
+                num_workers=self.num_workers,
+                autocast_context=self.autocast_context,
             )[0]
 
-        sources = (sources * ref.std() + ref.mean()).cpu().numpy()
+        sources = (sources.float() * ref.std() + ref.mean()).cpu().numpy()
         sources[[0, 1]] = sources[[1, 0]]
         processed[mix] = sources[:, :, 0:None].copy()
         sources = list(processed.values())
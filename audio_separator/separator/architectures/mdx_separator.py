@@ -2,15 +2,19 @@
 
 import os
 import platform
+import re
+import threading
+from importlib import metadata
 import torch
 import onnx
 import onnxruntime as ort
+from onnxruntime.capi import onnxruntime_pybind11_state as ort_state
 import numpy as np
 import onnx2torch
 from tqdm import tqdm
 from audio_separator.separator.uvr_lib_v5 import spec_utils
 from audio_separator.separator.uvr_lib_v5.stft import STFT
-from audio_separator.separator.common_separator import CommonSeparator
+from audio_separator.separator.common_separator import CommonSeparator, context_attribute
 
 
 class MDXSeparator(CommonSeparator):
@@ -19,6 +23,36 @@ class MDXSeparator(CommonSeparator):
     It initializes with configuration parameters and prepares the model for separation tasks.
     """
 
+    ONNX_GRAPH_OPTIMIZATION_LEVELS = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+
+    ONNX_EXECUTION_MODES = {"sequential": ort.ExecutionMode.ORT_SEQUENTIAL, "parallel": ort.ExecutionMode.ORT_PARALLEL}
+
+    # Errors a model raises when it can't take the doubled denoise batch: ONNX invalid argument errors (e.g. invalid dimensions),
+    # and errors from PyTorch or ONNX nodes reporting a mismatch between the batch and a shape baked into the model.
+    # Out of memory errors are never batch errors, as running the passes separately would hide them.
+    BATCH_ERROR_TYPES = (RuntimeError, ValueError, ort_state.RuntimeException)
+    BATCH_ERROR_PATTERNS = re.compile(
+        r"size of tensor a \(\d+\) must match the size of tensor b"
+        r"|shape '\[[-\d, ]*\]' is invalid for input of size"
+        r"|sizes of tensors must match"
+        r"|invalid dimensions? for input"
+        r"|cannot be reshaped to the requested shape"
+        r"|attempting to broadcast an axis by a dimension other than 1"
+    )
+    OUT_OF_MEMORY_PATTERNS = re.compile(r"out of memory|failed to allocate")
+
+    # IO bindings and their output buffers can't be shared between concurrent runs of the session, so each request gets its own
+    onnx_io_binding = context_attribute("onnx_io_binding")
+    onnx_output_buffer = context_attribute("onnx_output_buffer")
+
+    # Whether the denoise passes can run as one batch, switched off for the rest of the request the first time the model rejects a doubled batch
+    denoise_batching = context_attribute("denoise_batching", True)
+
     def __init__(self, common_config, arch_config):
         # Any configuration values which can be shared between architectures should be set already in CommonSeparator,
         # e.g. user-specified functionality choices (self.output_single_stem) or common model parameters (self.primary_stem_name)
@@ -60,8 +94,32 @@ class MDXSeparator(CommonSeparator):
         # If enabled, model will be run twice to reduce noise in output audio.
         self.enable_denoise = arch_config.get("enable_denoise")
 
+        # ONNX Runtime session tuning, only used when the model runs through an ONNX Runtime inference session.
+        # - 0 threads lets ONNX Runtime pick the thread count for the machine.
+        # - Graph optimization level is one of: disable, basic, extended, all.
+        # - Execution mode is one of: sequential, parallel. Parallel only helps models with independent branches.
+        self.onnx_intra_op_threads = arch_config.get("onnx_intra_op_threads", 0)
+        self.onnx_inter_op_threads = arch_config.get("onnx_inter_op_threads", 0)
+        self.onnx_graph_optimization_level = arch_config.get("onnx_graph_optimization_level", "all")
+        self.onnx_execution_mode = arch_config.get("onnx_execution_mode", "sequential")
+
+        # If enabled, the graph-optimized model is saved next to the model file and loaded directly on later runs.
+        self.onnx_optimized_model_cache = arch_config.get("onnx_optimized_model_cache", False)
+
+        # If enabled, model inputs and outputs are bound to pre-allocated buffers, avoiding a host copy per chunk.
+        self.onnx_enable_io_binding = arch_config.get("onnx_enable_io_binding", True)
+
+        if self.onnx_graph_optimization_level not in self.ONNX_GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"Unsupported ONNX graph optimization level: {self.onnx_graph_optimization_level}. Choose one of: {', '.join(self.ONNX_GRAPH_OPTIMIZATION_LEVELS)}")
+
+        if self.onnx_execution_mode not in self.ONNX_EXECUTION_MODES:
+            raise ValueError(f"Unsupported ONNX execution mode: {self.onnx_execution_mode}. Choose one of: {', '.join(self.ONNX_EXECUTION_MODES)}")
+
         self.logger.debug(f"MDX arch params: batch_size={self.batch_size}, segment_size={self.segment_size}")
         self.logger.debug(f"MDX arch params: overlap={self.overlap}, hop_length={self.hop_length}, enable_denoise={self.enable_denoise}")
+        self.logger.debug(f"MDX arch params: onnx_intra_op_threads={self.onnx_intra_op_threads}, onnx_inter_op_threads={self.onnx_inter_op_threads}")
+        self.logger.debug(f"MDX arch params: onnx_graph_optimization_level={self.onnx_graph_optimization_level}, onnx_execution_mode={self.onnx_execution_mode}")
+        self.logger.debug(f"MDX arch params: onnx_optimized_model_cache={self.onnx_optimized_model_cache}, onnx_enable_io_binding={self.onnx_enable_io_binding}")
 
         # Initializing model-specific parameters from model_data JSON
         self.compensate = self.model_data["compensate"]
@@ -92,6 +150,8 @@ class MDXSeparator(CommonSeparator):
         # We haven't implemented support for the checkpoint models here, so we're not using it.
         # self.dim_c = 4
 
+        self.onnx_session = None
+
         self.load_model()
 
         self.n_bins = 0
@@ -113,24 +173,201 @@ class MDXSeparator(CommonSeparator):
         self.logger.debug("Loading ONNX model for inference...")
 
         if self.segment_size == self.dim_t:
-            ort_session_options = ort.SessionOptions()
-            if self.log_level > 10:
-                ort_session_options.log_severity_level = 3
-            else:
-                ort_session_options.log_severity_level = 0
+            ort_session_options, onnx_model_path = self.create_onnx_session_options()
+
+            self.onnx_session = ort.InferenceSession(onnx_model_path, providers=self.onnx_execution_provider, sess_options=ort_session_options)
 
-            ort_inference_session = ort.InferenceSession(self.model_path, providers=self.onnx_execution_provider, sess_options=ort_session_options)
-            self.model_run = lambda spek: ort_inference_session.run(None, {"input": spek.cpu().numpy()})[0]
+            if self.onnx_enable_io_binding:
+                self.model_run = self.onnx_model_run_io_binding
+            else:
+                self.model_run = lambda spek: self.onnx_session.run(None, {"input": spek.cpu().numpy()})[0]
             self.logger.debug("Model loaded successfully using ONNXruntime inferencing session.")
         else:
-            if platform.system() == 'Windows':
+            self.converted_model = None
+            self.traced_models = {}
+            self.traced_models_lock = threading.Lock()
+            self.model_run = self.converted_model_run
+            self.logger.warning("Model converted from onnx to pytorch due to segment size not matching dim_t, processing may be slower.")
+
+    def converted_model_run(self, spek):
+        """
+        Runs the ONNX model converted to PyTorch, through a TorchScript module traced at the input's shape.
+        """
+        return self.get_traced_model(tuple(spek.shape))(spek)
+
+    def get_traced_model(self, input_shape):
+        """
+        Returns the converted model traced with TorchScript at input_shape, loading it from model_file_dir if it was traced before.
+        onnx2torch graphs bake their reshapes into the trace, so each input shape (full batches, the last batch, denoise batches)
+        gets its own module. Cached modules are loaded with torch.jit.load, which doesn't unpickle arbitrary Python objects,
+        and are keyed by model hash, input shape, device type, precision and the PyTorch and onnx2torch versions.
+        The ONNX model is only converted when a shape isn't cached yet.
+        """
+        with self.traced_models_lock:
+            traced_model = self.traced_models.get(input_shape)
+            if traced_model is not None:
+                return traced_model
+
+            traced_model_dir = os.path.join(self.model_file_dir if self.model_file_dir else os.path.dirname(self.model_path), "compile_cache")
+            input_shape_name = "x".join(str(dim) for dim in input_shape)
+            traced_model_path = os.path.join(
+                traced_model_dir,
+                f"{self.model_name}.{self.model_hash}.{input_shape_name}.{self.torch_device.type}.{self.precision}.torch-{torch.__version__}.onnx2torch-{metadata.version('onnx2torch')}.torchscript.pt",
+            )
+
+            if os.path.isfile(traced_model_path):
+                try:
+                    self.logger.debug(f"Loading cached TorchScript conversion from {traced_model_path}")
+                    traced_model = torch.jit.load(traced_model_path, map_location=self.torch_device)
+                except Exception as e:
+                    self.logger.warning(f"Cached TorchScript conversion at {traced_model_path} could not be loaded, tracing again: {e}")
+
+            if traced_model is None:
+                traced_model = self.trace_converted_model(input_shape, traced_model_dir, traced_model_path)
+
+            self.traced_models[input_shape] = traced_model
+            return traced_model
+
+    def trace_converted_model(self, input_shape, traced_model_dir, traced_model_path):
+        """
+        Converts the ONNX model to PyTorch with onnx2torch (once per separator), traces it at input_shape and caches the trace.
+        """
+        if self.converted_model is None:
+            self.logger.debug("Converting ONNX model to PyTorch with onnx2torch...")
+            if platform.system() == "Windows":
                 onnx_model = onnx.load(self.model_path)
-                self.model_run = onnx2torch.convert(onnx_model)
+                self.converted_model = onnx2torch.convert(onnx_model)
             else:
-                self.model_run = onnx2torch.convert(self.model_path)
-   
-            self.model_run.to(self.torch_device).eval()
-            self.logger.warning("Model converted from onnx to pytorch due to segment size not matching dim_t, processing may be slower.")
+                self.converted_model = onnx2torch.convert(self.model_path)
+            self.converted_model.to(self.torch_device).eval()
+
+        self.logger.debug(f"Tracing converted model with TorchScript at input shape {input_shape}...")
+        example_input = torch.zeros(input_shape, dtype=torch.float32, device=self.torch_device)
+        # Traced under the inference precision, so the casts autocast inserts are part of the graph
+        with torch.no_grad(), self.autocast_context():
+            traced_model = torch.jit.freeze(torch.jit.trace(self.converted_model, example_input, check_trace=False))
+
+        # Write to a temporary file first so an interrupted save never leaves a truncated cache entry behind
+        os.makedirs(traced_model_dir, exist_ok=True)
+        temp_traced_model_path = f"{traced_model_path}.{os.getpid()}.tmp"
+        try:
+            torch.jit.save(traced_model, temp_traced_model_path)
+            os.replace(temp_traced_model_path, traced_model_path)
+            self.logger.debug(f"Saved TorchScript conversion to {traced_model_path}")
+        except Exception as e:
+            self.logger.warning(f"Unable to cache TorchScript conversion to {traced_model_path}: {e}")
+            if os.path.isfile(temp_traced_model_path):
+                os.remove(temp_traced_model_path)
+
+        return traced_model
+
+    def create_onnx_session_options(self):
+        """
+        Builds the ONNX Runtime session options from the user-configurable tuning parameters.
+        Returns the session options and the path of the model file the session should be created from,
+        which is the cached graph-optimized model if one is enabled and up to date.
+        """
+        ort_session_options = ort.SessionOptions()
+        if self.log_level > 10:
+            ort_session_options.log_severity_level = 3
+        else:
+            ort_session_options.log_severity_level = 0
+
+        ort_session_options.intra_op_num_threads = self.onnx_intra_op_threads
+        ort_session_options.inter_op_num_threads = self.onnx_inter_op_threads
+        ort_session_options.execution_mode = self.ONNX_EXECUTION_MODES[self.onnx_execution_mode]
+        ort_session_options.graph_optimization_level = self.ONNX_GRAPH_OPTIMIZATION_LEVELS[self.onnx_graph_optimization_level]
+
+        if not self.onnx_optimized_model_cache:
+            return ort_session_options, self.model_path
+
+        # Optimized graphs at the extended and all levels may contain provider-specific nodes, so the cache is keyed by both
+        provider_name = self.onnx_execution_provider[0] if self.onnx_execution_provider else "CPUExecutionProvider"
+        optimized_model_path = os.path.join(os.path.dirname(self.model_path), f"{self.model_name}.{provider_name}.{self.onnx_graph_optimization_level}.optimized.onnx")
+
+        if os.path.isfile(optimized_model_path) and os.path.getmtime(optimized_model_path) >= os.path.getmtime(self.model_path):
+            self.logger.debug(f"Loading cached optimized ONNX model from {optimized_model_path}")
+            # The cached model has already been through graph optimization, so don't spend time re-optimizing it
+            ort_session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            return ort_session_options, optimized_model_path
+
+        self.logger.debug(f"Optimized ONNX model will be cached to {optimized_model_path}")
+        ort_session_options.optimized_model_filepath = optimized_model_path
+        return ort_session_options, self.model_path
+
+    def onnx_model_run_io_binding(self, spek):
+        """
+        Runs the ONNX inference session using IO binding, so the input spectrum is read straight from the tensor's memory
+        and the prediction is written into an output buffer which is re-used across chunks of the same shape.
+        Falls back to a regular session run if the tensor lives on a device ONNX Runtime can't bind to.
+        """
+        device = spek.device
+        is_bindable_device = device.type == "cpu" or (device.type == "cuda" and "CUDAExecutionProvider" in self.onnx_session.get_providers())
+
+        if not is_bindable_device:
+            return self.onnx_session.run(None, {"input": spek.cpu().numpy()})[0]
+
+        spek = spek.contiguous()
+
+        if self.onnx_io_binding is None:
+            self.onnx_io_binding = self.onnx_session.io_binding()
+
+        # MDX models predict a spectrum with the same shape as their input, so the output buffer only changes with the chunk shape
+        if self.onnx_output_buffer is None or self.onnx_output_buffer.shape != spek.shape or self.onnx_output_buffer.device != device:
+            self.logger.debug(f"Allocating ONNX output buffer with shape {tuple(spek.shape)} on device {device}")
+            self.onnx_output_buffer = torch.empty(spek.shape, dtype=torch.float32, device=device)
+
+        device_id = device.index if device.index is not None else 0
+        output_name = self.onnx_session.get_outputs()[0].name
+
+        self.onnx_io_binding.bind_input(name="input", device_type=device.type, device_id=device_id, element_type=np.float32, shape=tuple(spek.shape), buffer_ptr=spek.data_ptr())
+        self.onnx_io_binding.bind_output(
+            name=output_name, device_type=device.type, device_id=device_id, element_type=np.float32, shape=tuple(self.onnx_output_buffer.shape), buffer_ptr=self.onnx_output_buffer.data_ptr()
+        )
+        self.onnx_session.run_with_iobinding(self.onnx_io_binding)
+
+        return self.onnx_output_buffer
+
+    def is_batch_error(self, error):
+        """
+        Returns whether an error running the doubled denoise batch comes from the model rejecting the batch's shape or type,
+        in which case the passes can be run separately. Any other error is a real failure of the model run.
+        """
+        if isinstance(error, torch.cuda.OutOfMemoryError) or self.OUT_OF_MEMORY_PATTERNS.search(str(error).lower()):
+            return False
+
+        if isinstance(error, ort_state.InvalidArgument):
+            return True
+
+        return isinstance(error, self.BATCH_ERROR_TYPES) and self.BATCH_ERROR_PATTERNS.search(str(error).lower()) is not None
+
+    def denoise_model_run(self, spek):
+        """
+        Runs the model on the negative and positive spectrum and averages the two predictions (negating the first one back).
+        Both spectrums are concatenated along the batch dimension and run as a single inference, unless the model has a fixed
+        batch size or rejects the doubled batch, in which case the two passes are run one after the other.
+        """
+        batch_size = spek.shape[0]
+
+        if self.denoise_batching and self.onnx_session is not None:
+            onnx_batch_dim = self.onnx_session.get_inputs()[0].shape[0]
+            if isinstance(onnx_batch_dim, int) and onnx_batch_dim != batch_size * 2:
+                self.logger.debug(f"ONNX model has a fixed batch size of {onnx_batch_dim}, running denoise passes separately.")
+                self.denoise_batching = False
+
+        if self.denoise_batching:
+            try:
+                spec_pred = torch.as_tensor(self.run_batched(self.model_run, torch.cat([-spek, spek])), device=spek.device)
+                return spec_pred[batch_size:] * 0.5 - spec_pred[:batch_size] * 0.5
+            except Exception as e:
+                if not self.is_batch_error(e):
+                    raise
+                self.logger.warning(f"Model failed to run the denoise passes as one batch, running them separately instead: {e}")
+                self.denoise_batching = False
+
+        # The negative prediction is scaled before the second run, as an IO-bound session re-uses its output buffer
+        spec_pred = self.model_run(-spek) * -0.5
+        return spec_pred + self.model_run(spek) * 0.5
 
     def separate(self, audio_file_path):
         """
@@ -252,7 +489,7 @@ class MDXSeparator(CommonSeparator):
             pad = self.gen_size + self.trim - (mix.shape[-1] % self.gen_size)
             self.logger.debug(f"Padding calculated: {pad}")
             # Add padding at the beginning and the end of the mix
-            mixture = np.concatenate((np.zeros((2, self.trim), dtype="float32"), mix, np.zeros((2, pad), dtype="float32")), 1)
+            mixture = np.concatenate((np.zeros((2, self.trim), dtype="float32"), mix.astype(np.float32, copy=False), np.zeros((2, pad), dtype="float32")), 1)
             # Determine the number of chunks based on the mixture's length
             num_chunks = mixture.shape[-1] // self.gen_size
             self.logger.debug(f"Mixture shape after padding: {mixture.shape}, Number of chunks: {num_chunks}")
@@ -267,7 +504,8 @@ class MDXSeparator(CommonSeparator):
             pad = self.gen_size - n_sample % self.gen_size
             self.logger.debug(f"Number of samples: {n_sample}, Padding calculated: {pad}")
             # Apply padding to the mix
-            mix_p = np.concatenate((np.zeros((2, self.trim)), mix, np.zeros((2, pad)), np.zeros((2, self.trim))), 1)
+            # The padding is float32 like the mix, so the concatenation doesn't promote the whole mix to float64
+            mix_p = np.concatenate((np.zeros((2, self.trim), dtype="float32"), mix.astype(np.float32, copy=False), np.zeros((2, pad + self.trim), dtype="float32")), 1)
             self.logger.debug(f"Shape of mix after padding: {mix_p.shape}")
 
             # Process the mix in chunks
@@ -322,7 +560,7 @@ class MDXSeparator(CommonSeparator):
         # Calculates padding to make the mix length a multiple of the generated size.
         pad = gen_size + self.trim - ((mix.shape[-1]) % gen_size)
         # Prepares the mixture with padding at the beginning and the end.
-        mixture = np.concatenate((np.zeros((2, self.trim), dtype="float32"), mix, np.zeros((2, pad), dtype="float32")), 1)
+        mixture = np.concatenate((np.zeros((2, self.trim), dtype="float32"), mix.astype(np.float32, copy=False), np.zeros((2, pad), dtype="float32")), 1)
         self.logger.debug(f"Mixture prepared with padding. Mixture shape: {mixture.shape}")
 
         # Calculates the step size for processing chunks based on the overlap.
@@ -359,8 +597,8 @@ class MDXSeparator(CommonSeparator):
                 pad_size = (i + chunk_size) - end
                 mix_part_ = np.concatenate((mix_part_, np.zeros((2, pad_size), dtype="float32")), axis=-1)
 
-            # Converts the chunk to a tensor for processing.
-            mix_part = torch.tensor([mix_part_], dtype=torch.float32).to(self.torch_device)
+            # Converts the chunk to a tensor for processing, adding the batch dimension without going through a Python list.
+            mix_part = torch.as_tensor(mix_part_[None], dtype=torch.float32).to(self.torch_device)
             # Splits the chunk into smaller batches if necessary.
             mix_waves = mix_part.split(self.batch_size)
             total_batches = len(mix_waves)
@@ -426,24 +664,21 @@ class MDXSeparator(CommonSeparator):
 
         # Handling the case where the mix needs to be matched (is_match_mix = True)
         if is_match_mix:
-            # self.logger.debug("Match mix mode is enabled. Converting spectrum to NumPy array.")
-            spec_pred = spek.cpu().numpy()
+            spec_pred = spek
             self.logger.debug("is_match_mix: spectrum prediction obtained directly from STFT output.")
         else:
             # If denoising is enabled, the model is run on both the negative and positive spectrums.
-            if self.enable_denoise:
-                # Assuming spek is a tensor and self.model_run can process it directly
-                spec_pred_neg = self.model_run(-spek)  # Ensure this line correctly negates spek and runs the model
-                spec_pred_pos = self.model_run(spek)
-                # Ensure both spec_pred_neg and spec_pred_pos are tensors before applying operations
-                spec_pred = (spec_pred_neg * -0.5) + (spec_pred_pos * 0.5)  # [invalid-unary-operand-type]
-                self.logger.debug("Model run on both negative and positive spectrums for denoising.")
-            else:
-                spec_pred = self.model_run(spek)
-                self.logger.debug("Model run on the spectrum without denoising.")
-
-        # Applying the inverse STFT to convert the spectrum back to the time domain.
-        result = self.stft.inverse(torch.tensor(spec_pred).to(self.torch_device)).cpu().detach().numpy()
+            with self.autocast_context():
+                if self.enable_denoise:
+                    spec_pred = self.denoise_model_run(spek)
+                    self.logger.debug("Model run on both negative and positive spectrums for denoising.")
+                else:
+                    spec_pred = self.run_batched(self.model_run, spek)
+                    self.logger.debug("Model run on the spectrum without denoising.")
+
+        # Applying the inverse STFT to convert the spectrum back to the time domain, always in fp32.
+        # Torch-backed models keep their prediction on the device, only ONNX sessions without IO binding hand back a NumPy array.
+        result = self.stft.inverse(torch.as_tensor(spec_pred, device=self.torch_device).float()).cpu().detach().numpy()
         self.logger.debug(f"Inverse STFT applied. Returning result with shape: {result.shape}")
 
         return result
@@ -12,6 +12,7 @@ from audio_separator.separator.uvr_lib_v5 import spec_utils
 from audio_separator.separator.uvr_lib_v5.tfc_tdf_v3 import TFC_TDF_net
 from audio_separator.separator.uvr_lib_v5.roformer.mel_band_roformer import MelBandRoformer
 from audio_separator.separator.uvr_lib_v5.roformer.bs_roformer import BSRoformer
+from audio_separator.separator.uvr_lib_v5.roformer.attend import Attend
 
 
 class MDXCSeparator(CommonSeparator):
@@ -20,6 +21,8 @@ class MDXCSeparator(CommonSeparator):
     It initializes with configuration parameters and prepares the model for separation tasks.
     """
 
+    COMPILE_MODES = (None, "torch_compile", "torchscript")
+
     def __init__(self, common_config, arch_config):
         # Any configuration values which can be shared between architectures should be set already in CommonSeparator,
         # e.g. user-specified functionality choices (self.output_single_stem) or common model parameters (self.primary_stem_name)
@@ -50,11 +53,34 @@ class MDXCSeparator(CommonSeparator):
         # • Dropping the pitch may take more processing time but works well for tracks with high-pitched vocals.
         self.pitch_shift = arch_config.get("pitch_shift", 0)
 
+        # Optional compiled inference mode, so repeated chunks of identical shape run through an optimized graph:
+        # • None - run the eager PyTorch model (default).
+        # • "torch_compile" - compile the model with torch.compile, using compile_backend (default: inductor, which supports CPU).
+        # • "torchscript" - trace the model with TorchScript at the fixed chunk shape; other shapes fall back to the eager model.
+        # Compiled artifacts are cached in the model file directory, so only the first run pays the compilation cost.
+        # torch.compile caches through TORCHINDUCTOR_CACHE_DIR, which is process-wide, see compile_model.
+        self.compile_mode = arch_config.get("compile_mode", None)
+        self.compile_backend = arch_config.get("compile_backend", "inductor")
+
+        # Roformer attention over long sequences can process queries in chunks of this many frames, to bound memory use.
+        # The output is identical; None attends over the whole sequence at once.
+        self.attention_chunk_size = arch_config.get("attention_chunk_size", None)
+
+        if self.compile_mode not in self.COMPILE_MODES:
+            raise ValueError(f"Unsupported MDXC compile mode: {self.compile_mode}. Choose one of: {', '.join(str(mode) for mode in self.COMPILE_MODES)}")
+
         self.logger.debug(f"MDXC arch params: batch_size={self.batch_size}, segment_size={self.segment_size}, overlap={self.overlap}")
         self.logger.debug(f"MDXC arch params: override_model_segment_size={self.override_model_segment_size}, pitch_shift={self.pitch_shift}")
+        self.logger.debug(f"MDXC arch params: compile_mode={self.compile_mode}, compile_backend={self.compile_backend}, attention_chunk_size={self.attention_chunk_size}")
 
         self.is_roformer = "is_roformer" in self.model_data
 
+        self.compiled_model_run = None
+        self.compiled_input_shape = None
+
+        # Set by load_model when the int8 quantized model passed its regression check and is used for inference
+        self.is_quantized = False
+
         self.load_model()
 
         self.primary_source = None
@@ -99,6 +125,12 @@ class MDXCSeparator(CommonSeparator):
                 self.model_run.load_state_dict(checkpoint)
                 self.model_run.to(self.torch_device).eval()
 
+                if self.attention_chunk_size is not None:
+                    self.logger.debug(f"Setting Roformer attention chunk size to {self.attention_chunk_size}")
+                    for module in self.model_run.modules():
+                        if isinstance(module, Attend):
+                            module.chunk_size = self.attention_chunk_size
+
             else:
                 self.logger.debug("Loading TFC_TDF_net model...")
                 self.model_run = TFC_TDF_net(self.model_data_cfgdict, device=self.torch_device)
@@ -111,6 +143,110 @@ class MDXCSeparator(CommonSeparator):
             self.logger.error(f"Please try deleting the model file from {self.model_path} and run audio-separator again to re-download it.")
             sys.exit(1)
 
+        if self.enable_quantization:
+            # Probe with a single chunk of low-level noise, the same shape as the chunks passed to the model in demix
+            probe_input = torch.randn((1, 2, self.get_chunk_size()), generator=torch.Generator().manual_seed(0)) * 0.1
+            fp32_model_run = self.model_run
+            self.model_run = self.quantize_model(self.model_run, [torch.nn.Linear], probe_input, lambda model, x: model(x))
+            self.is_quantized = self.model_run is not fp32_model_run
+
+        if self.compile_mode is not None:
+            self.compile_model()
+
+    def get_chunk_size(self):
+        """
+        Returns the number of samples in each chunk passed to the model, based on the model's hop length and the segment size in use.
+        """
+        if self.override_model_segment_size:
+            mdx_segment_size = self.segment_size
+        else:
+            mdx_segment_size = self.model_data_cfgdict.inference.dim_t
+
+        return self.model_data_cfgdict.audio.hop_length * (mdx_segment_size - 1)
+
+    def compile_model(self):
+        """
+        Builds the compiled inference model according to compile_mode, then runs a warm-up chunk through it
+        so the compilation cost isn't paid while processing the first chunk of real audio.
+        If compilation fails for any reason, separation carries on using the eager model.
+        """
+        # Roformer models are always run one chunk at a time, TFC_TDF_net models are run in batches of batch_size chunks
+        batch_size = 1 if self.is_roformer else self.batch_size
+        example_input = torch.zeros((batch_size, 2, self.get_chunk_size()), dtype=torch.float32, device=self.torch_device)
+        compile_cache_dir = os.path.join(self.model_file_dir if self.model_file_dir else os.path.dirname(self.model_path), "compile_cache")
+
+        try:
+            if self.compile_mode == "torch_compile":
+                self.logger.debug(f"Compiling model with torch.compile using backend {self.compile_backend}...")
+                # Inductor persists its generated kernels to TORCHINDUCTOR_CACHE_DIR and re-uses them in later processes.
+                # Inductor has no per-model setting for it, the environment variable is read lazily by every compilation in
+                # the process, so it is a one-time, process-wide setting: a directory set by the user is kept, otherwise the
+                # compile cache of the first model compiled is used for all of them. Entries are keyed by graph hash,
+                # so sharing the directory between models is safe.
+                inductor_cache_dir = os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(compile_cache_dir, "torchinductor"))
+                self.logger.debug(f"Inductor kernels are cached in {inductor_cache_dir}")
+                self.compiled_model_run = torch.compile(self.model_run, backend=self.compile_backend, dynamic=False)
+            else:
+                self.compiled_model_run = self.load_or_trace_torchscript(example_input, compile_cache_dir)
+
+            # The warm-up runs under the same autocast context as inference, otherwise the first real chunk would compile again
+            self.logger.debug(f"Running warm-up chunk through compiled model with input shape {tuple(example_input.shape)}...")
+            with torch.no_grad(), self.autocast_context():
+                self.compiled_model_run(example_input)
+
+            self.compiled_input_shape = tuple(example_input.shape)
+            self.logger.info(f"Model compiled for inference using {self.compile_mode}")
+        except Exception as e:
+            self.logger.warning(f"Unable to compile model using {self.compile_mode}, falling back to eager inference: {e}")
+            self.compiled_model_run = None
+            self.compiled_input_shape = None
+
+    def load_or_trace_torchscript(self, example_input, compile_cache_dir):
+        """
+        Returns a TorchScript module traced at the shape of example_input, loading it from the compile cache if it was traced before.
+        Cached modules are keyed by model hash, input shape, device type, precision, quantization, attention chunk size and PyTorch version,
+        as each of these changes the traced graph.
+        """
+        input_shape_name = "x".join(str(dim) for dim in example_input.shape)
+        variant_name = f"{self.precision}{'-int8' if self.is_quantized else ''}.attn-{self.attention_chunk_size or 'full'}"
+        traced_model_path = os.path.join(compile_cache_dir, f"{self.model_name}.{self.model_hash}.{input_shape_name}.{self.torch_device.type}.{variant_name}.torch-{torch.__version__}.torchscript.pt")
+
+        if os.path.isfile(traced_model_path):
+            self.logger.debug(f"Loading cached TorchScript model from {traced_model_path}")
+            return torch.jit.load(traced_model_path, map_location=self.torch_device)
+
+        self.logger.debug(f"Tracing model with TorchScript at input shape {tuple(example_input.shape)}...")
+        # Traced under the inference precision, so the casts autocast inserts are part of the graph
+        with torch.no_grad(), self.autocast_context():
+            traced_model = torch.jit.optimize_for_inference(torch.jit.trace(self.model_run, example_input, check_trace=False))
+
+        os.makedirs(compile_cache_dir, exist_ok=True)
+        temp_traced_model_path = f"{traced_model_path}.{os.getpid()}.tmp"
+        try:
+            torch.jit.save(traced_model, temp_traced_model_path)
+            os.replace(temp_traced_model_path, traced_model_path)
+            self.logger.debug(f"Saved TorchScript model to {traced_model_path}")
+        except Exception as e:
+            self.logger.warning(f"Unable to cache TorchScript model to {traced_model_path}: {e}")
+            if os.path.isfile(temp_traced_model_path):
+                os.remove(temp_traced_model_path)
+
+        return traced_model
+
+    def run_model_chunk(self, chunk):
+        """
+        Runs a chunk (or batch of chunks) through the model, using the compiled model when one is available for this input.
+        TorchScript models are traced at a fixed shape, so chunks of any other shape (e.g. the final partial batch) use the eager model.
+        """
+        if self.compiled_model_run is not None:
+            if self.compile_mode == "torch_compile":
+                return self.run_batched(self.compiled_model_run, chunk)
+            if tuple(chunk.shape) == self.compiled_input_shape:
+                # Coalescing chunks with concurrent requests would change the traced shape, so these run on their own
+                return self.compiled_model_run(chunk)
+
+        return self.run_batched(self.model_run, chunk)
+
     def separate(self, audio_file_path):
         """
         Separates the audio file into primary and secondary sources based on the model's configuration.
@@ -239,8 +375,7 @@ class MDXCSeparator(CommonSeparator):
             # Transfer to the weighting plate for the same device as the other tensors
             window = window.to(device)
 
-            # with torch.cuda.amp.autocast():
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast_context():
                 req_shape = (len(self.model_data_cfgdict.training.instruments),) + tuple(mix.shape)
                 result = torch.zeros(req_shape, dtype=torch.float32).to(device)
                 counter = torch.zeros(req_shape, dtype=torch.float32).to(device)
@@ -252,7 +387,7 @@ class MDXCSeparator(CommonSeparator):
                         part = mix[:, -chunk_size:]
                         length = chunk_size
                     part = part.to(device)
-                    x = self.model_run(part.unsqueeze(0))[0]
+                    x = self.run_model_chunk(part.unsqueeze(0))[0]
                     if i + chunk_size > mix.shape[1]:
                         # Corrigido para adicionar corretamente ao final do tensor
                         result = self.overlap_add(result, x, window, result.shape[-1] - chunk_size, length)
@@ -304,12 +439,12 @@ class MDXCSeparator(CommonSeparator):
             accumulated_outputs = torch.zeros(num_stems, *mix.shape) if num_stems > 1 else torch.zeros_like(mix)
             accumulated_outputs = accumulated_outputs.to(self.torch_device)
 
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast_context():
                 count = 0
                 for batch in tqdm(batches):
                     # Since the model processes the audio data in batches, single_batch_result temporarily holds the model's output
                     # for each batch before it is accumulated into accumulated_outputs.
-                    single_batch_result = self.model_run(batch.to(self.torch_device))
+                    single_batch_result = self.run_model_chunk(batch.to(self.torch_device))
 
                     # Each individual output tensor from the current batch's processing result.
                     # Since single_batch_result can contain multiple output tensors (one for each piece of audio in the batch),
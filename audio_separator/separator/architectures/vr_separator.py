@@ -11,7 +11,7 @@ from tqdm import tqdm
 # Check if we really need the rerun_mp3 function, remove if not
 import audioread
 
-from audio_separator.separator.common_separator import CommonSeparator
+from audio_separator.separator.common_separator import CommonSeparator, context_attribute
 from audio_separator.separator.uvr_lib_v5 import spec_utils
 from audio_separator.separator.uvr_lib_v5.vr_network import nets
 from audio_separator.separator.uvr_lib_v5.vr_network import nets_new
@@ -24,6 +24,10 @@ class VRSeparator(CommonSeparator):
     It initializes with configuration parameters and prepares the model for separation tasks.
     """
 
+    # The high end of the input file being separated, kept per request for high_end_process
+    input_high_end_h = context_attribute("input_high_end_h")
+    input_high_end = context_attribute("input_high_end")
+
     def __init__(self, common_config, arch_config: dict):
         # Any configuration values which can be shared between architectures should be set already in CommonSeparator,
         # e.g. user-specified functionality choices (self.output_single_stem) or common model parameters (self.primary_stem_name)
@@ -84,8 +88,6 @@ class VRSeparator(CommonSeparator):
 
         # The application will mirror the missing frequency range of the output.
         self.high_end_process = arch_config.get("high_end_process", False)
-        self.input_high_end_h = None
-        self.input_high_end = None
 
         # Adjust the intensity of primary stem extraction:
         # - Ranges from -100 - 100.
@@ -94,6 +96,13 @@ class VRSeparator(CommonSeparator):
         # - Values beyond 5 might muddy the sound for non-vocal models.
         self.aggression = float(int(arch_config.get("aggression", 5)) / 100)
 
+        # Resampler used between the bands of multi-band models, instead of each band's res_type from the model params.
+        # Faster choices like "soxr_qq", "kaiser_fast" or "polyphase" cut CPU preprocessing time at a small cost in quality.
+        self.resample_type = arch_config.get("resample_type", None)
+
+        # Number of threads building and inverting the per-band spectrograms, defaults to one per band. 1 processes the bands serially.
+        self.band_workers = arch_config.get("band_workers", None)
+
         self.aggressiveness = {"value": self.aggression, "split_bin": self.model_params.param["band"][1]["crop_stop"], "aggr_correction": self.model_params.param.get("aggr_correction")}
 
         self.model_samplerate = self.model_params.param["sr"]
@@ -101,33 +110,22 @@ class VRSeparator(CommonSeparator):
         self.logger.debug(f"VR arch params: enable_tta={self.enable_tta}, enable_post_process={self.enable_post_process}, post_process_threshold={self.post_process_threshold}")
         self.logger.debug(f"VR arch params: batch_size={self.batch_size}, window_size={self.window_size}")
         self.logger.debug(f"VR arch params: high_end_process={self.high_end_process}, aggression={self.aggression}")
+        self.logger.debug(f"VR arch params: resample_type={self.resample_type}, band_workers={self.band_workers}")
         self.logger.debug(f"VR arch params: is_vr_51_model={self.is_vr_51_model}, model_samplerate={self.model_samplerate}, model_capacity={self.model_capacity}")
 
-        self.model_run = lambda *args, **kwargs: self.logger.error("Model run method is not initialised yet.")
+        self.load_model()
 
         # This should go away once we refactor to remove soundfile.write and replace with pydub like we did for the MDX rewrite
         self.wav_subtype = "PCM_16"
 
         self.logger.info("VR Separator initialisation complete")
 
-    def separate(self, audio_file_path):
+    def load_model(self):
         """
-        Separates the audio file into primary and secondary sources based on the model's configuration.
-        It processes the mix, demixes it into sources, normalizes the sources, and saves the output files.
-
-        Args:
-            audio_file_path (str): The path to the audio file to be processed.
-
-        Returns:
-            list: A list of paths to the output files generated by the separation process.
+        Builds the network matching the model file's size, loads its weights and moves it to the Torch device.
+        The model is loaded once and shared by every separate() call, including concurrent ones.
         """
-        self.primary_source = None
-        self.secondary_source = None
-
-        self.audio_file_path = audio_file_path
-        self.audio_file_base = os.path.splitext(os.path.basename(audio_file_path))[0]
-
-        self.logger.debug(f"Starting separation for input audio file {self.audio_file_path}...")
+        self.logger.debug("Loading model for inference...")
 
         nn_arch_sizes = [31191, 33966, 56817, 123821, 123812, 129605, 218409, 537238, 537227]  # default
         vr_5_1_models = [56817, 218409]
@@ -145,8 +143,33 @@ class VRSeparator(CommonSeparator):
 
         self.model_run.load_state_dict(torch.load(self.model_path, map_location=self.torch_device_cpu))
         self.model_run.to(self.torch_device)
+        self.model_run.eval()
         self.logger.debug("Model loaded and moved to device.")
 
+        if self.enable_quantization:
+            # Probe with a single window of normalized magnitudes, the same shape as the batches used in inference_vr
+            probe_input = torch.rand((1, 2, self.model_params.param["bins"] + 1, self.window_size), generator=torch.Generator().manual_seed(0))
+            self.model_run = self.quantize_model(self.model_run, [torch.nn.LSTM, torch.nn.Linear], probe_input, lambda model, x: model.predict_mask(x))
+
+    def separate(self, audio_file_path):
+        """
+        Separates the audio file into primary and secondary sources based on the model's configuration.
+        It processes the mix, demixes it into sources, normalizes the sources, and saves the output files.
+
+        Args:
+            audio_file_path (str): The path to the audio file to be processed.
+
+        Returns:
+            list: A list of paths to the output files generated by the separation process.
+        """
+        self.primary_source = None
+        self.secondary_source = None
+
+        self.audio_file_path = audio_file_path
+        self.audio_file_base = os.path.splitext(os.path.basename(audio_file_path))[0]
+
+        self.logger.debug(f"Starting separation for input audio file {self.audio_file_path}...")
+
         y_spec, v_spec = self.inference_vr(self.loading_mix(), self.torch_device, self.aggressiveness)
         self.logger.debug("Inference completed.")
 
@@ -178,13 +201,15 @@ class VRSeparator(CommonSeparator):
 
         # Note: logic similar to the following should probably be added to the other architectures
         # Check if output_single_stem is set to a value that would result in no output files
-        if self.output_single_stem and (self.output_single_stem.lower() != self.primary_stem_name.lower() and self.output_single_stem.lower() != self.secondary_stem_name.lower()):
-            # If so, reset output_single_stem to None to save both stems
-            self.output_single_stem = None
-            self.logger.warning(f"The output_single_stem setting '{self.output_single_stem}' does not match any of the output files: '{self.primary_stem_name}' and '{self.secondary_stem_name}'. For this model '{self.model_name}', the output_single_stem setting will be ignored and all output files will be saved.")
+        # The override only applies to this request, the separator's setting is shared by concurrent requests
+        output_single_stem = self.output_single_stem
+        if output_single_stem and (output_single_stem.lower() != self.primary_stem_name.lower() and output_single_stem.lower() != self.secondary_stem_name.lower()):
+            # If so, ignore output_single_stem to save both stems
+            self.logger.warning(f"The output_single_stem setting '{output_single_stem}' does not match any of the output files: '{self.primary_stem_name}' and '{self.secondary_stem_name}'. For this model '{self.model_name}', the output_single_stem setting will be ignored and all output files will be saved.")
+            output_single_stem = None
 
         # Save and process the primary stem if needed
-        if not self.output_single_stem or self.output_single_stem.lower() == self.primary_stem_name.lower():
+        if not output_single_stem or output_single_stem.lower() == self.primary_stem_name.lower():
             self.logger.debug(f"Processing primary stem: {self.primary_stem_name}")
             if not isinstance(self.primary_source, np.ndarray):
                 self.logger.debug(f"Preparing to convert spectrogram to waveform. Spec shape: {y_spec.shape}")
@@ -202,7 +227,7 @@ class VRSeparator(CommonSeparator):
             output_files.append(self.primary_stem_output_path)
 
         # Save and process the secondary stem if needed
-        if not self.output_single_stem or self.output_single_stem.lower() == self.secondary_stem_name.lower():
+        if not output_single_stem or output_single_stem.lower() == self.secondary_stem_name.lower():
             self.logger.debug(f"Processing secondary stem: {self.secondary_stem_name}")
             if not isinstance(self.secondary_source, np.ndarray):
                 self.logger.debug(f"Preparing to convert spectrogram to waveform. Spec shape: {v_spec.shape}")
@@ -225,8 +250,27 @@ class VRSeparator(CommonSeparator):
 
         return output_files
 
+    def band_res_type(self, bp):
+        """
+        Returns the resampler used for a band: the model's, unless overridden by MPS or the resample_type parameter.
+        """
+        if self.resample_type is not None:
+            return self.resample_type
+
+        if self.torch_device_mps is not None:
+            return "polyphase"
+
+        return bp["res_type"]
+
+    def load_audio(self, audio_file_path):
+        """
+        Decodes the input file at the sample rate of the model's high-end band, which the lower bands are resampled from.
+        """
+        bp = self.model_params.param["band"][len(self.model_params.param["band"])]
+        return librosa.load(audio_file_path, sr=bp["sr"], mono=False, dtype=np.float32, res_type=self.band_res_type(bp))[0]
+
     def loading_mix(self):
-        X_wave, X_spec_s = {}, {}
+        X_wave, band_waves = {}, {}
 
         bands_n = len(self.model_params.param["band"])
 
@@ -237,14 +281,12 @@ class VRSeparator(CommonSeparator):
         for d in tqdm(range(bands_n, 0, -1)):
             bp = self.model_params.param["band"][d]
 
-            wav_resolution = bp["res_type"]
-
-            if self.torch_device_mps is not None:
-                wav_resolution = "polyphase"
+            wav_resolution = self.band_res_type(bp)
 
             if d == bands_n:  # high-end band
-                X_wave[d], _ = librosa.load(audio_file, sr=bp["sr"], mono=False, dtype=np.float32, res_type=wav_resolution)
-                X_spec_s[d] = spec_utils.wave_to_spectrogram(X_wave[d], bp["hl"], bp["n_fft"], self.model_params, band=d, is_v51_model=self.is_vr_51_model)
+                X_wave[d] = self.load_input_audio(audio_file)
+                # The spectrogram is taken from the wave as loaded, before any mp3 reload below
+                band_waves[d] = X_wave[d]
 
                 if not np.any(X_wave[d]) and is_mp3:
                     X_wave[d] = rerun_mp3(audio_file, bp["sr"])
@@ -253,52 +295,78 @@ class VRSeparator(CommonSeparator):
                     X_wave[d] = np.asarray([X_wave[d], X_wave[d]])
             else:  # lower bands
                 X_wave[d] = librosa.resample(X_wave[d + 1], orig_sr=self.model_params.param["band"][d + 1]["sr"], target_sr=bp["sr"], res_type=wav_resolution)
-                X_spec_s[d] = spec_utils.wave_to_spectrogram(X_wave[d], bp["hl"], bp["n_fft"], self.model_params, band=d, is_v51_model=self.is_vr_51_model)
+                band_waves[d] = X_wave[d]
+
+        # Each band's resample depends on the band above, but their spectrograms are independent, so those are built concurrently
+        def band_spectrogram(d):
+            bp = self.model_params.param["band"][d]
+            return spec_utils.wave_to_spectrogram(band_waves[d], bp["hl"], bp["n_fft"], self.model_params, band=d, is_v51_model=self.is_vr_51_model)
 
-            if d == bands_n and self.high_end_process:
-                self.input_high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (self.model_params.param["pre_filter_stop"] - self.model_params.param["pre_filter_start"])
-                self.input_high_end = X_spec_s[d][:, bp["n_fft"] // 2 - self.input_high_end_h : bp["n_fft"] // 2, :]
+        X_spec_s = dict(zip(band_waves, spec_utils.run_threaded(band_spectrogram, band_waves, self.band_workers)))
+
+        if self.high_end_process:
+            bp = self.model_params.param["band"][bands_n]
+            self.input_high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (self.model_params.param["pre_filter_stop"] - self.model_params.param["pre_filter_start"])
+            self.input_high_end = X_spec_s[bands_n][:, bp["n_fft"] // 2 - self.input_high_end_h : bp["n_fft"] // 2, :]
 
         X_spec = spec_utils.combine_spectrograms(X_spec_s, self.model_params, is_v51_model=self.is_vr_51_model)
 
-        del X_wave, X_spec_s, audio_file
+        del X_wave, band_waves, X_spec_s, audio_file
 
         return X_spec
 
     def inference_vr(self, X_spec, device, aggressiveness):
-        def _execute(X_mag_pad, roi_size):
-            X_dataset = []
-            patches = (X_mag_pad.shape[2] - 2 * self.model_run.offset) // roi_size
+        def _execute(X_mag_pads, roi_size):
+            """
+            Runs the model over the patches of each padded spectrogram and returns one mask per spectrogram.
+            Patches are strided views into the padded spectrograms, so only the current batch is copied into contiguous memory,
+            and patches of all spectrograms (the TTA pass included) share batches.
+            """
+            patch_windows = []
+            for X_mag_pad in X_mag_pads:
+                patches = (X_mag_pad.shape[2] - 2 * self.model_run.offset) // roi_size
+                if patches <= 0:
+                    raise ValueError(f"Window size error: h1_shape[3] must be greater than h2_shape[3]")
 
-            self.logger.debug(f"inference_vr appending to X_dataset for each of {patches} patches")
-            for i in tqdm(range(patches)):
-                start = i * roi_size
-                X_mag_window = X_mag_pad[:, :, start : start + self.window_size]
-                X_dataset.append(X_mag_window)
+                # (channels, bins, windows, window_size) view, taking every roi_size-th window and moving patches to the front
+                windows = np.lib.stride_tricks.sliding_window_view(X_mag_pad, self.window_size, axis=2)[:, :, ::roi_size][:, :, :patches]
+                patch_windows.append(windows.transpose(2, 0, 1, 3))
 
-            total_iterations = patches // self.batch_size if not self.enable_tta else (patches // self.batch_size) * 2
-            self.logger.debug(f"inference_vr iterating through {total_iterations} batches, batch_size = {self.batch_size}")
+            patch_starts = np.cumsum([0] + [len(windows) for windows in patch_windows])
+            total_patches = patch_starts[-1]
+
+            total_iterations = math.ceil(total_patches / self.batch_size)
+            self.logger.debug(f"inference_vr iterating through {total_iterations} batches of {total_patches} patches, batch_size = {self.batch_size}")
 
-            X_dataset = np.asarray(X_dataset)
             self.model_run.eval()
             with torch.no_grad():
-                mask = []
+                masks = [[] for _ in patch_windows]
+
+                for i in tqdm(range(0, total_patches, self.batch_size)):
+                    batch_end = min(i + self.batch_size, total_patches)
 
-                for i in tqdm(range(0, patches, self.batch_size)):
+                    # Collects the patches of this batch, which may span the end of one spectrogram and the start of the next
+                    batch_parts = []
+                    for pass_index, windows in enumerate(patch_windows):
+                        part_start, part_end = max(i, patch_starts[pass_index]), min(batch_end, patch_starts[pass_index + 1])
+                        if part_start < part_end:
+                            batch_parts.append((pass_index, windows[part_start - patch_starts[pass_index] : part_end - patch_starts[pass_index]]))
 
-                    X_batch = X_dataset[i : i + self.batch_size]
+                    X_batch = np.concatenate([part for _, part in batch_parts])
                     X_batch = torch.from_numpy(X_batch).to(device)
-                    pred = self.model_run.predict_mask(X_batch)
+                    with self.autocast_context():
+                        pred = self.run_batched(self.model_run.predict_mask, X_batch)
                     if not pred.size()[3] > 0:
                         raise ValueError(f"Window size error: h1_shape[3] must be greater than h2_shape[3]")
-                    pred = pred.detach().cpu().numpy()
-                    pred = np.concatenate(pred, axis=2)
-                    mask.append(pred)
-                if len(mask) == 0:
-                    raise ValueError(f"Window size error: h1_shape[3] must be greater than h2_shape[3]")
+                    pred = pred.detach().float().cpu().numpy()
+
+                    pred_start = 0
+                    for pass_index, part in batch_parts:
+                        masks[pass_index].append(np.concatenate(pred[pred_start : pred_start + len(part)], axis=2))
+                        pred_start += len(part)
 
-                mask = np.concatenate(mask, axis=2)
-            return mask
+                masks = [np.concatenate(mask, axis=2) for mask in masks]
+            return masks
 
         def postprocess(mask, X_mag, X_phase):
             is_non_accom_stem = False
@@ -306,13 +374,11 @@ class VRSeparator(CommonSeparator):
                 if stem == self.primary_stem_name:
                     is_non_accom_stem = True
 
-            mask = spec_utils.adjust_aggr(mask, is_non_accom_stem, aggressiveness)
-
-            if self.enable_post_process:
-                mask = spec_utils.merge_artifacts(mask, thres=self.post_process_threshold)
-
-            y_spec = mask * X_mag * np.exp(1.0j * X_phase)
-            v_spec = (1 - mask) * X_mag * np.exp(1.0j * X_phase)
+            # Aggressiveness, artifact merging and both stem spectrograms are applied in chunked, in-place passes over the mask,
+            # rather than allocating full-size copies of the mask and spectrogram at each step
+            post_process_threshold = self.post_process_threshold if self.enable_post_process else None
+            mask = mask.astype(spec_utils.WAVE_DTYPE, copy=False)
+            y_spec, v_spec = spec_utils.apply_mask_chunked(mask, X_mag, X_phase, is_non_accom_stem, aggressiveness, post_process_threshold=post_process_threshold)
 
             return y_spec, v_spec
 
@@ -321,15 +387,20 @@ class VRSeparator(CommonSeparator):
         pad_l, pad_r, roi_size = spec_utils.make_padding(n_frame, self.window_size, self.model_run.offset)
         X_mag_pad = np.pad(X_mag, ((0, 0), (0, 0), (pad_l, pad_r)), mode="constant")
         X_mag_pad /= X_mag_pad.max()
-        mask = _execute(X_mag_pad, roi_size)
+        X_mag_pads = [X_mag_pad]
 
         if self.enable_tta:
             pad_l += roi_size // 2
             pad_r += roi_size // 2
-            X_mag_pad = np.pad(X_mag, ((0, 0), (0, 0), (pad_l, pad_r)), mode="constant")
-            X_mag_pad /= X_mag_pad.max()
-            mask_tta = _execute(X_mag_pad, roi_size)
-            mask_tta = mask_tta[:, :, roi_size // 2 :]
+            X_mag_pad_tta = np.pad(X_mag, ((0, 0), (0, 0), (pad_l, pad_r)), mode="constant")
+            X_mag_pad_tta /= X_mag_pad_tta.max()
+            X_mag_pads.append(X_mag_pad_tta)
+
+        masks = _execute(X_mag_pads, roi_size)
+        mask = masks[0]
+
+        if self.enable_tta:
+            mask_tta = masks[1][:, :, roi_size // 2 :]
             mask = (mask[:, :, :n_frame] + mask_tta[:, :, :n_frame]) * 0.5
         else:
             mask = mask[:, :, :n_frame]
@@ -341,9 +412,11 @@ class VRSeparator(CommonSeparator):
     def spec_to_wav(self, spec):
         if self.high_end_process and isinstance(self.input_high_end, np.ndarray) and self.input_high_end_h:
             input_high_end_ = spec_utils.mirroring("mirroring", spec, self.input_high_end, self.model_params)
-            wav = spec_utils.cmb_spectrogram_to_wave(spec, self.model_params, self.input_high_end_h, input_high_end_, is_v51_model=self.is_vr_51_model)
+            wav = spec_utils.cmb_spectrogram_to_wave(
+                spec, self.model_params, self.input_high_end_h, input_high_end_, is_v51_model=self.is_vr_51_model, res_type=self.resample_type, max_workers=self.band_workers
+            )
         else:
-            wav = spec_utils.cmb_spectrogram_to_wave(spec, self.model_params, is_v51_model=self.is_vr_51_model)
+            wav = spec_utils.cmb_spectrogram_to_wave(spec, self.model_params, is_v51_model=self.is_vr_51_model, res_type=self.resample_type, max_workers=self.band_workers)
 
         return wav
 
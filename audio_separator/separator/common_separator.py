@@ -2,7 +2,10 @@
 
 from logging import Logger
 import os
+import contextlib
 import gc
+import threading
+import time
 import numpy as np
 import librosa
 import torch
@@ -11,6 +14,28 @@ import soundfile as sf
 from audio_separator.separator.uvr_lib_v5 import spec_utils
 
 
+class SeparationContext:
+    """
+    Holds the state of a single separation request, i.e. the input file, the separated sources and the output paths.
+    Each thread using a separator gets its own context, so one loaded model can serve concurrent requests.
+    """
+
+
+def context_attribute(name, default=None):
+    """
+    Returns a property which stores the attribute in the calling thread's SeparationContext rather than on the separator,
+    so existing code can keep reading and writing self.<name>.
+    """
+
+    def getter(self):
+        return getattr(self.separation_context, name, default)
+
+    def setter(self, value):
+        setattr(self.separation_context, name, value)
+
+    return property(getter, setter)
+
+
 class CommonSeparator:
     """
     This class contains the common methods and attributes common to all architecture-specific Separator classes.
@@ -53,7 +78,27 @@ class CommonSeparator:
 
     NON_ACCOM_STEMS = (VOCAL_STEM, OTHER_STEM, BASS_STEM, DRUM_STEM, GUITAR_STEM, PIANO_STEM, SYNTH_STEM, STRINGS_STEM, WOODWINDS_STEM, BRASS_STEM, WIND_INST_STEM)
 
+    PRECISION_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+    # Outcome of the quantization regression check per model file and probe, so loading the same model again
+    # (e.g. another Separator or a SeparatorPool reload) doesn't run the fp32 and int8 probes again
+    quantization_checks = {}
+
+    # Output formats written directly with libsndfile rather than through ffmpeg
+    SOUNDFILE_LOSSLESS_FORMATS = ("wav", "flac", "aiff", "aif")
+
+    # File-specific variables, which live in the per-thread separation context and are cleared between audio inputs
+    audio_file_path = context_attribute("audio_file_path")
+    audio_file_base = context_attribute("audio_file_base")
+    primary_source = context_attribute("primary_source")
+    secondary_source = context_attribute("secondary_source")
+    primary_stem_output_path = context_attribute("primary_stem_output_path")
+    secondary_stem_output_path = context_attribute("secondary_stem_output_path")
+    stem_sources = context_attribute("stem_sources")
+    prefetched_audio = context_attribute("prefetched_audio")
+
     def __init__(self, config):
+        self.separation_contexts = threading.local()
 
         self.logger: Logger = config.get("logger")
         self.log_level: int = config.get("log_level")
@@ -68,6 +113,8 @@ class CommonSeparator:
         self.model_name = config.get("model_name")
         self.model_path = config.get("model_path")
         self.model_data = config.get("model_data")
+        self.model_hash = config.get("model_hash")
+        self.model_file_dir = config.get("model_file_dir")
 
         # Output directory and format
         self.output_dir = config.get("output_dir")
@@ -81,6 +128,19 @@ class CommonSeparator:
         self.invert_using_spec = config.get("invert_using_spec")
         self.sample_rate = config.get("sample_rate")
 
+        # Opt-in dynamic int8 quantization of Linear / LSTM layers for CPU inference.
+        # The quantized model is only used if its output stays within quantization_min_sdr (dB) of the fp32 model's output.
+        self.enable_quantization = config.get("enable_quantization", False)
+        self.quantization_min_sdr = config.get("quantization_min_sdr", 20.0)
+
+        # Inference precision (fp32, bf16 or fp16), applied to model forward passes through torch.autocast.
+        # STFT / ISTFT steps are always kept in fp32 for accuracy.
+        self.precision = config.get("precision", "fp32")
+
+        # Optional function (audio_file_path, sample_rate) -> audio decoding input files instead of librosa.load,
+        # e.g. a cache shared with other processing stages so each file is only decoded once.
+        self.audio_loader = config.get("audio_loader")
+
         # Model specific properties
 
         # Check if model_data has a "training" key with "instruments" list
@@ -106,21 +166,29 @@ class CommonSeparator:
         self.logger.debug(f"Common params: normalization_threshold={self.normalization_threshold}")
         self.logger.debug(f"Common params: enable_denoise={self.enable_denoise}, output_single_stem={self.output_single_stem}")
         self.logger.debug(f"Common params: invert_using_spec={self.invert_using_spec}, sample_rate={self.sample_rate}")
+        self.logger.debug(f"Common params: enable_quantization={self.enable_quantization}, quantization_min_sdr={self.quantization_min_sdr}")
+        self.logger.debug(f"Common params: precision={self.precision}")
 
         self.logger.debug(f"Common params: primary_stem_name={self.primary_stem_name}, secondary_stem_name={self.secondary_stem_name}")
         self.logger.debug(f"Common params: is_karaoke={self.is_karaoke}, is_bv_model={self.is_bv_model}, bv_model_rebalance={self.bv_model_rebalance}")
 
-        # File-specific variables which need to be cleared between processing different audio inputs
-        self.audio_file_path = None
-        self.audio_file_base = None
+        self.cached_sources_map = {}
 
-        self.primary_source = None
-        self.secondary_source = None
+        # Coalesces model chunks with those of concurrent requests when set, see audio_separator.separator.server.ChunkBatcher
+        self.chunk_batcher = None
 
-        self.primary_stem_output_path = None
-        self.secondary_stem_output_path = None
+        # Writes stems in the background when set, see audio_separator.separator.writer.StemWriterPool
+        self.stem_writer = None
 
-        self.cached_sources_map = {}
+    @property
+    def separation_context(self):
+        """
+        Returns the SeparationContext of the calling thread, creating an empty one the first time the thread uses this separator.
+        """
+        context = getattr(self.separation_contexts, "context", None)
+        if context is None:
+            context = self.separation_contexts.context = SeparationContext()
+        return context
 
     def secondary_stem(self, primary_stem: str):
         """Determines secondary stem name based on the primary stem name."""
@@ -144,10 +212,28 @@ class CommonSeparator:
         Finalizes the processing of a stem by writing the audio to a file and returning the processed source.
         """
         self.logger.debug(f"Finalizing {stem_name} stem processing and writing audio...")
-        self.write_audio(stem_path, source)
+        if self.stem_writer is not None:
+            self.stem_writer.submit(stem_path, self.write_audio, stem_path, source)
+        else:
+            self.write_audio(stem_path, source)
+
+        # Kept until the context is cleared, so callers can get the stems without reading the files back
+        if self.stem_sources is None:
+            self.stem_sources = {}
+        self.stem_sources[stem_name] = source
 
         return {stem_name: source}
 
+    def run_batched(self, model_function, batch):
+        """
+        Runs the model function on a batch of chunks, through the chunk batcher when one is set so the chunks of concurrent
+        requests for this model share a forward pass.
+        """
+        if self.chunk_batcher is None:
+            return model_function(batch)
+
+        return self.chunk_batcher.run(model_function, batch)
+
     def cached_sources_clear(self):
         """
         Clears the cache dictionaries for VR, MDX, and Demucs models.
@@ -191,6 +277,29 @@ class CommonSeparator:
         """
         self.cached_sources_map[model_architecture] = {**self.cached_sources_map.get(model_architecture, {}), **{model_name: sources}}
 
+    def load_audio(self, audio_file_path):
+        """
+        Decodes and resamples an input file the way this architecture's separation needs it.
+        It doesn't touch the separation context, so it can run ahead on a prefetching thread (see AudioPrefetcher).
+        """
+        if self.audio_loader is not None:
+            # Copied, as the loader's arrays may be shared and separation normalizes the mix in place
+            return np.array(self.audio_loader(audio_file_path, self.sample_rate), dtype=np.float32)
+
+        return librosa.load(audio_file_path, mono=False, sr=self.sample_rate)[0]
+
+    def load_input_audio(self, audio_file_path):
+        """
+        Returns the decoded input file, using the audio prefetched for this request if there is one.
+        """
+        prefetched_audio = self.prefetched_audio
+        if prefetched_audio is not None and prefetched_audio[0] == audio_file_path:
+            self.prefetched_audio = None
+            self.logger.debug(f"Using prefetched audio for {audio_file_path}")
+            return prefetched_audio[1]
+
+        return self.load_audio(audio_file_path)
+
     def prepare_mix(self, mix):
         """
         Prepares the mix for processing. This includes loading the audio from a file if necessary,
@@ -202,8 +311,8 @@ class CommonSeparator:
         # Check if the input is a file path (string) and needs to be loaded
         if not isinstance(mix, np.ndarray):
             self.logger.debug(f"Loading audio from file: {mix}")
-            mix, sr = librosa.load(mix, mono=False, sr=self.sample_rate)
-            self.logger.debug(f"Audio loaded. Sample rate: {sr}, Audio shape: {mix.shape}")
+            mix = self.load_input_audio(mix)
+            self.logger.debug(f"Audio loaded. Sample rate: {self.sample_rate}, Audio shape: {mix.shape}")
         else:
             # Transpose the mix if it's already an ndarray (expected shape: [channels, samples])
             self.logger.debug("Transposing the provided mix array.")
@@ -232,12 +341,20 @@ class CommonSeparator:
     def write_audio(self, stem_path: str, stem_source):
         """
         Writes the separated audio source to a file using pydub or soundfile
-        Pydub supports a much wider range of audio formats and produces better encoded lossy files for some formats.
-        Soundfile is used for very large files (longer than 1 hour), as pydub has memory issues with large files:
+        Lossless formats (WAV, FLAC, AIFF) are written directly from the float array with soundfile (libsndfile),
+        without the int16 interleave copy and ffmpeg subprocess. Pydub (ffmpeg) is used for the lossy codecs, as it
+        supports a much wider range of formats and produces better encoded lossy files for some of them.
+        Soundfile is also used for very large files (longer than 1 hour), as pydub has memory issues with large files:
         https://github.com/jiaaro/pydub/issues/135
         """
-        # Get the duration of the input audio file
-        duration_seconds = librosa.get_duration(filename=self.audio_file_path)
+        file_format = stem_path.lower().split(".")[-1]
+        if file_format in self.SOUNDFILE_LOSSLESS_FORMATS:
+            self.logger.debug(f"Using soundfile for writing lossless {file_format} output.")
+            self.write_audio_soundfile(stem_path, stem_source)
+            return
+
+        # The stem has the length of the loaded mix, so there is no need to reopen the input file for its duration
+        duration_seconds = len(stem_source) / self.sample_rate
         duration_hours = duration_seconds / 3600
         self.logger.info(f"Audio duration is {duration_hours:.2f} hours ({duration_seconds:.2f} seconds).")
 
@@ -254,11 +371,13 @@ class CommonSeparator:
         """
         self.logger.debug(f"Entering write_audio_pydub with stem_path: {stem_path}")
 
-        stem_source = spec_utils.normalize(wave=stem_source, max_peak=self.normalization_threshold)
+        # Normalize a copy, as the source is also handed to the caller through stem_sources, possibly while this runs on a writer thread
+        stem_source = spec_utils.normalize(wave=np.array(stem_source), max_peak=self.normalization_threshold)
 
         # Check if the numpy array is empty or contains very low values
         if np.max(np.abs(stem_source)) < 1e-6:
             self.logger.warning("Warning: stem_source array is near-silent or empty.")
+            self.raise_write_error(ValueError(f"Stem {stem_path} is near-silent or empty and was not written."))
             return
 
         # If output_dir is specified, create it and join it with stem_path
@@ -287,6 +406,7 @@ class CommonSeparator:
             self.logger.debug("Created AudioSegment successfully.")
         except (IOError, ValueError) as e:
             self.logger.error(f"Specific error creating AudioSegment: {e}")
+            self.raise_write_error(e)
             return
 
         # Determine file format based on the file extension
@@ -307,41 +427,111 @@ class CommonSeparator:
             self.logger.debug(f"Exported audio file successfully to {stem_path}")
         except (IOError, ValueError) as e:
             self.logger.error(f"Error exporting audio file: {e}")
+            self.raise_write_error(e)
+
+    def raise_write_error(self, error):
+        """
+        Raises a failed or skipped write when the stem is written by the background stem writer, whose pool keeps the error
+        for Separator.separate / wait_for_writes to raise. Synchronous writes only log it, as they always have.
+        """
+        if self.stem_writer is not None:
+            raise error
 
     def write_audio_soundfile(self, stem_path: str, stem_source):
         """
         Writes the separated audio source to a file using soundfile library.
+        The (samples, channels) float array is handed to libsndfile as is, which converts it to the file's sample format.
         """
         self.logger.debug(f"Entering write_audio_soundfile with stem_path: {stem_path}")
 
-        # Correctly interleave stereo channels if needed
-        if stem_source.shape[1] == 2:
-            # If the audio is already interleaved, ensure it's in the correct order
-            # Check if the array is Fortran contiguous (column-major)
-            if stem_source.flags["F_CONTIGUOUS"]:
-                # Convert to C contiguous (row-major)
-                stem_source = np.ascontiguousarray(stem_source)
-            # Otherwise, perform interleaving
-            else:
-                stereo_interleaved = np.empty((2 * stem_source.shape[0],), dtype=np.int16)
-                # Left channel
-                stereo_interleaved[0::2] = stem_source[:, 0]
-                # Right channel
-                stereo_interleaved[1::2] = stem_source[:, 1]
-                stem_source = stereo_interleaved
+        # Normalize a copy, as the source is also handed to the caller through stem_sources, possibly while this runs on a writer thread
+        stem_source = spec_utils.normalize(wave=np.array(stem_source), max_peak=self.normalization_threshold)
 
-        self.logger.debug(f"Interleaved audio data shape: {stem_source.shape}")
+        # Check if the numpy array is empty or contains very low values
+        if np.max(np.abs(stem_source)) < 1e-6:
+            self.logger.warning("Warning: stem_source array is near-silent or empty.")
+            self.raise_write_error(ValueError(f"Stem {stem_path} is near-silent or empty and was not written."))
+            return
 
-        """
-        Write audio using soundfile (for formats other than M4A).
-        """
-        # Save audio using soundfile
+        # If output_dir is specified, create it and join it with stem_path
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            stem_path = os.path.join(self.output_dir, stem_path)
+
+        self.logger.debug(f"Audio data shape: {stem_source.shape}, data type: {stem_source.dtype}")
+
+        # Save audio using soundfile, which picks the container from the file extension
         try:
-            # Specify the subtype to define the sample width
             sf.write(stem_path, stem_source, self.sample_rate)
             self.logger.debug(f"Exported audio file successfully to {stem_path}")
         except Exception as e:
             self.logger.error(f"Error exporting audio file: {e}")
+            self.raise_write_error(e)
+
+    def autocast_context(self):
+        """
+        Returns a torch.autocast context for the configured inference precision on the inferencing device,
+        or a no-op context when running in full fp32 precision.
+        """
+        autocast_dtype = self.PRECISION_DTYPES[self.precision]
+        if autocast_dtype is None:
+            return contextlib.nullcontext()
+
+        return torch.autocast(device_type=self.torch_device.type, dtype=autocast_dtype)
+
+    def quantize_model(self, model, module_types, probe_input, run_probe):
+        """
+        Applies dynamic int8 quantization to the given module types (e.g. torch.nn.Linear, torch.nn.LSTM) of a model, for faster CPU inference.
+
+        As a regression check, the probe input is run through both the fp32 and the quantized model; the speedup and the SDR
+        of the quantized output against the fp32 output are logged, and the fp32 model is kept if the SDR is below quantization_min_sdr.
+        The check runs once per model file, later loads reuse its outcome from quantization_checks.
+
+        Args:
+            model: The fp32 model to quantize.
+            module_types: The module types which should be dynamically quantized.
+            probe_input: A representative model input used for the SDR regression check and speedup measurement.
+            run_probe: A callable taking (model, probe_input) and returning the model output to compare.
+
+        Returns:
+            The quantized model if it passed the regression check, otherwise the original fp32 model.
+        """
+        if self.torch_device != self.torch_device_cpu:
+            self.logger.warning(f"Dynamic int8 quantization is only supported for CPU inference, but the device is {self.torch_device}. Using the fp32 model.")
+            return model
+
+        if not any(isinstance(module, tuple(module_types)) for module in model.modules()):
+            self.logger.debug("Model has no layers which support dynamic quantization, using the fp32 model.")
+            return model
+
+        self.logger.debug(f"Applying dynamic int8 quantization to {', '.join(module_type.__name__ for module_type in module_types)} layers...")
+        quantized_model = torch.ao.quantization.quantize_dynamic(model, set(module_types), dtype=torch.qint8)
+
+        check_key = (self.model_path, type(model).__name__, tuple(module_type.__name__ for module_type in module_types), tuple(probe_input.shape), self.quantization_min_sdr)
+        passed = self.quantization_checks.get(check_key)
+        if passed is not None:
+            self.logger.debug(f"Using the cached quantization check for {type(model).__name__}: {'passed' if passed else 'failed'}.")
+            return quantized_model if passed else model
+
+        with torch.no_grad():
+            fp32_start_time = time.perf_counter()
+            fp32_output = run_probe(model, probe_input)
+            fp32_duration = time.perf_counter() - fp32_start_time
+
+            quantized_start_time = time.perf_counter()
+            quantized_output = run_probe(quantized_model, probe_input)
+            quantized_duration = time.perf_counter() - quantized_start_time
+
+        sdr = spec_utils.calculate_sdr(fp32_output.cpu().numpy(), quantized_output.cpu().numpy())
+        speedup = fp32_duration / max(quantized_duration, 1e-9)
+        self.logger.info(f"Quantization check for {type(model).__name__}: SDR against fp32 output {sdr:.2f} dB, speedup {speedup:.2f}x ({fp32_duration:.3f}s -> {quantized_duration:.3f}s)")
+
+        self.quantization_checks[check_key] = sdr >= self.quantization_min_sdr
+        if sdr < self.quantization_min_sdr:
+            self.logger.warning(f"Quantized model SDR of {sdr:.2f} dB is below the minimum of {self.quantization_min_sdr} dB, using the fp32 model.")
+            return model
+
+        return quantized_model
 
     def clear_gpu_cache(self):
         """
@@ -362,11 +552,5 @@ class CommonSeparator:
         """
         self.logger.info("Clearing input audio file paths, sources and stems...")
 
-        self.audio_file_path = None
-        self.audio_file_base = None
-
-        self.primary_source = None
-        self.secondary_source = None
-
-        self.primary_stem_output_path = None
-        self.secondary_stem_output_path = None
+        # Only the calling thread's context is replaced, requests running on other threads keep theirs
+        self.separation_contexts.context = SeparationContext()
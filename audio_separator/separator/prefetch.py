@@ -0,0 +1,54 @@
+""" Background decoding of the next input files while the current one is being separated. """
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import logging
+
+
+class AudioPrefetcher:
+    """
+    Iterates over (audio_file_path, decoded audio) for a list of input files, decoding up to `prefetch` files ahead
+    on worker threads with the given load_audio function, so the model doesn't wait on ffmpeg and resampling.
+
+    Memory is bounded: a file is only submitted for decoding once an earlier decoded file has been handed out.
+    Files which fail to decode are handed out with None, so the caller's own decode reports the error for that file.
+    Decoding and resampling spend most of their time outside the GIL (ffmpeg, libsndfile, soxr), so threads are enough.
+    """
+
+    def __init__(self, load_audio, audio_file_paths, prefetch=2, num_workers=1, logger=None):
+        self.load_audio = load_audio
+        self.audio_file_paths = list(audio_file_paths)
+        self.prefetch = max(1, prefetch)
+        self.num_workers = max(1, num_workers)
+        self.logger = logger or logging.getLogger(__name__)
+
+    def __iter__(self):
+        audio_file_paths = iter(self.audio_file_paths)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="audio_prefetch") as executor:
+
+            def submit_next():
+                audio_file_path = next(audio_file_paths, None)
+                if audio_file_path is not None:
+                    pending.append((audio_file_path, executor.submit(self.load_audio, audio_file_path)))
+
+            for _ in range(self.prefetch):
+                submit_next()
+
+            try:
+                while pending:
+                    audio_file_path, future = pending.popleft()
+                    try:
+                        audio = future.result()
+                    except Exception as e:
+                        self.logger.debug(f"Prefetching {audio_file_path} failed, it will be decoded when separated: {e}")
+                        audio = None
+
+                    # The next file starts decoding while this one is separated
+                    submit_next()
+                    yield audio_file_path, audio
+            finally:
+                # Decoded files the caller never asked for are dropped when it stops iterating early
+                for _, future in pending:
+                    future.cancel()
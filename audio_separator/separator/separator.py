@@ -9,6 +9,7 @@ import time
 import logging
 import warnings
 import importlib
+import threading
 
 import hashlib
 import json
@@ -18,6 +19,9 @@ import torch
 import onnxruntime as ort
 from tqdm import tqdm
 
+from audio_separator.separator.prefetch import AudioPrefetcher
+from audio_separator.separator.writer import StemWriterPool
+
 
 class Separator:
     """
@@ -41,6 +45,14 @@ class Separator:
         output_single_stem (str): Option to output a single stem.
         invert_using_spec (bool): Flag to invert using spectrogram.
         sample_rate (int): The sample rate of the audio.
+        enable_quantization (bool): Flag to apply dynamic int8 quantization to Roformer and VR models for CPU inference.
+        quantization_min_sdr (float): The minimum SDR (dB) of quantized output against fp32 output for the quantized model to be used.
+        precision (str): The inference precision: fp32, bf16 or fp16 (fp16 only where the device supports it).
+        write_workers (int): Number of threads writing stems in the background, 0 writes them before separate() returns.
+        write_queue_size (int): Maximum number of stems queued for background writing before separate() blocks.
+        audio_loader (callable): Optional function (audio_file_path, sample_rate) -> audio array (channels, samples) used to decode
+            input files instead of librosa.load, e.g. a decoded audio cache shared with other stages. VR models keep their own decoding,
+            as they resample with the model's band resamplers.
 
     MDX Architecture Specific Attributes:
         hop_length (int): The hop length for STFT.
@@ -48,6 +60,12 @@ class Separator:
         overlap (float): The overlap between segments.
         batch_size (int): The batch size for processing.
         enable_denoise (bool): Flag to enable or disable denoising.
+        onnx_intra_op_threads (int): ONNX Runtime intra-op thread count, 0 to let ONNX Runtime decide.
+        onnx_inter_op_threads (int): ONNX Runtime inter-op thread count, 0 to let ONNX Runtime decide.
+        onnx_graph_optimization_level (str): ONNX Runtime graph optimization level: disable, basic, extended or all.
+        onnx_execution_mode (str): ONNX Runtime execution mode: sequential or parallel.
+        onnx_optimized_model_cache (bool): Flag to cache the graph-optimized ONNX model next to the model file.
+        onnx_enable_io_binding (bool): Flag to bind ONNX inputs and outputs to re-used buffers instead of copying per chunk.
 
     VR Architecture Specific Attributes & Defaults:
         batch_size: 16
@@ -57,11 +75,36 @@ class Separator:
         enable_post_process: False
         post_process_threshold: 0.2
         high_end_process: False
+        resample_type: None (use each band's res_type from the model params)
+        band_workers: None (one thread per band)
 
     Demucs Architecture Specific Attributes & Defaults:
         model_path: The path to the Demucs model file.
+        batch_size: 1
+        batch_shifts: False
+        shift_seed: None
+        num_workers: 0
+
+    MDXC Architecture Specific Attributes & Defaults:
+        segment_size: 256
+        batch_size: 1
+        overlap: 8
+        compile_mode: None (or "torch_compile" / "torchscript")
+        compile_backend: "inductor"
+        attention_chunk_size: None
     """
 
+    # Compiled model metadata registries, keyed by registry file path, shared by every Separator in this process.
+    # Each registry maps (path, size, mtime) -> model hash -> model parameters, so switching between models only costs the weight load.
+    # Model hashes are kept in their own small file, so hashing a new model doesn't rewrite the parsed UVR model data.
+    MODEL_REGISTRY_FILENAME = "model_registry.json"
+    MODEL_HASHES_FILENAME = "model_hashes.json"
+    MODEL_REGISTRY_VERSION = 2
+    MODEL_REGISTRY_SECTIONS = {MODEL_REGISTRY_FILENAME: ("model_data", "supported_model_files"), MODEL_HASHES_FILENAME: ("model_hashes",)}
+    model_registries = {}
+    # Reentrant, so a registry can be updated and saved while holding the lock
+    model_registry_lock = threading.RLock()
+
     def __init__(
         self,
         log_level=logging.INFO,
@@ -74,6 +117,12 @@ class Separator:
         output_single_stem=None,
         invert_using_spec=False,
         sample_rate=44100,
+        enable_quantization=False,
+        quantization_min_sdr=20.0,
+        precision="fp32",
+        write_workers=0,
+        write_queue_size=4,
+        audio_loader=None,
         mdx_params={"hop_length": 1024, "segment_size": 256, "overlap": 0.25, "batch_size": 1, "enable_denoise": False},
         vr_params={"batch_size": 16, "window_size": 512, "aggression": 5, "enable_tta": False, "enable_post_process": False, "post_process_threshold": 0.2, "high_end_process": False},
         demucs_params={"segment_size": "Default", "shifts": 2, "overlap": 0.25, "segments_enabled": True},
@@ -141,6 +190,11 @@ class Separator:
         except ValueError:
             raise ValueError("The sample rate must be a non-zero whole number. Please provide a valid integer.")
 
+        self.enable_quantization = enable_quantization
+        self.quantization_min_sdr = quantization_min_sdr
+        if self.enable_quantization:
+            self.logger.debug(f"Dynamic int8 quantization enabled for CPU inference, with a minimum SDR of {self.quantization_min_sdr} dB against fp32 output.")
+
         # These are parameters which users may want to configure so we expose them to the top-level Separator class,
         # even though they are specific to a single model architecture
         self.arch_specific_params = {"MDX": mdx_params, "VR": vr_params, "Demucs": demucs_params, "MDXC": mdxc_params}
@@ -152,10 +206,23 @@ class Separator:
         self.onnx_execution_provider = None
         self.model_instance = None
 
+        self.audio_loader = audio_loader
+
+        self.precision = precision
+        if self.precision not in ("fp32", "bf16", "fp16"):
+            raise ValueError(f"The precision setting is {self.precision} but it must be one of: fp32, bf16, fp16.")
+
         self.model_is_uvr_vip = False
         self.model_friendly_name = None
 
+        # With write workers, separate() returns once the stems are queued and encoding overlaps with the next file's separation
+        self.stem_writer = None
+        if write_workers > 0:
+            self.stem_writer = StemWriterPool(num_workers=write_workers, max_pending=write_queue_size, logger=self.logger)
+            self.logger.debug(f"Writing stems in the background with {write_workers} workers and up to {write_queue_size} queued stems")
+
         self.setup_accelerated_inferencing_device()
+        self.setup_inference_precision()
 
     def setup_accelerated_inferencing_device(self):
         """
@@ -262,6 +329,27 @@ class Separator:
         else:
             self.logger.warning("CoreMLExecutionProvider not available in ONNXruntime, so acceleration will NOT be enabled")
 
+    def setup_inference_precision(self):
+        """
+        This method checks the requested inference precision is supported by the inferencing device, falling back to fp32 if not.
+        bf16 is supported on CPU (fastest with AVX512-bf16 / AMX) and on CUDA devices which report bf16 support,
+        while fp16 is only used on GPU devices, as CPU fp16 autocast is usually slower than fp32.
+        """
+        if self.precision == "fp32":
+            return
+
+        if self.precision == "fp16" and self.torch_device.type == "cpu":
+            self.logger.warning("fp16 precision is not supported for CPU inference, falling back to fp32. Try bf16 for reduced precision on CPU.")
+            self.precision = "fp32"
+        elif self.precision == "bf16" and self.torch_device.type == "cuda" and not torch.cuda.is_bf16_supported():
+            self.logger.warning("bf16 precision is not supported by this CUDA device, falling back to fp32.")
+            self.precision = "fp32"
+        elif self.precision == "bf16" and self.torch_device.type == "mps":
+            self.logger.warning("bf16 precision is not supported for MPS inference, falling back to fp32.")
+            self.precision = "fp32"
+
+        self.logger.info(f"Inference precision set to {self.precision}")
+
     def get_package_distribution(self, package_name):
         """
         This method returns the package distribution for a given package name if installed, or None otherwise.
@@ -290,6 +378,80 @@ class Separator:
             # Attempt to open the file again, read its entire content, and calculate the MD5 hash
             return hashlib.md5(open(model_path, "rb").read()).hexdigest()
 
+    def get_file_signature(self, file_path):
+        """
+        This method returns the (size, mtime) signature of a file, used to detect when a cached registry entry is stale.
+        """
+        file_stat = os.stat(file_path)
+        return [file_stat.st_size, file_stat.st_mtime_ns]
+
+    def load_model_registry(self, registry_filename=MODEL_REGISTRY_FILENAME):
+        """
+        This method returns the compiled model metadata registry (or the model hashes registry) for model_file_dir.
+        The registry is read from disk at most once per process, then shared between all Separator instances.
+        It must only be modified while holding model_registry_lock, as save_model_registry may be serializing it.
+        """
+        registry_path = os.path.join(self.model_file_dir, registry_filename)
+
+        with self.model_registry_lock:
+            if registry_path in self.model_registries:
+                return self.model_registries[registry_path]
+
+            registry = None
+            if os.path.isfile(registry_path):
+                try:
+                    with open(registry_path, encoding="utf-8") as f:
+                        registry = json.load(f)
+                    self.logger.debug(f"Model registry loaded from {registry_path}")
+                except (IOError, ValueError) as e:
+                    self.logger.warning(f"Model registry at {registry_path} could not be read and will be rebuilt: {e}")
+
+            if not isinstance(registry, dict) or registry.get("version") != self.MODEL_REGISTRY_VERSION:
+                registry = {"version": self.MODEL_REGISTRY_VERSION, **{section: {} for section in self.MODEL_REGISTRY_SECTIONS[registry_filename]}}
+
+            self.model_registries[registry_path] = registry
+            return registry
+
+    def save_model_registry(self, registry_filename=MODEL_REGISTRY_FILENAME):
+        """
+        This method writes the compiled model metadata registry (or the model hashes registry) back to model_file_dir, so later processes can reuse it.
+        The file is written to a temporary path first and then moved into place, so readers never see a partial registry.
+        """
+        registry_path = os.path.join(self.model_file_dir, registry_filename)
+        registry = self.load_model_registry(registry_filename)
+
+        with self.model_registry_lock:
+            temp_registry_path = f"{registry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_registry_path, "w", encoding="utf-8") as f:
+                    json.dump(registry, f)
+                os.replace(temp_registry_path, registry_path)
+                self.logger.debug(f"Model registry saved to {registry_path}")
+            except IOError as e:
+                self.logger.warning(f"Unable to save model registry to {registry_path}: {e}")
+
+    def get_cached_model_hash(self, model_path):
+        """
+        This method returns the MD5 hash of a given model file, using the model registry to skip re-hashing
+        files whose path, size and modification time haven't changed since they were last hashed.
+        """
+        registry = self.load_model_registry(self.MODEL_HASHES_FILENAME)
+        registry_key = os.path.abspath(model_path)
+        file_signature = self.get_file_signature(model_path)
+
+        with self.model_registry_lock:
+            cached_entry = registry["model_hashes"].get(registry_key)
+        if cached_entry is not None and cached_entry["signature"] == file_signature:
+            self.logger.debug(f"Model hash for {model_path} found in model registry")
+            return cached_entry["hash"]
+
+        model_hash = self.get_model_hash(model_path)
+        with self.model_registry_lock:
+            registry["model_hashes"][registry_key] = {"signature": file_signature, "hash": model_hash}
+            self.save_model_registry(self.MODEL_HASHES_FILENAME)
+
+        return model_hash
+
     def download_file_if_not_exists(self, url, output_path):
         """
         This method downloads a file from a given URL to a given output path, if the file does not already exist.
@@ -322,6 +484,18 @@ class Separator:
 
         self.download_file_if_not_exists("https://raw.githubusercontent.com/TRvlvr/application_data/main/filelists/download_checks.json", download_checks_path)
 
+        # Re-use the grouped model list from the model registry unless either of the source lists has changed on disk
+        registry = self.load_model_registry()
+        source_signatures = {
+            "download_checks": self.get_file_signature(download_checks_path),
+            "models": self.get_file_signature(str(resources.files("audio_separator").joinpath("models.json"))),
+        }
+
+        cached_entry = registry["supported_model_files"]
+        if cached_entry.get("sources") == source_signatures:
+            self.logger.debug("Supported model list found in model registry")
+            return cached_entry["models"]
+
         model_downloads_list = json.load(open(download_checks_path, encoding="utf-8"))
         self.logger.debug(f"UVR model download list loaded")
 
@@ -399,6 +573,11 @@ class Separator:
                 **audio_separator_models_list["roformer_download_list"],
             },
         }
+
+        with self.model_registry_lock:
+            registry["supported_model_files"] = {"sources": source_signatures, "models": model_files_grouped_by_type}
+            self.save_model_registry()
+
         return model_files_grouped_by_type
 
     def print_uvr_vip_message(self):
@@ -543,9 +722,9 @@ class Separator:
         vr_model_data_url = f"{model_data_url_prefix}/vr_model_data/model_data_new.json"
         mdx_model_data_url = f"{model_data_url_prefix}/mdx_model_data/model_data_new.json"
 
-        # Calculate hash for the downloaded model
+        # Calculate hash for the downloaded model, unless the model registry already has it for this exact file
         self.logger.debug("Calculating MD5 hash for model file to identify model parameters from UVR data...")
-        model_hash = self.get_model_hash(model_path)
+        model_hash = self.get_cached_model_hash(model_path)
         self.logger.debug(f"Model {model_path} has hash {model_hash}")
 
         # Setting up the path for model data and checking its existence
@@ -557,10 +736,24 @@ class Separator:
         self.logger.debug(f"MDX model data path set to {mdx_model_data_path}")
         self.download_file_if_not_exists(mdx_model_data_url, mdx_model_data_path)
 
-        # Loading model data
-        self.logger.debug("Loading MDX and VR model parameters from UVR model data files...")
-        vr_model_data_object = json.load(open(vr_model_data_path, encoding="utf-8"))
-        mdx_model_data_object = json.load(open(mdx_model_data_path, encoding="utf-8"))
+        # The model registry holds the parsed UVR data files, so they are only re-parsed when they change on disk
+        registry = self.load_model_registry()
+        source_signatures = {"vr": self.get_file_signature(vr_model_data_path), "mdx": self.get_file_signature(mdx_model_data_path)}
+
+        cached_entry = registry["model_data"]
+        if cached_entry.get("sources") == source_signatures:
+            self.logger.debug("UVR model parameters found in model registry")
+            vr_model_data_object = cached_entry["vr"]
+            mdx_model_data_object = cached_entry["mdx"]
+        else:
+            # Loading model data
+            self.logger.debug("Loading MDX and VR model parameters from UVR model data files...")
+            vr_model_data_object = json.load(open(vr_model_data_path, encoding="utf-8"))
+            mdx_model_data_object = json.load(open(mdx_model_data_path, encoding="utf-8"))
+
+            with self.model_registry_lock:
+                registry["model_data"] = {"sources": source_signatures, "vr": vr_model_data_object, "mdx": mdx_model_data_object}
+                self.save_model_registry()
 
         # vr_model_data_object JSON structure / example snippet:
         # {
@@ -637,10 +830,11 @@ class Separator:
         #     }
         # }
 
+        # Hand out a copy, so callers modifying model_data cannot alter the shared model registry entry
         if model_hash in mdx_model_data_object:
-            model_data = mdx_model_data_object[model_hash]
+            model_data = dict(mdx_model_data_object[model_hash])
         elif model_hash in vr_model_data_object:
-            model_data = vr_model_data_object[model_hash]
+            model_data = dict(vr_model_data_object[model_hash])
         else:
             raise ValueError(f"Unsupported Model File: parameters for MD5 hash {model_hash} could not be found in UVR model data file for MDX or VR arch.")
 
@@ -670,6 +864,9 @@ class Separator:
         else:
             model_data = self.load_model_data_using_hash(model_path)
 
+        # The model hash identifies derived artifacts (e.g. converted or compiled models) cached in model_file_dir
+        model_hash = self.get_cached_model_hash(model_path)
+
         common_params = {
             "logger": self.logger,
             "log_level": self.log_level,
@@ -680,6 +877,8 @@ class Separator:
             "model_name": model_name,
             "model_path": model_path,
             "model_data": model_data,
+            "model_hash": model_hash,
+            "model_file_dir": self.model_file_dir,
             "output_format": self.output_format,
             "output_bitrate": self.output_bitrate,
             "output_dir": self.output_dir,
@@ -687,6 +886,10 @@ class Separator:
             "output_single_stem": self.output_single_stem,
             "invert_using_spec": self.invert_using_spec,
             "sample_rate": self.sample_rate,
+            "enable_quantization": self.enable_quantization,
+            "quantization_min_sdr": self.quantization_min_sdr,
+            "precision": self.precision,
+            "audio_loader": self.audio_loader,
         }
 
         # Instantiate the appropriate separator class depending on the model type
@@ -706,12 +909,24 @@ class Separator:
 
         self.logger.debug(f"Instantiating separator class for model type {model_type}: {separator_class}")
         self.model_instance = separator_class(common_config=common_params, arch_config=self.arch_specific_params[model_type])
+        self.model_instance.stem_writer = self.stem_writer
 
         # Log the completion of the model load process
         self.logger.debug("Loading model completed.")
         self.logger.info(f'Load model duration: {time.strftime("%H:%M:%S", time.gmtime(int(time.perf_counter() - load_model_start_time)))}')
 
-    def separate(self, audio_file_path):
+    def prefetch_audio(self, audio_file_paths, prefetch=2, num_workers=1):
+        """
+        Returns an iterator of (audio_file_path, decoded audio) which decodes up to `prefetch` files ahead on background threads,
+        for the loaded model's input format. Pass each item to separate(audio_file_path, prefetched_audio=audio) so the model
+        doesn't wait on decoding:
+
+            for audio_file_path, audio in separator.prefetch_audio(audio_file_paths):
+                output_files = separator.separate(audio_file_path, prefetched_audio=audio)
+        """
+        return AudioPrefetcher(self.model_instance.load_audio, audio_file_paths, prefetch=prefetch, num_workers=num_workers, logger=self.logger)
+
+    def separate(self, audio_file_path, return_sources=False, prefetched_audio=None):
         """
         Separates the audio file into different stems (e.g., vocals, instruments) using the loaded model.
 
@@ -721,9 +936,15 @@ class Separator:
 
         Parameters:
         - audio_file_path (str): The path to the audio file to be separated.
+        - return_sources (bool): Also return the separated stems as arrays, saving callers from reading the files back.
+        - prefetched_audio (np.ndarray): The file already decoded by prefetch_audio, if any.
 
         Returns:
         - output_files (list of str): A list containing the paths to the separated audio stem files.
+        - sources (dict of str to np.ndarray): The stems keyed by stem name, only returned (after output_files) if return_sources is set.
+
+        With write_workers the output files may still be being written when this returns, call wait_for_writes(output_files)
+        before using them, which raises any failure writing them.
         """
         # Starting the separation process
         self.logger.info(f"Starting separation process for audio_file_path: {audio_file_path}")
@@ -731,8 +952,12 @@ class Separator:
 
         self.logger.debug(f"Normalization threshold set to {self.normalization_threshold}, waveform will lowered to this max amplitude to avoid clipping.")
 
+        if prefetched_audio is not None:
+            self.model_instance.prefetched_audio = (audio_file_path, prefetched_audio)
+
         # Run separation method for the loaded model
         output_files = self.model_instance.separate(audio_file_path)
+        sources = self.model_instance.stem_sources or {}
 
         # Clear GPU cache to free up memory
         self.model_instance.clear_gpu_cache()
@@ -747,8 +972,26 @@ class Separator:
         self.logger.debug("Separation process completed.")
         self.logger.info(f'Separation duration: {time.strftime("%H:%M:%S", time.gmtime(int(time.perf_counter() - separate_start_time)))}')
 
+        if return_sources:
+            return output_files, sources
+
         return output_files
 
+    def wait_for_writes(self, output_files=None):
+        """
+        Waits until the given output files (or all of them) have been written by the background stem writers,
+        raising the first failure writing those files. Returns immediately when stems are written synchronously.
+        Given output files which don't exist once written (e.g. skipped near-silent stems) raise a FileNotFoundError.
+        """
+        if self.stem_writer is None:
+            return
+
+        self.stem_writer.wait(output_files)
+
+        missing_files = [output_file for output_file in output_files or [] if not os.path.exists(os.path.join(self.output_dir, output_file))]
+        if missing_files:
+            raise FileNotFoundError(f"Output files were not written: {', '.join(missing_files)}")
+
     def download_model_and_data(self, model_filename):
         """
         Downloads the model file without loading it into memory.
@@ -0,0 +1,409 @@
+""" Local separation server keeping models warm and coalescing the model chunks of concurrent requests. """
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http.client
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import contextlib
+import threading
+import time
+
+import numpy as np
+import torch
+
+from audio_separator.separator.separator import Separator
+
+
+class ChunkBatch:
+    """
+    The chunks submitted for one model call while its batch is open, and the outputs handed back to their submitters.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.rows = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.outputs = None
+        self.error = None
+
+
+class ChunkBatcher:
+    """
+    Coalesces the chunk batches which concurrent requests pass to the same model function into one forward pass.
+
+    The first request to submit a chunk of a given shape opens a batch and waits up to max_latency seconds (or until
+    max_batch_size rows are queued, or every active request has added a chunk) for other requests to add theirs, then runs
+    the model once on the concatenated batch and hands each request back its own rows.
+    It runs on the submitting threads, so no extra worker thread is needed.
+    """
+
+    def __init__(self, max_batch_size=8, max_latency=0.01, logger=None):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.unbatchable = set()
+        self.active_requests = 0
+
+    @contextlib.contextmanager
+    def request(self):
+        """
+        Marks a separation request as running, a batch never waits for more chunks than there are running requests.
+        """
+        with self.lock:
+            self.active_requests += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active_requests -= 1
+                # A batch may have been waiting on the request which just finished
+                for key, group in list(self.pending.items()):
+                    if len(group.parts) >= self.active_requests:
+                        del self.pending[key]
+                        group.full.set()
+
+    def run(self, function, batch):
+        # Only chunks of the same shape, type and device can be concatenated along the batch dimension
+        key = (function, tuple(batch.shape[1:]), batch.dtype, batch.device)
+
+        with self.lock:
+            if key in self.unbatchable:
+                group = None
+            else:
+                group = self.pending.get(key)
+                is_leader = group is None
+                if is_leader:
+                    group = self.pending[key] = ChunkBatch()
+                index = len(group.parts)
+                group.parts.append(batch)
+                group.rows += len(batch)
+                if group.rows >= self.max_batch_size or len(group.parts) >= self.active_requests:
+                    del self.pending[key]
+                    group.full.set()
+
+        if group is None:
+            return function(batch)
+
+        if not is_leader:
+            group.done.wait()
+            if group.error is not None:
+                raise group.error
+            return group.outputs[index]
+
+        group.full.wait(self.max_latency)
+        with self.lock:
+            if self.pending.get(key) is group:
+                del self.pending[key]
+
+        try:
+            group.outputs = self.run_batch(key, function, group.parts)
+        except Exception as e:
+            group.error = e
+        finally:
+            group.done.set()
+
+        if group.error is not None:
+            raise group.error
+        return group.outputs[index]
+
+    def run_batch(self, key, function, parts):
+        """
+        Runs the model once for all the parts of a batch and splits the output back into one output per part.
+        Models which reject the combined batch (e.g. an ONNX model with a fixed batch size) run each part separately from then on.
+        """
+        if len(parts) == 1:
+            return [function(parts[0])]
+
+        try:
+            output = function(torch.cat(parts))
+        except Exception as e:
+            self.logger.warning(f"Model failed to run {len(parts)} coalesced chunk batches at once, running them separately from now on: {e}")
+            with self.lock:
+                self.unbatchable.add(key)
+            return [function(part) for part in parts]
+
+        # Each part is copied out of the output, as models which re-use their output buffer (e.g. ONNX IO binding) overwrite it on the next run
+        outputs, start = [], 0
+        for part in parts:
+            outputs.append(output[start : start + len(part)].copy() if isinstance(output, np.ndarray) else output[start : start + len(part)].clone())
+            start += len(part)
+
+        return outputs
+
+
+class SeparatorPool:
+    """
+    Keeps up to max_models Separator instances with their model loaded, evicting the least recently used one.
+    Every loaded model gets a ChunkBatcher, so concurrent requests for the same model share its forward passes.
+    """
+
+    def __init__(self, separator_kwargs=None, max_models=2, max_batch_size=8, max_latency=0.01, logger=None):
+        self.separator_kwargs = separator_kwargs or {}
+        self.max_models = max_models
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.logger = logger or logging.getLogger(__name__)
+        self.separators = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def get(self, model_filename):
+        """
+        Returns the Separator with model_filename loaded, loading it first if it isn't already warm.
+        Models are loaded one at a time, requests for models which are already loaded don't wait for the load.
+        """
+        separator = self.get_loaded(model_filename)
+        if separator is not None:
+            return separator
+
+        with self.load_lock:
+            # Another request may have loaded the model while this one waited
+            separator = self.get_loaded(model_filename)
+            if separator is not None:
+                return separator
+
+            self.logger.info(f"Loading model {model_filename} into the separator pool...")
+            separator = Separator(**self.separator_kwargs)
+            separator.load_model(model_filename=model_filename)
+            separator.model_instance.chunk_batcher = ChunkBatcher(self.max_batch_size, self.max_latency, logger=separator.logger)
+
+            evicted_separators = []
+            with self.lock:
+                self.separators[model_filename] = separator
+                while len(self.separators) > self.max_models:
+                    # Requests still running on an evicted model keep their reference to it until they finish
+                    evicted_model_filename, evicted_separator = self.separators.popitem(last=False)
+                    evicted_separators.append(evicted_separator)
+                    self.logger.info(f"Evicted model {evicted_model_filename} from the separator pool.")
+
+            for evicted_separator in evicted_separators:
+                self.shutdown_writer(evicted_separator)
+
+            return separator
+
+    def shutdown_writer(self, separator):
+        """
+        Finishes the queued writes of an evicted separator and stops its writer threads.
+        """
+        if separator.stem_writer is None:
+            return
+
+        try:
+            separator.stem_writer.shutdown()
+        except Exception as e:
+            # The failure belongs to the request which queued the write, not to the one loading a model
+            self.logger.error(f"Writing stems of an evicted model failed: {e}")
+
+    def get_loaded(self, model_filename):
+        with self.lock:
+            separator = self.separators.get(model_filename)
+            if separator is not None:
+                self.separators.move_to_end(model_filename)
+            return separator
+
+    def loaded_models(self):
+        with self.lock:
+            return list(self.separators)
+
+
+class SeparationRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the server's HTTP API:
+        GET /health returns the loaded models.
+        POST /separate with a JSON body {"audio_file": path, "model_filename": optional, "return": "paths" or "arrays"}
+        returns {"output_files": [absolute paths]}, or the stems as an .npz archive keyed by stem name when return is "arrays".
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        self.send_json(200, {"status": "ok", "models": self.server.pool.loaded_models()})
+
+    def do_POST(self):
+        if self.path != "/separate":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            audio_file = request["audio_file"]
+            model_filename = request.get("model_filename") or self.server.default_model_filename
+            return_arrays = request.get("return", "paths") == "arrays"
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": f"Invalid separation request: {e}"})
+            return
+
+        try:
+            separator = self.server.pool.get(model_filename)
+            request_start_time = time.perf_counter()
+            with separator.model_instance.chunk_batcher.request():
+                output_files, sources = separator.separate(audio_file, return_sources=True)
+            separator.wait_for_writes(output_files)
+            self.server.logger.info(f"Separated {audio_file} with {model_filename} in {time.perf_counter() - request_start_time:.2f} seconds")
+        except Exception as e:
+            self.server.logger.exception(f"Separation of {audio_file} failed")
+            self.send_json(500, {"error": str(e)})
+            return
+
+        if not return_arrays:
+            self.send_json(200, {"output_files": [os.path.join(separator.output_dir, output_file) for output_file in output_files]})
+            return
+
+        buffer = io.BytesIO()
+        np.savez(buffer, **sources)
+        self.send_body(200, "application/octet-stream", buffer.getvalue())
+
+    def send_json(self, status, payload):
+        self.send_body(status, "application/json", json.dumps(payload).encode("utf-8"))
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no host address
+        return self.client_address[0] if self.client_address else "unix-socket"
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(f"{self.address_string()} - {format % args}")
+
+
+class SeparationServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server separating each request on its own thread with the warm models of a SeparatorPool.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, pool, default_model_filename, handler_class=SeparationRequestHandler):
+        self.pool = pool
+        self.default_model_filename = default_model_filename
+        self.logger = pool.logger
+        super().__init__(server_address, handler_class)
+
+
+class UnixSeparationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    SeparationServer listening on a Unix domain socket, for clients on the same machine.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool, default_model_filename, handler_class=SeparationRequestHandler):
+        self.pool = pool
+        self.default_model_filename = default_model_filename
+        self.logger = pool.logger
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, handler_class)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection talking to a server on a Unix domain socket.
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class SeparationClient:
+    """
+    Client for a running separation server, given either host and port or the path of its Unix socket.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, socket_path=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def connection(self):
+        if self.socket_path is not None:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, payload=None):
+        connection = self.connection()
+        try:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else None
+            connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise RuntimeError(f"Separation server returned {response.status}: {json.loads(data).get('error')}")
+        return response.getheader("Content-Type"), data
+
+    def health(self):
+        _, data = self.request("GET", "/health")
+        return json.loads(data)
+
+    def separate(self, audio_file, model_filename=None, return_arrays=False):
+        """
+        Separates audio_file on the server, returning the paths of the stem files,
+        or a dict of stem name to stem array (samples, channels) when return_arrays is set.
+        """
+        payload = {"audio_file": os.path.abspath(str(audio_file)), "model_filename": model_filename, "return": "arrays" if return_arrays else "paths"}
+        _, data = self.request("POST", "/separate", payload)
+
+        if not return_arrays:
+            return json.loads(data)["output_files"]
+
+        with np.load(io.BytesIO(data)) as stems:
+            return {stem_name: stems[stem_name] for stem_name in stems.files}
+
+
+def serve(separator_kwargs, model_filename, host="127.0.0.1", port=8765, socket_path=None, max_models=2, max_batch_size=8, max_latency=0.01, logger=None):
+    """
+    Runs a separation server until interrupted, with model_filename loaded up front and used for requests which don't name a model.
+    """
+    logger = logger or logging.getLogger(__name__)
+    pool = SeparatorPool(separator_kwargs, max_models=max_models, max_batch_size=max_batch_size, max_latency=max_latency, logger=logger)
+    pool.get(model_filename)
+
+    if socket_path is not None:
+        server = UnixSeparationServer(socket_path, pool, model_filename)
+        logger.info(f"Separation server listening on unix socket {socket_path}")
+    else:
+        server = SeparationServer((host, port), pool, model_filename)
+        logger.info(f"Separation server listening on http://{host}:{port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Separation server shutting down...")
+    finally:
+        server.server_close()
@@ -8,7 +8,9 @@ Code to apply a model to a mix. It will handle chunking with overlaps and
 inteprolation between chunks, as well as the "shift trick".
 """
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import random
+import threading
 import typing as tp
 from multiprocessing import Process, Queue, Pipe
 
@@ -25,6 +27,46 @@ Model = tp.Union[Demucs, HDemucs]
 
 progress_bar_num = 0
 
+# Worker pools shared by every apply_model call in the process, keyed by their number of workers
+shared_pools = {}
+shared_pools_lock = threading.Lock()
+
+
+def get_shared_pool(num_workers):
+    """
+    Returns the process-wide ThreadPoolExecutor with `num_workers` threads, creating it on first use.
+    Concurrent separations submit their segments to the same long-lived pool instead of each starting (and leaking) its own.
+    """
+    with shared_pools_lock:
+        pool = shared_pools.get(num_workers)
+        if pool is None:
+            pool = shared_pools[num_workers] = ThreadPoolExecutor(num_workers, thread_name_prefix="demucs_apply")
+        return pool
+
+
+class ApplyProgress:
+    """
+    Progress state of one top-level `apply_model` call, shared with its nested calls (bag of models, shifts, segments).
+    Keeping it per call rather than in module globals lets several separations run concurrently in one process.
+    """
+
+    def __init__(self, set_progress_bar=None, static_shifts=1, bag_num=1):
+        self.set_progress_bar = set_progress_bar
+        self.static_shifts = static_shifts
+        self.bag_num = bag_num
+        self.fut_length = 0
+        self.prog_bar = 0
+        self.lock = threading.Lock()
+
+    def update(self, total_segments, segments_done):
+        if not self.set_progress_bar:
+            return
+
+        with self.lock:
+            self.fut_length = total_segments * self.bag_num * self.static_shifts
+            self.prog_bar += segments_done
+            self.set_progress_bar(0.1, (0.8 / self.fut_length * self.prog_bar))
+
 
 class BagOfModels(nn.Module):
     def __init__(self, models: tp.List[Model], weights: tp.Optional[tp.List[tp.List[float]]] = None, segment: tp.Optional[float] = None):
@@ -122,7 +164,47 @@ def tensor_chunk(tensor_or_chunk):
         return TensorChunk(tensor_or_chunk)
 
 
-def apply_model(model, mix, shifts=1, split=True, overlap=0.25, transition_power=1.0, static_shifts=1, set_progress_bar=None, device=None, progress=False, num_workers=0, pool=None):
+def apply_model_to_chunks(model, chunks, device, autocast_context=None):
+    """
+    Runs the model once over several chunks of the same length, stacked along the batch dimension,
+    and returns the output of each chunk. Each chunk is padded to the model's valid length exactly as a single chunk would be.
+    `autocast_context` is entered around the forward pass, as pool threads don't inherit the caller's thread-local autocast state.
+    """
+    length = chunks[0].shape[-1]
+    assert all(chunk.shape[-1] == length for chunk in chunks), "chunks batched together must have the same length"
+
+    if hasattr(model, "valid_length"):
+        valid_length = model.valid_length(length)
+    else:
+        valid_length = length
+
+    padded_chunks = [tensor_chunk(chunk).padded(valid_length) for chunk in chunks]
+    batch_sizes = [padded_chunk.shape[0] for padded_chunk in padded_chunks]
+    padded_mix = th.cat(padded_chunks).to(device)
+    with th.no_grad(), (autocast_context() if autocast_context is not None else nullcontext()):
+        out = model(padded_mix)
+    return list(center_trim(out, length).split(batch_sizes))
+
+
+def apply_model(
+    model,
+    mix,
+    shifts=1,
+    split=True,
+    overlap=0.25,
+    transition_power=1.0,
+    static_shifts=1,
+    set_progress_bar=None,
+    device=None,
+    progress=False,
+    num_workers=0,
+    pool=None,
+    segment_batch_size=1,
+    batch_shifts=False,
+    shift_seed=None,
+    progress_context=None,
+    autocast_context=None,
+):
     """
     Apply model to a given mixture.
 
@@ -131,19 +213,31 @@ def apply_model(model, mix, shifts=1, split=True, overlap=0.25, transition_power
             and apply the oppositve shift to the output. This is repeated `shifts` time and
             all predictions are averaged. This effectively makes the model time equivariant
             and improves SDR by up to 0.2 points.
+        batch_shifts (bool): if True, the `shifts` shifted copies of the mix are stacked along the batch
+            dimension and separated together, instead of one after the other. Each copy then runs up to
+            the end of the padded mix rather than stopping at the end of the track.
+        shift_seed (int or None): if set, the random shift offsets are drawn from a generator seeded with it
+            (offset by the model index in a bag of models), so repeated runs use the same shifts.
         split (bool): if True, the input will be broken down in 8 seconds extracts
             and predictions will be performed individually on each and concatenated.
             Useful for model with large memory footprint like Tasnet.
         progress (bool): if True, show a progress bar (requires split=True)
+        segment_batch_size (int): with split=True, how many segments are stacked into a single forward pass of the model.
+            Segments are only batched with others of the same length (i.e. all but the last few), so results match
+            running them one at a time.
+        num_workers (int): if > 0 and running on the CPU, segments are processed on a pool with this many threads,
+            shared by all calls in the process. Ignored when `pool` is given.
+        progress_context (ApplyProgress or None): progress state shared by nested calls, created by the top-level call.
+        autocast_context (callable or None): returns the context (e.g. torch.autocast) each forward pass runs in,
+            on the pool threads as well as the calling thread.
         device (torch.device, str, or None): if provided, device on which to
             execute the computation, otherwise `mix.device` is assumed.
             When `device` is different from `mix.device`, only local computations will
             be on `device`, while the entire tracks will be stored on `mix.device`.
     """
 
-    global fut_length
-    global bag_num
-    global prog_bar
+    if progress_context is None:
+        progress_context = ApplyProgress(set_progress_bar, static_shifts)
 
     if device is None:
         device = mix.device
@@ -151,7 +245,7 @@ def apply_model(model, mix, shifts=1, split=True, overlap=0.25, transition_power
         device = th.device(device)
     if pool is None:
         if num_workers > 0 and device.type == "cpu":
-            pool = ThreadPoolExecutor(num_workers)
+            pool = get_shared_pool(num_workers)
         else:
             pool = DummyPoolExecutor()
 
@@ -165,6 +259,11 @@ def apply_model(model, mix, shifts=1, split=True, overlap=0.25, transition_power
         "pool": pool,
         "set_progress_bar": set_progress_bar,
         "static_shifts": static_shifts,
+        "segment_batch_size": segment_batch_size,
+        "batch_shifts": batch_shifts,
+        "shift_seed": shift_seed,
+        "progress_context": progress_context,
+        "autocast_context": autocast_context,
     }
 
     if isinstance(model, BagOfModels):
@@ -174,15 +273,15 @@ def apply_model(model, mix, shifts=1, split=True, overlap=0.25, transition_power
 
         estimates = 0
         totals = [0] * len(model.sources)
-        bag_num = len(model.models)
-        fut_length = 0
-        prog_bar = 0
+        progress_context.bag_num = len(model.models)
         current_model = 0  # (bag_num + 1)
         for sub_model, weight in zip(model.models, model.weights):
             original_model_device = next(iter(sub_model.parameters())).device
             sub_model.to(device)
-            fut_length += fut_length
             current_model += 1
+            if shift_seed is not None:
+                # Each model still gets different shifts, as with the unseeded random shifts
+                kwargs["shift_seed"] = shift_seed + current_model
             out = apply_model(sub_model, mix, **kwargs)
             sub_model.to(original_model_device)
             for k, inst_weight in enumerate(weight):
@@ -205,12 +304,21 @@ def apply_model(model, mix, shifts=1, split=True, overlap=0.25, transition_power
         max_shift = int(0.5 * model.samplerate)
         mix = tensor_chunk(mix)
         padded_mix = mix.padded(length + 2 * max_shift)
+        shift_random = random if shift_seed is None else random.Random(shift_seed)
+        shift_offsets = [shift_random.randint(0, max_shift) for _ in range(shifts)]
         out = 0
-        for _ in range(shifts):
-            offset = random.randint(0, max_shift)
-            shifted = TensorChunk(padded_mix, offset, length + max_shift - offset)
-            shifted_out = apply_model(model, shifted, **kwargs)
-            out += shifted_out[..., max_shift - offset :]
+        if batch_shifts:
+            # All shifted copies share the length of the longest one, so they can be stacked and separated in one go
+            progress_context.static_shifts = 1
+            shifted = th.cat([TensorChunk(padded_mix, offset, length + max_shift).padded(length + max_shift) for offset in shift_offsets])
+            shifted_outs = apply_model(model, shifted, **kwargs).split(batch)
+            for offset, shifted_out in zip(shift_offsets, shifted_outs):
+                out += shifted_out[..., max_shift - offset : max_shift - offset + length]
+        else:
+            for offset in shift_offsets:
+                shifted = TensorChunk(padded_mix, offset, length + max_shift - offset)
+                shifted_out = apply_model(model, shifted, **kwargs)
+                out += shifted_out[..., max_shift - offset :]
         out /= shifts
         return out
     elif split:
@@ -229,36 +337,31 @@ def apply_model(model, mix, shifts=1, split=True, overlap=0.25, transition_power
         # If the overlap < 50%, this will translate to linear transition when
         # transition_power is 1.
         weight = (weight / weight.max()) ** transition_power
-        futures = []
+        # Consecutive segments of the same length are grouped into batches, only the segments at the end of the mix are shorter
+        batches = []
         for offset in offsets:
             chunk = TensorChunk(mix, offset, segment)
-            future = pool.submit(apply_model, model, chunk, **kwargs)
-            futures.append((future, offset))
-            offset += segment
+            if batches and len(batches[-1]) < segment_batch_size and batches[-1][-1][1].length == chunk.length:
+                batches[-1].append((offset, chunk))
+            else:
+                batches.append([(offset, chunk)])
+        futures = []
+        for batch_chunks in batches:
+            future = pool.submit(apply_model_to_chunks, model, [chunk for _, chunk in batch_chunks], device, autocast_context)
+            futures.append((future, [offset for offset, _ in batch_chunks]))
         if progress:
             futures = tqdm.tqdm(futures)
-        for future, offset in futures:
-            if set_progress_bar:
-                fut_length = len(futures) * bag_num * static_shifts
-                prog_bar += 1
-                set_progress_bar(0.1, (0.8 / fut_length * prog_bar))
-            chunk_out = future.result()
-            chunk_length = chunk_out.shape[-1]
-            out[..., offset : offset + segment] += (weight[:chunk_length] * chunk_out).to(mix.device)
-            sum_weight[offset : offset + segment] += weight[:chunk_length].to(mix.device)
+        for future, batch_offsets in futures:
+            progress_context.update(len(offsets), len(batch_offsets))
+            for offset, chunk_out in zip(batch_offsets, future.result()):
+                chunk_length = chunk_out.shape[-1]
+                out[..., offset : offset + segment] += (weight[:chunk_length] * chunk_out).to(mix.device)
+                sum_weight[offset : offset + segment] += weight[:chunk_length].to(mix.device)
         assert sum_weight.min() > 0
         out /= sum_weight
         return out
     else:
-        if hasattr(model, "valid_length"):
-            valid_length = model.valid_length(length)
-        else:
-            valid_length = length
-        mix = tensor_chunk(mix)
-        padded_mix = mix.padded(valid_length).to(device)
-        with th.no_grad():
-            out = model(padded_mix)
-        return center_trim(out, length)
+        return apply_model_to_chunks(model, [tensor_chunk(mix)], device, autocast_context)[0]
 
 
 def demucs_segments(demucs_segment, demucs_model):
@@ -426,6 +426,8 @@ class HTDemucs(nn.Module):
     def _mask(self, z, m):
         # Apply masking given the mixture spectrogram `z` and the estimated mask `m`.
         # If `cac` is True, `m` is actually a full spectrogram and `z` is ignored.
+        # The estimate is cast back to fp32, so masking and the iSTFT stay in full precision under autocast.
+        m = m.float()
         niters = self.wiener_iters
         if self.cac:
             B, S, C, Fr, T = m.shape
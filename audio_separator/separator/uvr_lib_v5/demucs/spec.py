@@ -9,6 +9,7 @@ import torch as th
 
 
 def spectro(x, n_fft=512, hop_length=None, pad=0):
+    x = x.float()
     *other, length = x.shape
     x = x.reshape(-1, length)
 
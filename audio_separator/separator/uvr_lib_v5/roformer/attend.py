@@ -1,3 +1,4 @@
+import time
 from functools import wraps
 from packaging import version
 from collections import namedtuple
@@ -19,6 +20,10 @@ def exists(val):
     return val is not None
 
 
+def default(v, d):
+    return v if exists(v) else d
+
+
 def once(fn):
     called = False
 
@@ -39,17 +44,30 @@ print_once = once(print)
 
 
 class Attend(nn.Module):
-    def __init__(self, dropout=0.0, flash=False):
+    """
+    Attention with a device-aware backend selector.
+
+    backend - None to pick automatically, or force "sdpa" (torch scaled_dot_product_attention) / "einsum" (explicit softmax attention)
+    chunk_size - if set, queries are processed in chunks of this length, so the full similarity matrix is never materialized for long sequences
+    """
+
+    BACKENDS = ("sdpa", "einsum")
+
+    def __init__(self, dropout=0.0, flash=False, scale=None, backend=None, chunk_size=None):
         super().__init__()
         self.dropout = dropout
         self.attn_dropout = nn.Dropout(dropout)
+        self.scale = scale
 
         self.flash = flash
         assert not (flash and version.parse(torch.__version__) < version.parse("2.0.0")), "in order to use flash attention, you must be using pytorch 2.0 or above"
 
-        # determine efficient attention configs for cuda and cpu
+        assert backend is None or backend in self.BACKENDS, f"attention backend must be one of {self.BACKENDS}"
+        self.backend = backend
+        self.chunk_size = chunk_size
+
+        # determine efficient attention configs for cuda
 
-        self.cpu_config = FlashAttentionConfig(True, True, True)
         self.cuda_config = None
 
         if not torch.cuda.is_available() or not flash:
@@ -63,20 +81,63 @@ class Attend(nn.Module):
         else:
             self.cuda_config = FlashAttentionConfig(False, True, True)
 
+    def select_backend(self, q):
+        """
+        Returns the attention backend to use for this query tensor.
+        Off CUDA, scaled_dot_product_attention is always preferred: PyTorch dispatches it to its fused CPU kernel,
+        which avoids materializing the softmax matrix. On CUDA, it is only used when flash attention is enabled.
+        """
+        if exists(self.backend):
+            return self.backend
+
+        has_sdpa = hasattr(F, "scaled_dot_product_attention")
+
+        if has_sdpa and (self.flash or not q.is_cuda):
+            return "sdpa"
+
+        return "einsum"
+
     def flash_attn(self, q, k, v):
         _, heads, q_len, _, k_len, is_cuda, device = *q.shape, k.shape[-2], q.is_cuda, q.device
 
+        sdpa_kwargs = dict(dropout_p=self.dropout if self.training else 0.0)
+        if exists(self.scale):
+            sdpa_kwargs["scale"] = self.scale
+
+        # the sdp_kernel context manager only selects between cuda kernels, so off cuda let pytorch pick the best kernel itself
+
+        if not is_cuda:
+            return F.scaled_dot_product_attention(q, k, v, **sdpa_kwargs)
+
         # Check if there is a compatible device for flash attention
 
-        config = self.cuda_config if is_cuda else self.cpu_config
+        config = default(self.cuda_config, FlashAttentionConfig(False, True, True))
 
         # sdpa_flash kernel only supports float16 on sm80+ architecture gpu
-        if is_cuda and q.dtype != torch.float16:
+        if q.dtype != torch.float16:
             config = FlashAttentionConfig(False, True, True)
 
         # pytorch 2.0 flash attn: q, k, v, mask, dropout, softmax_scale
         with torch.backends.cuda.sdp_kernel(**config._asdict()):
-            out = F.scaled_dot_product_attention(q, k, v, dropout_p=self.dropout if self.training else 0.0)
+            out = F.scaled_dot_product_attention(q, k, v, **sdpa_kwargs)
+
+        return out
+
+    def einsum_attn(self, q, k, v):
+        scale = default(self.scale, q.shape[-1] ** -0.5)
+
+        # similarity
+
+        sim = einsum(f"b h i d, b h j d -> b h i j", q, k) * scale
+
+        # attention
+
+        attn = sim.softmax(dim=-1)
+        attn = self.attn_dropout(attn)
+
+        # aggregate values
+
+        out = einsum(f"b h i j, b h j d -> b h i d", attn, v)
 
         return out
 
@@ -89,24 +150,62 @@ class Attend(nn.Module):
         d - feature dimension
         """
 
-        q_len, k_len, device = q.shape[-2], k.shape[-2], q.device
+        q_len = q.shape[-2]
 
-        scale = q.shape[-1] ** -0.5
+        attn_fn = self.flash_attn if self.select_backend(q) == "sdpa" else self.einsum_attn
 
-        if self.flash:
-            return self.flash_attn(q, k, v)
+        if not exists(self.chunk_size) or q_len <= self.chunk_size:
+            return attn_fn(q, k, v)
 
-        # similarity
+        # memory efficient attention for long sequences - every query chunk still attends to all keys,
+        # so the output is identical, but only a (chunk_size x j) slice of the similarity matrix exists at a time
 
-        sim = einsum(f"b h i d, b h j d -> b h i j", q, k) * scale
+        return torch.cat([attn_fn(q_chunk, k, v) for q_chunk in q.split(self.chunk_size, dim=-2)], dim=-2)
 
-        # attention
 
-        attn = sim.softmax(dim=-1)
-        attn = self.attn_dropout(attn)
+# microbenchmark
 
-        # aggregate values
+# (batch, heads, seq, dim_head) shapes seen in the roformer models for an 8 second chunk at 44.1kHz, hop 441:
+# the time transformer attends over ~801 frames for each of ~60 bands, the frequency transformer over ~60 bands for each frame
 
-        out = einsum(f"b h i j, b h j d -> b h i d", attn, v)
+BENCHMARK_SHAPES = ((60, 8, 801, 64), (801, 8, 60, 64), (62, 8, 1101, 64))
 
-        return out
+
+def benchmark_attention_backends(shapes=BENCHMARK_SHAPES, device="cpu", dtype=torch.float32, chunk_sizes=(None, 256), repeats=10):
+    """
+    Times each attention backend, with and without query chunking, at the given (batch, heads, seq, dim_head) shapes.
+    Returns a list of dicts with the shape, backend, chunk size and mean milliseconds per call.
+    """
+    device = torch.device(device)
+    results = []
+
+    for shape in shapes:
+        q, k, v = (torch.randn(shape, device=device, dtype=dtype) for _ in range(3))
+
+        for backend in Attend.BACKENDS:
+            for chunk_size in chunk_sizes:
+                attend = Attend(backend=backend, chunk_size=chunk_size).eval()
+
+                with torch.no_grad():
+                    # warm up once, so kernel selection and allocation aren't part of the timing
+                    attend(q, k, v)
+
+                    if device.type == "cuda":
+                        torch.cuda.synchronize()
+
+                    start_time = time.perf_counter()
+                    for _ in range(repeats):
+                        attend(q, k, v)
+
+                    if device.type == "cuda":
+                        torch.cuda.synchronize()
+
+                milliseconds = (time.perf_counter() - start_time) * 1000 / repeats
+                results.append(dict(shape=shape, backend=backend, chunk_size=chunk_size, milliseconds=milliseconds))
+
+    return results
+
+
+if __name__ == "__main__":
+    for result in benchmark_attention_backends():
+        print(f"shape={result['shape']} backend={result['backend']:<6} chunk_size={str(result['chunk_size']):<4} {result['milliseconds']:.2f} ms")
@@ -10,7 +10,7 @@ from .attend import Attend
 from beartype.typing import Tuple, Optional, List, Callable
 from beartype import beartype
 
-from rotary_embedding_torch import RotaryEmbedding
+from .rotary import CachedRotaryEmbedding
 
 from einops import rearrange, pack, unpack
 from einops.layers.torch import Rearrange
@@ -341,8 +341,8 @@ class BSRoformer(Module):
 
         transformer_kwargs = dict(dim=dim, heads=heads, dim_head=dim_head, attn_dropout=attn_dropout, ff_dropout=ff_dropout, flash_attn=flash_attn, norm_output=False)
 
-        time_rotary_embed = RotaryEmbedding(dim=dim_head)
-        freq_rotary_embed = RotaryEmbedding(dim=dim_head)
+        time_rotary_embed = CachedRotaryEmbedding(dim=dim_head)
+        freq_rotary_embed = CachedRotaryEmbedding(dim=dim_head)
 
         for _ in range(depth):
             tran_modules = []
@@ -357,6 +357,7 @@ class BSRoformer(Module):
         self.stft_kwargs = dict(n_fft=stft_n_fft, hop_length=stft_hop_length, win_length=stft_win_length, normalized=stft_normalized)
 
         self.stft_window_fn = partial(default(stft_window_fn, torch.hann_window), stft_win_length)
+        self.stft_window_cache = {}
 
         freqs = torch.stft(torch.randn(1, 4096), **self.stft_kwargs, return_complex=True).shape[1]
 
@@ -383,6 +384,13 @@ class BSRoformer(Module):
 
         self.multi_stft_kwargs = dict(hop_length=multi_stft_hop_size, normalized=multi_stft_normalized)
 
+    def get_stft_window(self, device):
+        # The window only depends on the device, so build it once rather than on every chunk
+        stft_window = self.stft_window_cache.get(device)
+        if stft_window is None:
+            stft_window = self.stft_window_cache[device] = self.stft_window_fn().to(device)
+        return stft_window
+
     def forward(self, raw_audio, target=None, return_loss_breakdown=False):
         """
         einops
@@ -416,7 +424,7 @@ class BSRoformer(Module):
 
         raw_audio, batch_audio_channel_packed_shape = pack_one(raw_audio, "* t")
 
-        stft_window = self.stft_window_fn().to(device)
+        stft_window = self.get_stft_window(device)
 
         stft_repr = torch.stft(raw_audio, **self.stft_kwargs, window=stft_window, return_complex=True)
         stft_repr = torch.view_as_real(stft_repr)
@@ -468,8 +476,9 @@ class BSRoformer(Module):
 
         # complex number multiplication
 
+        # the mask is cast back to fp32 so the complex multiplication and istft stay in full precision under autocast
         stft_repr = torch.view_as_complex(stft_repr)
-        mask = torch.view_as_complex(mask)
+        mask = torch.view_as_complex(mask.float())
 
         stft_repr = stft_repr * mask
 
@@ -477,7 +486,7 @@ class BSRoformer(Module):
 
         stft_repr = rearrange(stft_repr, "b n (f s) t -> (b n s) f t", s=self.audio_channels)
 
-        recon_audio = torch.istft(stft_repr.cpu() if x_is_mps else stft_repr, **self.stft_kwargs, window=stft_window.cpu() if x_is_mps else stft_window, return_complex=False).to(device)
+        recon_audio = torch.istft(stft_repr.cpu() if x_is_mps else stft_repr, **self.stft_kwargs, window=self.get_stft_window(torch.device("cpu")) if x_is_mps else stft_window, return_complex=False).to(device)
 
         recon_audio = rearrange(recon_audio, "(b n s) t -> b n s t", s=self.audio_channels, n=self.num_stems)
 
@@ -10,7 +10,7 @@ from .attend import Attend
 from beartype.typing import Tuple, Optional, List, Callable
 from beartype import beartype
 
-from rotary_embedding_torch import RotaryEmbedding
+from .rotary import CachedRotaryEmbedding
 
 from einops import rearrange, pack, unpack, reduce, repeat
 
@@ -231,8 +231,8 @@ class MelBandRoformer(Module):
 
         transformer_kwargs = dict(dim=dim, heads=heads, dim_head=dim_head, attn_dropout=attn_dropout, ff_dropout=ff_dropout, flash_attn=flash_attn)
 
-        time_rotary_embed = RotaryEmbedding(dim=dim_head)
-        freq_rotary_embed = RotaryEmbedding(dim=dim_head)
+        time_rotary_embed = CachedRotaryEmbedding(dim=dim_head)
+        freq_rotary_embed = CachedRotaryEmbedding(dim=dim_head)
 
         for _ in range(depth):
             self.layers.append(
@@ -245,6 +245,8 @@ class MelBandRoformer(Module):
             )
 
         self.stft_window_fn = partial(default(stft_window_fn, torch.hann_window), stft_win_length)
+        self.stft_window_cache = {}
+        self.band_buffer_cache = {}
 
         self.stft_kwargs = dict(n_fft=stft_n_fft, hop_length=stft_hop_length, win_length=stft_win_length, normalized=stft_normalized)
 
@@ -298,6 +300,33 @@ class MelBandRoformer(Module):
 
         self.match_input_audio_length = match_input_audio_length
 
+    def get_stft_window(self, device):
+        # The window only depends on the device, so build it once rather than on every chunk
+        stft_window = self.stft_window_cache.get(device)
+        if stft_window is None:
+            stft_window = self.stft_window_cache[device] = self.stft_window_fn().to(device)
+        return stft_window
+
+    def get_band_buffers(self, batch, channels, frames, device):
+        """
+        Returns the band frequency indices, the scatter indices and the clamped band-count denominator used to average the band masks.
+        These only depend on the chunk shape and device, so they are cached instead of rebuilt on every forward pass.
+        """
+        key = (batch, channels, frames, device)
+        band_buffers = self.band_buffer_cache.get(key)
+
+        if band_buffers is None:
+            freq_indices = self.freq_indices.to(device)
+            scatter_indices = repeat(freq_indices, "f -> b n f t", b=batch, n=self.num_stems, t=frames)
+            denom = repeat(self.num_bands_per_freq.to(device), "f -> (f r) 1", r=channels).clamp(min=1e-8)
+
+            # Chunked separation only ever sees one or two shapes, anything more is not worth holding on to
+            if len(self.band_buffer_cache) >= 8:
+                self.band_buffer_cache.clear()
+            band_buffers = self.band_buffer_cache[key] = (freq_indices, scatter_indices, denom)
+
+        return band_buffers
+
     def forward(self, raw_audio, target=None, return_loss_breakdown=False):
         """
         einops
@@ -332,7 +361,7 @@ class MelBandRoformer(Module):
 
         raw_audio, batch_audio_channel_packed_shape = pack_one(raw_audio, "* t")
 
-        stft_window = self.stft_window_fn().to(device)
+        stft_window = self.get_stft_window(device)
 
         stft_repr = torch.stft(raw_audio, **self.stft_kwargs, window=stft_window, return_complex=True)
         stft_repr = torch.view_as_real(stft_repr)
@@ -342,7 +371,10 @@ class MelBandRoformer(Module):
 
         batch_arange = torch.arange(batch, device=device)[..., None]
 
-        x = stft_repr[batch_arange, self.freq_indices.cpu()] if x_is_mps else stft_repr[batch_arange, self.freq_indices]
+        # device is already the cpu for mps input, so the cached buffers live where the stft does
+        freq_indices, scatter_indices, denom = self.get_band_buffers(batch, channels, stft_repr.shape[-2], device)
+
+        x = stft_repr[batch_arange, freq_indices]
 
         x = rearrange(x, "b f t c -> b t (f c)")
 
@@ -370,16 +402,12 @@ class MelBandRoformer(Module):
 
         stft_repr = rearrange(stft_repr, "b f t c -> b 1 f t c")
 
+        # the masks are cast back to fp32 so the complex multiplication and istft stay in full precision under autocast
         stft_repr = torch.view_as_complex(stft_repr)
-        masks = torch.view_as_complex(masks)
+        masks = torch.view_as_complex(masks.float())
 
         masks = masks.type(stft_repr.dtype)
 
-        if x_is_mps:
-            scatter_indices = repeat(self.freq_indices.cpu(), "f -> b n f t", b=batch, n=self.num_stems, t=stft_repr.shape[-1])
-        else:
-            scatter_indices = repeat(self.freq_indices, "f -> b n f t", b=batch, n=self.num_stems, t=stft_repr.shape[-1])
-
         stft_repr_expanded_stems = repeat(stft_repr, "b 1 ... -> b n ...", n=self.num_stems)
         masks_summed = (
             torch.zeros_like(stft_repr_expanded_stems.cpu() if x_is_mps else stft_repr_expanded_stems)
@@ -387,12 +415,7 @@ class MelBandRoformer(Module):
             .to(device)
         )
 
-        denom = repeat(self.num_bands_per_freq, "f -> (f r) 1", r=channels)
-
-        if x_is_mps:
-            denom = denom.cpu()
-
-        masks_averaged = masks_summed / denom.clamp(min=1e-8)
+        masks_averaged = masks_summed / denom
 
         stft_repr = stft_repr * masks_averaged
 
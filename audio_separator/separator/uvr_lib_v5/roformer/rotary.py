@@ -0,0 +1,52 @@
+import torch
+from rotary_embedding_torch import RotaryEmbedding
+from rotary_embedding_torch.rotary_embedding_torch import rotate_half
+
+
+class CachedRotaryEmbedding(RotaryEmbedding):
+    """
+    RotaryEmbedding which keeps the cos / sin tables per (seq_len, device, dtype).
+
+    The stock rotate_queries_or_keys recomputes freqs.cos() and freqs.sin() for every query and key of every layer,
+    although separation feeds the same chunk length through the model over and over.
+    The parameters and state_dict keys are unchanged, so existing checkpoints load as before.
+    """
+
+    MAX_CACHED_SHAPES = 16
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cos_sin_cache = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        # Moving or casting the module invalidates tables computed from the old freqs
+        self.cos_sin_cache = {}
+        return super()._apply(fn, *args, **kwargs)
+
+    def get_cos_sin(self, seq_len, device, dtype):
+        key = (seq_len, device, dtype)
+        cos_sin = self.cos_sin_cache.get(key)
+
+        if cos_sin is None:
+            freqs = self.forward(self.get_seq_pos(seq_len, device=device, dtype=dtype), seq_len=seq_len)
+            cos_sin = (freqs.cos(), freqs.sin())
+
+            if len(self.cos_sin_cache) >= self.MAX_CACHED_SHAPES:
+                self.cos_sin_cache.clear()
+            self.cos_sin_cache[key] = cos_sin
+
+        return cos_sin
+
+    def rotate_queries_or_keys(self, t, seq_dim=None, offset=0):
+        seq_dim = self.default_seq_dim if seq_dim is None else seq_dim
+
+        # Only the plain (b, h, n, d) layout used by the roformers is served from the cache
+        if offset != 0 or seq_dim != -2 or t.ndim != 4 or self.use_xpos or self.learned_freq:
+            return super().rotate_queries_or_keys(t, seq_dim=seq_dim, offset=offset)
+
+        cos, sin = self.get_cos_sin(t.shape[seq_dim], t.device, t.dtype)
+        rot_dim = cos.shape[-1]
+
+        t_rot, t_pass = t[..., :rot_dim], t[..., rot_dim:]
+        t_rot = (t_rot * cos) + (rotate_half(t_rot) * sin)
+        return torch.cat((t_rot, t_pass), dim=-1)
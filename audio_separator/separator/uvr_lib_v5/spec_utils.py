@@ -8,6 +8,7 @@ import traceback
 from audio_separator.separator.uvr_lib_v5 import pyrb
 from scipy.signal import correlate, hilbert
 import io
+from concurrent.futures import ThreadPoolExecutor
 
 OPERATING_SYSTEM = platform.system()
 SYSTEM_ARCH = platform.platform()
@@ -46,6 +47,11 @@ MIN_WAV = MIN_SPEC
 
 AVERAGE = "Average"
 
+# Spectrograms and waveforms are kept in single precision end to end, as the models only ever see float32 input anyway.
+# Double precision arrays would just double the memory traffic of the (large) full-length spectrograms.
+SPEC_DTYPE = np.complex64
+WAVE_DTYPE = np.float32
+
 
 def crop_center(h1, h2):
     """
@@ -76,6 +82,7 @@ def preprocess(X_spec):
     This function preprocesses a spectrogram by separating it into magnitude and phase components.
     This is a common preprocessing step in audio processing tasks.
     """
+    X_spec = np.asarray(X_spec).astype(SPEC_DTYPE, copy=False)
     X_mag = np.abs(X_spec)
     X_phase = np.angle(X_spec)
 
@@ -113,6 +120,26 @@ def normalize(wave, max_peak=1.0):
     return wave
 
 
+def calculate_sdr(reference, estimate, eps=1e-10):
+    """Calculate the signal-to-distortion ratio of an estimate against a reference signal.
+
+    Args:
+        reference (array-like): Reference signal.
+        estimate (array-like): Estimated signal, with the same shape as the reference.
+        eps (float): Small constant to avoid division by zero and log of zero.
+
+    Returns:
+        float: SDR in decibels.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    estimate = np.asarray(estimate, dtype=np.float64)
+
+    signal_energy = np.sum(reference**2)
+    distortion_energy = np.sum((reference - estimate) ** 2)
+
+    return float(10 * np.log10((signal_energy + eps) / (distortion_energy + eps)))
+
+
 def auto_transpose(audio_array: np.ndarray):
     """
     Ensure that the audio array is in the (channels, samples) format.
@@ -175,38 +202,49 @@ def reduce_vocal_aggressively(X, y, softmask):
     return y_mag * np.exp(1.0j * np.angle(y))
 
 
+def artifact_weight(frame_min, thres=0.01, min_range=64, fade_size=32, dtype=np.float32):
+    """
+    Computes the per-frame weight merge_artifacts blends the mask towards 1 with, from the minimum of the mask in each frame.
+    The weight is the same for every channel and bin of a frame, so it is kept as a single vector over the frames.
+    """
+    if min_range < fade_size * 2:
+        raise ValueError("min_range must be >= fade_size * 2")
+
+    n_frames = len(frame_min)
+    idx = np.where(frame_min > thres)[0]
+    start_idx = np.insert(idx[np.where(np.diff(idx) != 1)[0] + 1], 0, idx[0])
+    end_idx = np.append(idx[np.where(np.diff(idx) != 1)[0]], idx[-1])
+    artifact_idx = np.where(end_idx - start_idx > min_range)[0]
+    weight = np.zeros(n_frames, dtype=dtype)
+    if len(artifact_idx) > 0:
+        start_idx = start_idx[artifact_idx]
+        end_idx = end_idx[artifact_idx]
+        old_e = None
+        for s, e in zip(start_idx, end_idx):
+            if old_e is not None and s - old_e < fade_size:
+                s = old_e - fade_size * 2
+
+            if s != 0:
+                weight[s : s + fade_size] = np.linspace(0, 1, fade_size)
+            else:
+                s -= fade_size
+
+            if e != n_frames:
+                weight[e - fade_size : e] = np.linspace(1, 0, fade_size)
+            else:
+                e += fade_size
+
+            weight[s + fade_size : e - fade_size] = 1
+            old_e = e
+
+    return weight
+
+
 def merge_artifacts(y_mask, thres=0.01, min_range=64, fade_size=32):
     mask = y_mask
 
     try:
-        if min_range < fade_size * 2:
-            raise ValueError("min_range must be >= fade_size * 2")
-
-        idx = np.where(y_mask.min(axis=(0, 1)) > thres)[0]
-        start_idx = np.insert(idx[np.where(np.diff(idx) != 1)[0] + 1], 0, idx[0])
-        end_idx = np.append(idx[np.where(np.diff(idx) != 1)[0]], idx[-1])
-        artifact_idx = np.where(end_idx - start_idx > min_range)[0]
-        weight = np.zeros_like(y_mask)
-        if len(artifact_idx) > 0:
-            start_idx = start_idx[artifact_idx]
-            end_idx = end_idx[artifact_idx]
-            old_e = None
-            for s, e in zip(start_idx, end_idx):
-                if old_e is not None and s - old_e < fade_size:
-                    s = old_e - fade_size * 2
-
-                if s != 0:
-                    weight[:, :, s : s + fade_size] = np.linspace(0, 1, fade_size)
-                else:
-                    s -= fade_size
-
-                if e != y_mask.shape[2]:
-                    weight[:, :, e - fade_size : e] = np.linspace(1, 0, fade_size)
-                else:
-                    e += fade_size
-
-                weight[:, :, s + fade_size : e - fade_size] = 1
-                old_e = e
+        weight = artifact_weight(y_mask.min(axis=(0, 1)), thres, min_range, fade_size, dtype=y_mask.dtype)
 
         v_mask = 1 - y_mask
         y_mask += weight * v_mask
@@ -247,7 +285,7 @@ def convert_channels(spec, mp, band):
 
 def combine_spectrograms(specs, mp, is_v51_model=False):
     l = min([specs[i].shape[2] for i in specs])
-    spec_c = np.zeros(shape=(2, mp.param["bins"] + 1, l), dtype=np.complex64)
+    spec_c = np.zeros(shape=(2, mp.param["bins"] + 1, l), dtype=SPEC_DTYPE)
     offset = 0
     bands_n = len(mp.param["band"])
 
@@ -299,10 +337,8 @@ def wave_to_spectrogram(wave, hop_length, n_fft, mp, band, is_v51_model=False):
         wave_left = np.asfortranarray(wave[0])
         wave_right = np.asfortranarray(wave[1])
 
-    spec_left = librosa.stft(wave_left, n_fft=n_fft, hop_length=hop_length)
-    spec_right = librosa.stft(wave_right, n_fft=n_fft, hop_length=hop_length)
-
-    spec = np.asfortranarray([spec_left, spec_right])
+    # Both channels go through a single multichannel STFT, which frames and transforms them together
+    spec = np.asfortranarray(librosa.stft(np.stack([wave_left, wave_right]), n_fft=n_fft, hop_length=hop_length))
 
     if is_v51_model:
         spec = convert_channels(spec, mp, band)
@@ -311,11 +347,8 @@ def wave_to_spectrogram(wave, hop_length, n_fft, mp, band, is_v51_model=False):
 
 
 def spectrogram_to_wave(spec, hop_length=1024, mp={}, band=0, is_v51_model=True):
-    spec_left = np.asfortranarray(spec[0])
-    spec_right = np.asfortranarray(spec[1])
-
-    wave_left = librosa.istft(spec_left, hop_length=hop_length)
-    wave_right = librosa.istft(spec_right, hop_length=hop_length)
+    # Both channels go through a single multichannel ISTFT
+    wave_left, wave_right = librosa.istft(np.ascontiguousarray(spec[:2]), hop_length=hop_length)
 
     if is_v51_model:
         cc = mp.param["band"][band].get("convert_channels")
@@ -336,13 +369,30 @@ def spectrogram_to_wave(spec, hop_length=1024, mp={}, band=0, is_v51_model=True)
     return np.asfortranarray([wave_left, wave_right])
 
 
-def cmb_spectrogram_to_wave(spec_m, mp, extra_bins_h=None, extra_bins=None, is_v51_model=False):
+def run_threaded(function, items, max_workers=None):
+    """
+    Applies function to each item on a thread pool and returns the results in order.
+    The STFT, ISTFT and resampling work per band is mostly NumPy / SciPy code which releases the GIL, so bands overlap well in threads.
+    A max_workers of 1 (or a single item) runs everything in the calling thread.
+    """
+    items = list(items)
+
+    if max_workers == 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(items)) as executor:
+        return list(executor.map(function, items))
+
+
+def cmb_spectrogram_to_wave(spec_m, mp, extra_bins_h=None, extra_bins=None, is_v51_model=False, res_type=None, max_workers=None):
     bands_n = len(mp.param["band"])
+    res_type = res_type or wav_resolution
     offset = 0
+    band_specs = {}
 
     for d in range(1, bands_n + 1):
         bp = mp.param["band"][d]
-        spec_s = np.zeros(shape=(2, bp["n_fft"] // 2 + 1, spec_m.shape[2]), dtype=complex)
+        spec_s = np.zeros(shape=(2, bp["n_fft"] // 2 + 1, spec_m.shape[2]), dtype=SPEC_DTYPE)
         h = bp["crop_stop"] - bp["crop_start"]
         spec_s[:, bp["crop_start"] : bp["crop_stop"], :] = spec_m[:, offset : offset + h, :]
 
@@ -356,39 +406,51 @@ def cmb_spectrogram_to_wave(spec_m, mp, extra_bins_h=None, extra_bins=None, is_v
                     spec_s *= get_hp_filter_mask(spec_s.shape[1], bp["hpf_start"], bp["hpf_stop"] - 1)
                 else:
                     spec_s = fft_hp_filter(spec_s, bp["hpf_start"], bp["hpf_stop"] - 1)
+        elif d == 1:  # lower
+            if is_v51_model:
+                spec_s *= get_lp_filter_mask(spec_s.shape[1], bp["lpf_start"], bp["lpf_stop"])
+            else:
+                spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
+        else:  # mid
+            if is_v51_model:
+                spec_s *= get_hp_filter_mask(spec_s.shape[1], bp["hpf_start"], bp["hpf_stop"] - 1)
+                spec_s *= get_lp_filter_mask(spec_s.shape[1], bp["lpf_start"], bp["lpf_stop"])
+            else:
+                spec_s = fft_hp_filter(spec_s, bp["hpf_start"], bp["hpf_stop"] - 1)
+                spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
+
+        band_specs[d] = spec_s
+
+    # The ISTFT of a band doesn't depend on any other band, so the bands are inverted concurrently.
+    # Only the resample and sum chain from the lowest band upwards has to run in order.
+    band_waves = run_threaded(lambda d: spectrogram_to_wave(band_specs[d], mp.param["band"][d]["hl"], mp, d, is_v51_model), range(1, bands_n + 1), max_workers)
+
+    for d in range(1, bands_n + 1):
+        bp = mp.param["band"][d]
+        band_wave = band_waves[d - 1]
+
+        if d == bands_n:  # higher
             if bands_n == 1:
-                wave = spectrogram_to_wave(spec_s, bp["hl"], mp, d, is_v51_model)
+                wave = band_wave
             else:
-                wave = np.add(wave, spectrogram_to_wave(spec_s, bp["hl"], mp, d, is_v51_model))
+                wave = np.add(wave, band_wave)
         else:
             sr = mp.param["band"][d + 1]["sr"]
             if d == 1:  # lower
-                if is_v51_model:
-                    spec_s *= get_lp_filter_mask(spec_s.shape[1], bp["lpf_start"], bp["lpf_stop"])
-                else:
-                    spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
-
                 try:
-                    wave = librosa.resample(spectrogram_to_wave(spec_s, bp["hl"], mp, d, is_v51_model), orig_sr=bp["sr"], target_sr=sr, res_type=wav_resolution)
+                    wave = librosa.resample(band_wave, orig_sr=bp["sr"], target_sr=sr, res_type=res_type)
                 except ValueError as e:
                     print(f"Error during resampling: {e}")
-                    print(f"Spec_s shape: {spec_s.shape}, SR: {sr}, Res type: {wav_resolution}")
+                    print(f"Spec_s shape: {band_specs[d].shape}, SR: {sr}, Res type: {res_type}")
 
             else:  # mid
-                if is_v51_model:
-                    spec_s *= get_hp_filter_mask(spec_s.shape[1], bp["hpf_start"], bp["hpf_stop"] - 1)
-                    spec_s *= get_lp_filter_mask(spec_s.shape[1], bp["lpf_start"], bp["lpf_stop"])
-                else:
-                    spec_s = fft_hp_filter(spec_s, bp["hpf_start"], bp["hpf_stop"] - 1)
-                    spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
-
-                wave2 = np.add(wave, spectrogram_to_wave(spec_s, bp["hl"], mp, d, is_v51_model))
+                wave2 = np.add(wave, band_wave)
 
                 try:
-                    wave = librosa.resample(wave2, orig_sr=bp["sr"], target_sr=sr, res_type=wav_resolution)
+                    wave = librosa.resample(wave2, orig_sr=bp["sr"], target_sr=sr, res_type=res_type)
                 except ValueError as e:
                     print(f"Error during resampling: {e}")
-                    print(f"Spec_s shape: {spec_s.shape}, SR: {sr}, Res type: {wav_resolution}")
+                    print(f"Spec_s shape: {band_specs[d].shape}, SR: {sr}, Res type: {res_type}")
 
     return wave
 
@@ -467,22 +529,34 @@ def mirroring(a, spec_m, input_high_end, mp):
         return np.where(np.abs(input_high_end) <= np.abs(mi), input_high_end, mi)
 
 
-def adjust_aggr(mask, is_non_accom_stem, aggressiveness):
+def aggr_exponents(is_non_accom_stem, aggressiveness):
+    """
+    Returns the per-channel aggressiveness adjust_aggr raises the mask to, or None when the aggressiveness is 0.
+    """
     aggr = aggressiveness["value"] * 2
 
-    if aggr != 0:
-        if is_non_accom_stem:
-            aggr = 1 - aggr
+    if aggr == 0:
+        return None
+
+    if is_non_accom_stem:
+        aggr = 1 - aggr
+
+    if np.any(aggr > 10) or np.any(aggr < -10):
+        print(f"Warning: Extreme aggressiveness values detected: {aggr}")
 
-        if np.any(aggr > 10) or np.any(aggr < -10):
-            print(f"Warning: Extreme aggressiveness values detected: {aggr}")
+    aggr = [aggr, aggr]
 
-        aggr = [aggr, aggr]
+    if aggressiveness["aggr_correction"] is not None:
+        aggr[0] += aggressiveness["aggr_correction"]["left"]
+        aggr[1] += aggressiveness["aggr_correction"]["right"]
 
-        if aggressiveness["aggr_correction"] is not None:
-            aggr[0] += aggressiveness["aggr_correction"]["left"]
-            aggr[1] += aggressiveness["aggr_correction"]["right"]
+    return aggr
 
+
+def adjust_aggr(mask, is_non_accom_stem, aggressiveness):
+    aggr = aggr_exponents(is_non_accom_stem, aggressiveness)
+
+    if aggr is not None:
         for ch in range(2):
             mask[ch, : aggressiveness["split_bin"]] = np.power(mask[ch, : aggressiveness["split_bin"]], 1 + aggr[ch] / 3)
             mask[ch, aggressiveness["split_bin"] :] = np.power(mask[ch, aggressiveness["split_bin"] :], 1 + aggr[ch])
@@ -490,6 +564,56 @@ def adjust_aggr(mask, is_non_accom_stem, aggressiveness):
     return mask
 
 
+def apply_mask_chunked(mask, X_mag, X_phase, is_non_accom_stem, aggressiveness, post_process_threshold=None, chunk_frames=1024):
+    """
+    Fused equivalent of adjust_aggr, merge_artifacts (when post_process_threshold is set) and splitting X into both stem spectrograms,
+    i.e. mask * X_mag * exp(1j * X_phase) and (1 - mask) * X_mag * exp(1j * X_phase).
+
+    The mask is modified in place, and everything is processed chunk_frames frames at a time. This way no full-size temporaries
+    (power copies, the artifact weight, 1 - mask or the phase term) are allocated, only the two output spectrograms.
+    The outputs match the unfused functions exactly, as every element goes through the same operations in the same order.
+    """
+    n_frames = mask.shape[2]
+    split_bin = aggressiveness["split_bin"]
+    aggr = aggr_exponents(is_non_accom_stem, aggressiveness)
+    chunks = [slice(start, min(start + chunk_frames, n_frames)) for start in range(0, n_frames, chunk_frames)]
+
+    # First pass: aggressiveness, plus the per-frame minimum merge_artifacts needs from the adjusted mask
+    frame_min = np.empty(n_frames, dtype=mask.dtype) if post_process_threshold is not None else None
+    for chunk in chunks:
+        mask_chunk = mask[:, :, chunk]
+        if aggr is not None:
+            for ch in range(2):
+                np.power(mask_chunk[ch, :split_bin], 1 + aggr[ch] / 3, out=mask_chunk[ch, :split_bin])
+                np.power(mask_chunk[ch, split_bin:], 1 + aggr[ch], out=mask_chunk[ch, split_bin:])
+        if frame_min is not None:
+            frame_min[chunk] = mask_chunk.min(axis=(0, 1))
+
+    weight = None
+    if frame_min is not None:
+        try:
+            weight = artifact_weight(frame_min, thres=post_process_threshold, dtype=mask.dtype)
+        except Exception as e:
+            error_name = f"{type(e).__name__}"
+            traceback_text = "".join(traceback.format_tb(e.__traceback__))
+            message = f'{error_name}: "{e}"\n{traceback_text}"'
+            print("Post Process Failed: ", message)
+
+    # Second pass: artifact merging and both stem spectrograms
+    y_spec = np.empty(mask.shape, dtype=SPEC_DTYPE)
+    v_spec = np.empty(mask.shape, dtype=SPEC_DTYPE)
+    for chunk in chunks:
+        mask_chunk = mask[:, :, chunk]
+        if weight is not None:
+            mask_chunk += weight[chunk] * (1 - mask_chunk)
+
+        X_phase_exp = np.exp(1.0j * X_phase[:, :, chunk]).astype(SPEC_DTYPE, copy=False)
+        np.multiply(mask_chunk * X_mag[:, :, chunk], X_phase_exp, out=y_spec[:, :, chunk])
+        np.multiply((1 - mask_chunk) * X_mag[:, :, chunk], X_phase_exp, out=v_spec[:, :, chunk])
+
+    return y_spec, v_spec
+
+
 def stft(wave, nfft, hl):
     wave_left = np.asfortranarray(wave[0])
     wave_right = np.asfortranarray(wave[1])
@@ -30,7 +30,9 @@ class STFT:
         return x[..., :self.dim_f, :]
 
     def inverse(self, x):
-        
+        # The ISTFT is kept in fp32, even when the network ran under reduced precision autocast
+        x = x.float()
+
         x_is_mps = not x.device.type in ["cuda", "cpu"]
         if x_is_mps:
             x = x.cpu()
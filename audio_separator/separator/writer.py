@@ -0,0 +1,86 @@
+""" Background encoding and writing of separated stems, overlapping with the separation of the next file. """
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import threading
+
+
+class StemWriterPool:
+    """
+    Writes stems on worker threads, so normalizing, encoding and ffmpeg run while the next file is being separated.
+
+    At most max_pending stems are queued or being written at once, submitting another one blocks until a write finishes,
+    which bounds the memory held by finished stems. Write failures are kept by stem path and only raised by wait() /
+    raise_errors() for those paths, so the request which wrote a stem (via Separator.wait_for_writes) gets its own failures
+    and never another request's.
+    """
+
+    def __init__(self, num_workers=2, max_pending=4, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="stem_writer")
+        self.slots = threading.BoundedSemaphore(max(max_pending, num_workers))
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.errors = {}
+        self.closed = False
+
+    def submit(self, stem_path, write_function, *args):
+        """
+        Queues write_function(*args) to write the stem at stem_path, blocking while max_pending writes are outstanding.
+        """
+        if self.closed:
+            # A request still running on a separator evicted from a SeparatorPool writes its remaining stems itself
+            write_function(*args)
+            return None
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(write_function, *args)
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.pending[future] = stem_path
+        future.add_done_callback(self.write_done)
+        return future
+
+    def write_done(self, future):
+        with self.lock:
+            stem_path = self.pending.pop(future, None)
+            if not future.cancelled() and future.exception() is not None:
+                self.errors[stem_path] = future.exception()
+        self.slots.release()
+
+    def raise_errors(self, stem_paths=None):
+        """
+        Raises the first write failure of the given stems (or of all stems), logging any others.
+        """
+        with self.lock:
+            failed_stem_paths = [stem_path for stem_path in self.errors if stem_paths is None or stem_path in stem_paths]
+            errors = [(stem_path, self.errors.pop(stem_path)) for stem_path in failed_stem_paths]
+
+        if not errors:
+            return
+
+        for stem_path, error in errors[1:]:
+            self.logger.error(f"Failed to write stem {stem_path}: {error}")
+
+        stem_path, error = errors[0]
+        raise RuntimeError(f"Failed to write stem {stem_path}: {error}") from error
+
+    def wait(self, stem_paths=None):
+        """
+        Waits until the given stems (or all queued stems) are written, then raises any write failure.
+        """
+        with self.lock:
+            futures = [future for future, stem_path in self.pending.items() if stem_paths is None or stem_path in stem_paths]
+
+        wait(futures)
+        self.raise_errors(stem_paths)
+
+    def shutdown(self):
+        self.closed = True
+        self.executor.shutdown(wait=True)
+        self.raise_errors()
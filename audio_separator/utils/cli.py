@@ -1,10 +1,90 @@
 #!/usr/bin/env python
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import glob
 import logging
 import json
+import os
 import sys
+import time
 from importlib import metadata
 
+AUDIO_FILE_EXTENSIONS = {".wav", ".flac", ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".wma", ".aiff", ".aif", ".mka", ".mp4", ".webm"}
+
+
+def expand_audio_inputs(inputs, input_list=None):
+    """
+    Expands the audio inputs given on the command line into a list of audio file paths.
+    Each input can be a file, a directory (its audio files are used) or a glob pattern (** matches subdirectories),
+    and input_list can name a text file with one such input per line. Duplicate files are only separated once.
+    """
+    inputs = list(inputs)
+    if input_list is not None:
+        with open(input_list, "r", encoding="utf-8") as f:
+            inputs.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+
+    audio_files = []
+    for audio_input in inputs:
+        if os.path.isdir(audio_input):
+            audio_files.extend(sorted(os.path.join(audio_input, name) for name in os.listdir(audio_input) if os.path.splitext(name)[1].lower() in AUDIO_FILE_EXTENSIONS))
+        elif os.path.isfile(audio_input):
+            audio_files.append(audio_input)
+        else:
+            audio_files.extend(sorted(path for path in glob.glob(audio_input, recursive=True) if os.path.isfile(path)))
+
+    return list(dict.fromkeys(audio_files))
+
+
+def separate_audio_files(separator, audio_files, num_workers, logger, prefetch=2):
+    """
+    Separates the audio files with the loaded model, num_workers files at a time so one file's decoding and encoding
+    overlap with another's inference, and returns a summary with the timing of each file and the overall throughput.
+    With a single worker the next `prefetch` files are decoded in the background instead.
+    """
+
+    def separate_audio_file(audio_file, prefetched_audio=None):
+        start_time = time.perf_counter()
+        try:
+            output_files, sources = separator.separate(audio_file, return_sources=True, prefetched_audio=prefetched_audio)
+        except Exception as e:
+            logger.error(f"Separation of {audio_file} failed: {e}")
+            return {"audio_file": audio_file, "status": "failed", "error": str(e), "seconds": time.perf_counter() - start_time}
+
+        seconds = time.perf_counter() - start_time
+        audio_seconds = max((len(source) for source in sources.values()), default=0) / separator.sample_rate
+        logger.info(f"Separated {audio_file} in {seconds:.2f} seconds, output file(s): {' '.join(output_files)}")
+        return {"audio_file": audio_file, "status": "ok", "output_files": output_files, "seconds": seconds, "audio_seconds": audio_seconds}
+
+    batch_start_time = time.perf_counter()
+    if num_workers > 1 and len(audio_files) > 1:
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="separate") as executor:
+            results = list(executor.map(separate_audio_file, audio_files))
+    else:
+        results = [separate_audio_file(audio_file, audio) for audio_file, audio in separator.prefetch_audio(audio_files, prefetch=prefetch)]
+
+    # Stems written in the background are part of the batch's time, and a file only succeeded once its own stems are written
+    for result in results:
+        if result["status"] != "ok":
+            continue
+        try:
+            separator.wait_for_writes(result["output_files"])
+        except Exception as e:
+            logger.error(f"Writing the stems of {result['audio_file']} failed: {e}")
+            result.update({"status": "failed", "error": str(e)})
+    total_seconds = time.perf_counter() - batch_start_time
+
+    audio_seconds = sum(result.get("audio_seconds", 0) for result in results)
+    return {
+        "model_filename": separator.model_friendly_name,
+        "files": results,
+        "succeeded": sum(result["status"] == "ok" for result in results),
+        "failed": sum(result["status"] != "ok" for result in results),
+        "total_seconds": total_seconds,
+        "audio_seconds": audio_seconds,
+        "files_per_second": len(results) / total_seconds if total_seconds > 0 else 0.0,
+        "realtime_factor": audio_seconds / total_seconds if total_seconds > 0 else 0.0,
+    }
+
 
 def main():
     """Main entry point for the CLI."""
@@ -17,7 +97,7 @@ def main():
 
     parser = argparse.ArgumentParser(description="Separate audio file into different stems.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
 
-    parser.add_argument("audio_file", nargs="?", help="The audio file path to separate, in any common format.", default=argparse.SUPPRESS)
+    parser.add_argument("audio_files", nargs="*", help="The audio file paths, directories or glob patterns to separate, in any common format.")
 
     package_version = metadata.distribution("audio-separator").version
 
@@ -49,22 +129,49 @@ def main():
     io_params.add_argument("--model_file_dir", default="/tmp/audio-separator-models/", help=model_file_dir_help)
     io_params.add_argument("--download_model_only", action="store_true", help=download_model_only_help)
 
+    input_list_help = "text file listing audio files, directories or glob patterns to separate, one per line. Example: --input_list=files.txt"
+    batch_workers_help = "number of files separated at once, so decoding and encoding overlap with inference (default: %(default)s). Example: --batch_workers=2"
+    prefetch_help = "number of upcoming files decoded in the background while separating one at a time (default: %(default)s). Example: --prefetch=4"
+    write_workers_help = "threads encoding and writing stems in the background while the next file is separated, 0 = none (default: %(default)s). Example: --write_workers=4"
+    write_queue_size_help = "maximum number of stems waiting to be written before separation pauses (default: %(default)s). Example: --write_queue_size=8"
+    batch_summary_help = "write a JSON summary of per-file timings and throughput to this path, - for stdout. Example: --batch_summary=summary.json"
+
+    batch_params = parser.add_argument_group("Batch Separation Params")
+    batch_params.add_argument("--input_list", default=None, help=input_list_help)
+    batch_params.add_argument("--batch_workers", type=int, default=1, help=batch_workers_help)
+    batch_params.add_argument("--prefetch", type=int, default=2, help=prefetch_help)
+    batch_params.add_argument("--write_workers", type=int, default=0, help=write_workers_help)
+    batch_params.add_argument("--write_queue_size", type=int, default=4, help=write_queue_size_help)
+    batch_params.add_argument("--batch_summary", default=None, help=batch_summary_help)
+
     invert_spect_help = "invert secondary stem using spectogram (default: %(default)s). Example: --invert_spect"
     normalization_help = "max peak amplitude to normalize input and output audio to (default: %(default)s). Example: --normalization=0.7"
     single_stem_help = "output only single stem, e.g. Instrumental, Vocals, Drums, Bass, Guitar, Piano, Other. Example: --single_stem=Instrumental"
     sample_rate_help = "modify the sample rate of the output audio (default: %(default)s). Example: --sample_rate=44100"
+    enable_quantization_help = "apply dynamic int8 quantization to Roformer and VR models for faster CPU inference (default: %(default)s). Example: --enable_quantization"
+    precision_help = "inference precision: fp32, bf16 or fp16, STFT steps stay in fp32 (default: %(default)s). Example: --precision=bf16"
+    quantization_min_sdr_help = "minimum SDR in dB of quantized output against fp32 output to use the quantized model (default: %(default)s). Example: --quantization_min_sdr=25"
 
     common_params = parser.add_argument_group("Common Separation Parameters")
     common_params.add_argument("--invert_spect", action="store_true", help=invert_spect_help)
     common_params.add_argument("--normalization", type=float, default=0.9, help=normalization_help)
     common_params.add_argument("--single_stem", default=None, help=single_stem_help)
     common_params.add_argument("--sample_rate", type=int, default=44100, help=sample_rate_help)
+    common_params.add_argument("--enable_quantization", action="store_true", help=enable_quantization_help)
+    common_params.add_argument("--quantization_min_sdr", type=float, default=20.0, help=quantization_min_sdr_help)
+    common_params.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"], help=precision_help)
 
     mdx_segment_size_help = "larger consumes more resources, but may give better results (default: %(default)s). Example: --mdx_segment_size=256"
     mdx_overlap_help = "amount of overlap between prediction windows, 0.001-0.999. higher is better but slower (default: %(default)s). Example: --mdx_overlap=0.25"
     mdx_batch_size_help = "larger consumes more RAM but may process slightly faster (default: %(default)s). Example: --mdx_batch_size=4"
     mdx_hop_length_help = "usually called stride in neural networks, only change if you know what you're doing (default: %(default)s). Example: --mdx_hop_length=1024"
     mdx_enable_denoise_help = "enable denoising during separation (default: %(default)s). Example: --mdx_enable_denoise"
+    mdx_onnx_intra_op_threads_help = "ONNX Runtime intra-op threads, 0 lets ONNX Runtime decide (default: %(default)s). Example: --mdx_onnx_intra_op_threads=8"
+    mdx_onnx_inter_op_threads_help = "ONNX Runtime inter-op threads, 0 lets ONNX Runtime decide (default: %(default)s). Example: --mdx_onnx_inter_op_threads=2"
+    mdx_onnx_graph_optimization_level_help = "ONNX Runtime graph optimization level: disable, basic, extended, all (default: %(default)s). Example: --mdx_onnx_graph_optimization_level=extended"
+    mdx_onnx_execution_mode_help = "ONNX Runtime execution mode: sequential, parallel (default: %(default)s). Example: --mdx_onnx_execution_mode=parallel"
+    mdx_onnx_optimized_model_cache_help = "cache the graph-optimized ONNX model in the model directory (default: %(default)s). Example: --mdx_onnx_optimized_model_cache"
+    mdx_onnx_disable_io_binding_help = "disable ONNX Runtime IO binding of re-used chunk buffers (default: %(default)s). Example: --mdx_onnx_disable_io_binding"
 
     mdx_params = parser.add_argument_group("MDX Architecture Parameters")
     mdx_params.add_argument("--mdx_segment_size", type=int, default=256, help=mdx_segment_size_help)
@@ -72,6 +179,12 @@ def main():
     mdx_params.add_argument("--mdx_batch_size", type=int, default=1, help=mdx_batch_size_help)
     mdx_params.add_argument("--mdx_hop_length", type=int, default=1024, help=mdx_hop_length_help)
     mdx_params.add_argument("--mdx_enable_denoise", action="store_true", help=mdx_enable_denoise_help)
+    mdx_params.add_argument("--mdx_onnx_intra_op_threads", type=int, default=0, help=mdx_onnx_intra_op_threads_help)
+    mdx_params.add_argument("--mdx_onnx_inter_op_threads", type=int, default=0, help=mdx_onnx_inter_op_threads_help)
+    mdx_params.add_argument("--mdx_onnx_graph_optimization_level", default="all", help=mdx_onnx_graph_optimization_level_help)
+    mdx_params.add_argument("--mdx_onnx_execution_mode", default="sequential", help=mdx_onnx_execution_mode_help)
+    mdx_params.add_argument("--mdx_onnx_optimized_model_cache", action="store_true", help=mdx_onnx_optimized_model_cache_help)
+    mdx_params.add_argument("--mdx_onnx_disable_io_binding", action="store_true", help=mdx_onnx_disable_io_binding_help)
 
     vr_batch_size_help = "number of batches to process at a time. higher = more RAM, slightly faster processing (default: %(default)s). Example: --vr_batch_size=16"
     vr_window_size_help = "balance quality and speed. 1024 = fast but lower, 320 = slower but better quality. (default: %(default)s). Example: --vr_window_size=320"
@@ -80,6 +193,8 @@ def main():
     vr_high_end_process_help = "mirror the missing frequency range of the output (default: %(default)s). Example: --vr_high_end_process"
     vr_enable_post_process_help = "identify leftover artifacts within vocal output; may improve separation for some songs (default: %(default)s). Example: --vr_enable_post_process"
     vr_post_process_threshold_help = "threshold for post_process feature: 0.1-0.3 (default: %(default)s). Example: --vr_post_process_threshold=0.1"
+    vr_resample_type_help = "resampler used between model bands instead of the model default, e.g. soxr_qq or kaiser_fast for speed (default: %(default)s). Example: --vr_resample_type=soxr_qq"
+    vr_band_workers_help = "threads building the per-band spectrograms, defaults to one per band, 1 = serial (default: %(default)s). Example: --vr_band_workers=2"
 
     vr_params = parser.add_argument_group("VR Architecture Parameters")
     vr_params.add_argument("--vr_batch_size", type=int, default=4, help=vr_batch_size_help)
@@ -89,10 +204,16 @@ def main():
     vr_params.add_argument("--vr_high_end_process", action="store_true", help=vr_high_end_process_help)
     vr_params.add_argument("--vr_enable_post_process", action="store_true", help=vr_enable_post_process_help)
     vr_params.add_argument("--vr_post_process_threshold", type=float, default=0.2, help=vr_post_process_threshold_help)
+    vr_params.add_argument("--vr_resample_type", default=None, help=vr_resample_type_help)
+    vr_params.add_argument("--vr_band_workers", type=int, default=None, help=vr_band_workers_help)
 
     demucs_segment_size_help = "size of segments into which the audio is split, 1-100. higher = slower but better quality (default: %(default)s). Example: --demucs_segment_size=256"
     demucs_shifts_help = "number of predictions with random shifts, higher = slower but better quality (default: %(default)s). Example: --demucs_shifts=4"
     demucs_overlap_help = "overlap between prediction windows, 0.001-0.999. higher = slower but better quality (default: %(default)s). Example: --demucs_overlap=0.25"
+    demucs_batch_size_help = "number of segments processed in a single forward pass. higher = more RAM, better hardware use (default: %(default)s). Example: --demucs_batch_size=4"
+    demucs_batch_shifts_help = "separate all shifted copies of the mix in one batch, faster with spare RAM / V-RAM (default: %(default)s). Example: --demucs_batch_shifts"
+    demucs_shift_seed_help = "seed for the random shift offsets, for reproducible output (default: %(default)s). Example: --demucs_shift_seed=42"
+    demucs_num_workers_help = "CPU threads processing segments in parallel, 0 = none (default: %(default)s). Example: --demucs_num_workers=4"
     demucs_segments_enabled_help = "enable segment-wise processing (default: %(default)s). Example: --demucs_segments_enabled=False"
 
     demucs_params = parser.add_argument_group("Demucs Architecture Parameters")
@@ -100,12 +221,19 @@ def main():
     demucs_params.add_argument("--demucs_shifts", type=int, default=2, help=demucs_shifts_help)
     demucs_params.add_argument("--demucs_overlap", type=float, default=0.25, help=demucs_overlap_help)
     demucs_params.add_argument("--demucs_segments_enabled", type=bool, default=True, help=demucs_segments_enabled_help)
+    demucs_params.add_argument("--demucs_batch_size", type=int, default=1, help=demucs_batch_size_help)
+    demucs_params.add_argument("--demucs_batch_shifts", action="store_true", help=demucs_batch_shifts_help)
+    demucs_params.add_argument("--demucs_shift_seed", type=int, default=None, help=demucs_shift_seed_help)
+    demucs_params.add_argument("--demucs_num_workers", type=int, default=0, help=demucs_num_workers_help)
 
     mdxc_segment_size_help = "larger consumes more resources, but may give better results (default: %(default)s). Example: --mdxc_segment_size=256"
     mdxc_override_model_segment_size_help = "override model default segment size instead of using the model default value. Example: --mdxc_override_model_segment_size"
     mdxc_overlap_help = "amount of overlap between prediction windows, 2-50. higher is better but slower (default: %(default)s). Example: --mdxc_overlap=8"
     mdxc_batch_size_help = "larger consumes more RAM but may process slightly faster (default: %(default)s). Example: --mdxc_batch_size=4"
     mdxc_pitch_shift_help = "shift audio pitch by a number of semitones while processing. may improve output for deep/high vocals. (default: %(default)s). Example: --mdxc_pitch_shift=2"
+    mdxc_compile_mode_help = "compile the model for faster repeated chunks: torch_compile or torchscript (default: %(default)s). Example: --mdxc_compile_mode=torch_compile"
+    mdxc_attention_chunk_size_help = "process Roformer attention queries in chunks of this many frames to bound memory use (default: %(default)s). Example: --mdxc_attention_chunk_size=256"
+    mdxc_compile_backend_help = "torch.compile backend used by --mdxc_compile_mode=torch_compile (default: %(default)s). Example: --mdxc_compile_backend=inductor"
 
     mdxc_params = parser.add_argument_group("MDXC Architecture Parameters")
     mdxc_params.add_argument("--mdxc_segment_size", type=int, default=256, help=mdxc_segment_size_help)
@@ -113,6 +241,26 @@ def main():
     mdxc_params.add_argument("--mdxc_overlap", type=int, default=8, help=mdxc_overlap_help)
     mdxc_params.add_argument("--mdxc_batch_size", type=int, default=1, help=mdxc_batch_size_help)
     mdxc_params.add_argument("--mdxc_pitch_shift", type=int, default=0, help=mdxc_pitch_shift_help)
+    mdxc_params.add_argument("--mdxc_compile_mode", default=None, choices=["torch_compile", "torchscript"], help=mdxc_compile_mode_help)
+    mdxc_params.add_argument("--mdxc_compile_backend", default="inductor", help=mdxc_compile_backend_help)
+    mdxc_params.add_argument("--mdxc_attention_chunk_size", type=int, default=None, help=mdxc_attention_chunk_size_help)
+
+    serve_help = "run a local separation server keeping models loaded between requests, instead of separating a single file (default: %(default)s). Example: --serve"
+    server_host_help = "host the separation server listens on (default: %(default)s). Example: --server_host=0.0.0.0"
+    server_port_help = "port the separation server listens on (default: %(default)s). Example: --server_port=8765"
+    server_socket_help = "listen on this unix socket path instead of a TCP port (default: %(default)s). Example: --server_socket=/tmp/audio-separator.sock"
+    server_max_models_help = "number of models the server keeps loaded at once (default: %(default)s). Example: --server_max_models=3"
+    server_max_batch_size_help = "maximum number of chunks from concurrent requests run in one forward pass (default: %(default)s). Example: --server_max_batch_size=16"
+    server_max_latency_help = "seconds a chunk waits for chunks of other requests to share its forward pass (default: %(default)s). Example: --server_max_latency=0.02"
+
+    server_params = parser.add_argument_group("Separation Server Parameters")
+    server_params.add_argument("--serve", action="store_true", help=serve_help)
+    server_params.add_argument("--server_host", default="127.0.0.1", help=server_host_help)
+    server_params.add_argument("--server_port", type=int, default=8765, help=server_port_help)
+    server_params.add_argument("--server_socket", default=None, help=server_socket_help)
+    server_params.add_argument("--server_max_models", type=int, default=2, help=server_max_models_help)
+    server_params.add_argument("--server_max_batch_size", type=int, default=8, help=server_max_batch_size_help)
+    server_params.add_argument("--server_max_latency", type=float, default=0.01, help=server_max_latency_help)
 
     args = parser.parse_args()
 
@@ -141,13 +289,15 @@ def main():
         logger.info(f"Model {args.model_filename} downloaded successfully.")
         sys.exit(0)
 
-    if not hasattr(args, "audio_file"):
+    audio_files = expand_audio_inputs(args.audio_files, args.input_list)
+
+    if not audio_files and not args.serve:
+        if args.audio_files or args.input_list:
+            logger.error("No audio files found for the given inputs.")
         parser.print_help()
         sys.exit(1)
 
-    logger.info(f"Separator version {package_version} beginning with input file: {args.audio_file}")
-
-    separator = Separator(
+    separator_kwargs = dict(
         log_formatter=log_formatter,
         log_level=log_level,
         model_file_dir=args.model_file_dir,
@@ -158,12 +308,23 @@ def main():
         output_single_stem=args.single_stem,
         invert_using_spec=args.invert_spect,
         sample_rate=args.sample_rate,
+        enable_quantization=args.enable_quantization,
+        quantization_min_sdr=args.quantization_min_sdr,
+        precision=args.precision,
+        write_workers=args.write_workers,
+        write_queue_size=args.write_queue_size,
         mdx_params={
             "hop_length": args.mdx_hop_length,
             "segment_size": args.mdx_segment_size,
             "overlap": args.mdx_overlap,
             "batch_size": args.mdx_batch_size,
             "enable_denoise": args.mdx_enable_denoise,
+            "onnx_intra_op_threads": args.mdx_onnx_intra_op_threads,
+            "onnx_inter_op_threads": args.mdx_onnx_inter_op_threads,
+            "onnx_graph_optimization_level": args.mdx_onnx_graph_optimization_level,
+            "onnx_execution_mode": args.mdx_onnx_execution_mode,
+            "onnx_optimized_model_cache": args.mdx_onnx_optimized_model_cache,
+            "onnx_enable_io_binding": not args.mdx_onnx_disable_io_binding,
         },
         vr_params={
             "batch_size": args.vr_batch_size,
@@ -173,12 +334,18 @@ def main():
             "enable_post_process": args.vr_enable_post_process,
             "post_process_threshold": args.vr_post_process_threshold,
             "high_end_process": args.vr_high_end_process,
+            "resample_type": args.vr_resample_type,
+            "band_workers": args.vr_band_workers,
         },
         demucs_params={
             "segment_size": args.demucs_segment_size,
             "shifts": args.demucs_shifts,
             "overlap": args.demucs_overlap,
             "segments_enabled": args.demucs_segments_enabled,
+            "batch_size": args.demucs_batch_size,
+            "batch_shifts": args.demucs_batch_shifts,
+            "shift_seed": args.demucs_shift_seed,
+            "num_workers": args.demucs_num_workers,
         },
         mdxc_params={
             "segment_size": args.mdxc_segment_size,
@@ -186,11 +353,46 @@ def main():
             "overlap": args.mdxc_overlap,
             "override_model_segment_size": args.mdxc_override_model_segment_size,
             "pitch_shift": args.mdxc_pitch_shift,
+            "compile_mode": args.mdxc_compile_mode,
+            "compile_backend": args.mdxc_compile_backend,
+            "attention_chunk_size": args.mdxc_attention_chunk_size,
         },
     )
 
+    if args.serve:
+        from audio_separator.separator.server import serve
+
+        logger.info(f"Separator version {package_version} starting separation server with model {args.model_filename}")
+        serve(
+            separator_kwargs,
+            args.model_filename,
+            host=args.server_host,
+            port=args.server_port,
+            socket_path=args.server_socket,
+            max_models=args.server_max_models,
+            max_batch_size=args.server_max_batch_size,
+            max_latency=args.server_max_latency,
+            logger=logger,
+        )
+        sys.exit(0)
+
+    logger.info(f"Separator version {package_version} beginning with {len(audio_files)} input file(s): {' '.join(audio_files)}")
+
+    separator = Separator(**separator_kwargs)
+
     separator.load_model(model_filename=args.model_filename)
 
-    output_files = separator.separate(args.audio_file)
+    summary = separate_audio_files(separator, audio_files, args.batch_workers, logger, prefetch=args.prefetch)
 
+    output_files = [output_file for result in summary["files"] for output_file in result.get("output_files", [])]
     logger.info(f"Separation complete! Output file(s): {' '.join(output_files)}")
+    logger.info(f"Separated {summary['succeeded']} of {len(audio_files)} file(s) in {summary['total_seconds']:.2f} seconds ({summary['realtime_factor']:.2f}x realtime).")
+
+    if args.batch_summary == "-":
+        print(json.dumps(summary, indent=4))
+    elif args.batch_summary is not None:
+        with open(args.batch_summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=4)
+
+    if summary["failed"]:
+        sys.exit(1)
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import librosa
+import numpy as np
+
+from pafts.datasets.shards import close_shards, find_shard_segment
+
+
+class AudioCache:
+    """
+    Decoded audio shared by every stage, so each file is decoded once and resampled at most once per sample rate.
+
+    Entries are keyed by the file's path, modification time and size (so a rewritten file is decoded again)
+    and by sample rate. Segments of a shard (see pafts.datasets.shards) are read from its memory-mapped blob instead of decoded. The native-rate decode is kept as the source of every resample. Arrays are float32,
+    shaped (channels, samples) like librosa.load(mono=False), and read-only as they are shared between callers.
+    When more than max_bytes are held in memory the least recently used entries are dropped,
+    or spilled to .npy files in spill_dir and memory-mapped back when they are used again.
+
+    Args:
+        max_bytes (int): Memory budget of the decoded audio held in memory.
+        spill_dir (str, optional): Directory to spill evicted entries to. Defaults to dropping them.
+
+    """
+
+    def __init__(
+            self,
+            max_bytes: int = 2 * 1024 ** 3,
+            spill_dir: str = None
+    ):
+        self.max_bytes = max_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+
+        self._entries = OrderedDict()
+        self._native_sr = {}
+        self._spilled = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def load(self, path, sr=None, mono=False):
+        """
+        Returns the decoded audio of a file and its sample rate, from the cache when possible.
+
+        Args:
+            path (str | Path): Audio file path.
+            sr (int, optional): Target sample rate. Defaults to the file's native rate.
+            mono (bool): Down-mix to a single channel (samples,).
+
+        Return:
+            (np.ndarray, int): Audio and sample rate.
+
+        """
+        segment = find_shard_segment(path)
+        if segment is not None:
+            reader, name = segment
+            file_key = (str(reader.path), reader.index_mtime, name)
+            native_audio, native_sr = reader.read(name)
+        else:
+            file_key = self._file_key(path)
+            native_audio, native_sr = self._get_native(file_key, path)
+        sr = sr or native_sr
+
+        if sr == native_sr:
+            audio = native_audio
+        else:
+            audio = self._get(file_key + (sr,))
+            if audio is None:
+                audio = self._put(file_key + (sr,), librosa.resample(np.asarray(native_audio), orig_sr=native_sr, target_sr=sr))
+
+        if mono and audio.ndim > 1:
+            audio = librosa.to_mono(audio)
+
+        return audio, sr
+
+    def put(self, path, audio, sr):
+        """
+        Stores audio which a stage has just written to path, so the next stage reading it doesn't decode it again.
+        The array is used as the file's native-rate audio, resamples cached for an older version of the file are no longer used.
+
+        Args:
+            path (str | Path): Path of the written audio file.
+            audio (np.ndarray): Audio as (channels, samples) or (samples,).
+            sr (int): Sample rate of the audio.
+
+        """
+        file_key = self._file_key(path)
+        with self._lock:
+            self._native_sr[file_key] = sr
+        self._put(file_key + (None,), np.array(audio, dtype=np.float32))
+
+    def clear(self):
+        """Drops every entry and the open shard readers, and deletes the spill files."""
+        with self._lock:
+            self._entries.clear()
+            self._native_sr.clear()
+            self._bytes = 0
+            spilled, self._spilled = self._spilled, {}
+
+        close_shards()
+        for spill_path in spilled.values():
+            Path(spill_path).unlink(missing_ok=True)
+
+    def _get_native(self, file_key, path):
+        audio = self._get(file_key + (None,))
+        with self._lock:
+            sr = self._native_sr.get(file_key)
+
+        if audio is None or sr is None:
+            audio, sr = librosa.load(str(path), sr=None, mono=False)
+            with self._lock:
+                self._native_sr[file_key] = sr
+            audio = self._put(file_key + (None,), audio)
+
+        return audio, sr
+
+    @staticmethod
+    def _file_key(path):
+        path = Path(path).resolve()
+        stat = path.stat()
+        return (str(path), stat.st_mtime_ns, stat.st_size)
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            spill_path = self._spilled.get(key)
+
+        if spill_path is None:
+            return None
+
+        # Memory-mapped entries are paged in by the OS and don't count against max_bytes
+        audio = np.load(spill_path, mmap_mode='r')
+        with self._lock:
+            self._entries[key] = audio
+        return audio
+
+    def _put(self, key, value):
+        value.flags.writeable = False
+
+        with self._lock:
+            self._bytes -= self._size(self._entries.pop(key, None))
+            self._entries[key] = value
+            self._bytes += self._size(value)
+
+            evicted = []
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key, evicted_value = self._entries.popitem(last=False)
+                self._bytes -= self._size(evicted_value)
+                evicted.append((evicted_key, evicted_value))
+
+        for evicted_key, evicted_value in evicted:
+            self._spill(evicted_key, evicted_value)
+
+        return value
+
+    def _spill(self, key, audio):
+        if self.spill_dir is None or isinstance(audio, np.memmap):
+            return
+
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        spill_path = self.spill_dir / f"{hashlib.sha1(repr(key).encode()).hexdigest()}.npy"
+        if not spill_path.exists():
+            np.save(spill_path, audio)
+
+        with self._lock:
+            self._spilled[key] = spill_path
+
+    @staticmethod
+    def _size(audio):
+        # Memory-mapped spill entries live on disk
+        if audio is None or isinstance(audio, np.memmap):
+            return 0
+        return audio.nbytes
+
+
+"""Decoded audio cache shared by the separator, diarization and STT stages"""
+audio_cache = AudioCache(
+    max_bytes=int(os.environ.get('PAFTS_AUDIO_CACHE_BYTES', 2 * 1024 ** 3)),
+    spill_dir=os.environ.get('PAFTS_AUDIO_CACHE_DIR'),
+)
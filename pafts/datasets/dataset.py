@@ -1,6 +1,8 @@
 from pathlib import Path
 
-from pydub import AudioSegment
+import librosa
+
+from pafts.datasets.shards import find_shard_audios, find_shard_segment
 
 """Supported Audio formats"""
 AUDIO_FORMATS = [
@@ -19,8 +21,12 @@ def is_audio(path):
 
 
 def get_duration(path):
-    audio = AudioSegment.from_file(path)
-    return audio.duration_seconds
+    # Read from the file header or the shard index, without decoding the audio
+    segment = find_shard_segment(path)
+    if segment is not None:
+        reader, name = segment
+        return reader.segments[name]['frames'] / reader.segments[name]['sample_rate']
+    return librosa.get_duration(path=str(path))
 
 
 class Dataset:
@@ -64,7 +70,7 @@ class Dataset:
 
         # find audio file in path
         # self._audios = [Data(str(p)) for p in self._path.glob("**/*") if is_audio(p)]
-        self._audios = [Path(p) for p in self._path.glob("**/*") if is_audio(p)]
+        self._audios = [Path(p) for p in self._path.glob("**/*") if is_audio(p)] + find_shard_audios(self._path)
 
     def __len__(self):
         return len(self._audios)
@@ -106,7 +112,7 @@ class Dataset:
     def path(self, path):
         if (isinstance(path, str) or isinstance(path, Path)) and Path(path).exists():
             self._path = path
-            self._audios = [Path(p) for p in self._path.glob("**/*") if is_audio(p)]
+            self._audios = [Path(p) for p in self._path.glob("**/*") if is_audio(p)] + find_shard_audios(self._path)
         else:
             raise ValueError("[!] The input is wrong.")
 
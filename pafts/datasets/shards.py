@@ -0,0 +1,260 @@
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+"""Suffix of shard directories"""
+SHARD_SUFFIX = '.shard'
+SHARD_SAMPLES = 'samples.bin'
+SHARD_INDEX = 'index.json'
+SHARD_DTYPES = ['float32', 'int16']
+
+_open_shards = {}
+_open_shards_lock = threading.Lock()
+
+
+class ShardWriter:
+    """
+    Writes the audio segments of a stage into one shard: a directory holding a single sample blob and an offsets index,
+    instead of one small audio file per segment.
+
+    Each segment is addressed by a virtual path, the shard directory joined with the segment name
+    (e.g. 'diarization.shard/speaker_A/A_0.wav'), which the next stages use like an audio file path.
+    The index is written when the writer is closed, only then can the shard be read.
+
+    Args:
+        path (str | Path): Shard directory, its name should end with '.shard'.
+        dtype (str): Sample format of the blob, 'float32' (read back zero-copy) or 'int16' (half the size).
+
+    """
+
+    def __init__(
+            self,
+            path,
+            dtype: str = 'float32'
+    ):
+        if dtype not in SHARD_DTYPES:
+            raise ValueError(f"[!] Please choose one of the following dtypes: {', '.join(SHARD_DTYPES)}.")
+
+        self.path = Path(path)
+        self.dtype = dtype
+        self.segments = []
+        self.offset = 0
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._samples = open(self.path / SHARD_SAMPLES, 'wb')
+
+    def add(self, name, audio, sample_rate):
+        """
+        Appends a segment to the shard.
+
+        Args:
+            name (str): Segment name, unique in the shard, e.g. 'speaker_A/A_0.wav'.
+            audio (np.ndarray): Audio as (channels, samples) or (samples,).
+            sample_rate (int): Sample rate of the audio.
+
+        Return:
+            Path: Virtual path of the segment.
+
+        """
+        audio = np.atleast_2d(audio)
+        channels, frames = audio.shape
+
+        # Frames are stored interleaved, like an audio file
+        if self.dtype == 'int16':
+            samples = (np.clip(audio.T, -1, 1) * 32767).astype(np.int16)
+        else:
+            samples = np.ascontiguousarray(audio.T, dtype=np.float32)
+        self._samples.write(samples.tobytes())
+
+        self.segments.append({
+            'name': name,
+            'offset': self.offset,
+            'frames': frames,
+            'channels': channels,
+            'sample_rate': sample_rate,
+        })
+        self.offset += frames * channels
+
+        return self.path / name
+
+    def close(self):
+        self._samples.close()
+        with open(self.path / SHARD_INDEX, 'w', encoding='UTF8') as f:
+            json.dump({'dtype': self.dtype, 'segments': self.segments}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShardReader:
+    """
+    Reads the segments of a shard from its memory-mapped sample blob.
+
+    Args:
+        path (str | Path): Shard directory.
+
+    """
+
+    def __init__(
+            self,
+            path
+    ):
+        self.path = Path(path)
+
+        with open(self.path / SHARD_INDEX, 'r', encoding='UTF8') as f:
+            index = json.load(f)
+
+        self.dtype = index['dtype']
+        self.segments = {segment['name']: segment for segment in index['segments']}
+
+        # An empty file can't be memory-mapped
+        if (self.path / SHARD_SAMPLES).stat().st_size:
+            self.samples = np.memmap(self.path / SHARD_SAMPLES, dtype=self.dtype, mode='r')
+        else:
+            self.samples = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __contains__(self, name):
+        return name in self.segments
+
+    def paths(self):
+        """Virtual paths of the segments, in the order they were written."""
+        return [self.path / name for name in self.segments]
+
+    def read(self, name):
+        """
+        Returns a segment as (channels, samples) float32 and its sample rate.
+        Float32 shards return a read-only view of the memory-mapped blob, without copying or decoding.
+
+        Args:
+            name (str): Segment name.
+
+        Return:
+            (np.ndarray, int): Audio and sample rate.
+
+        """
+        segment = self.segments[name]
+        start = segment['offset']
+        end = start + segment['frames'] * segment['channels']
+
+        audio = self.samples[start:end].reshape(segment['frames'], segment['channels']).T
+        if self.dtype == 'int16':
+            audio = audio.astype(np.float32) / 32767
+
+        return audio, segment['sample_rate']
+
+    def export(self, output_path):
+        """
+        Writes every segment to an audio file under output_path, at the segment name's relative path.
+
+        Args:
+            output_path (str | Path): Output directory.
+
+        Return:
+            list: Paths of the written files.
+
+        """
+        paths = []
+        for name in self.segments:
+            audio, sample_rate = self.read(name)
+            path = Path(output_path) / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            sf.write(path, audio.T, sample_rate, subtype='PCM_16')
+            paths.append(path)
+
+        return paths
+
+
+def open_shard(path):
+    """
+    Returns a ShardReader of the shard directory, shared by every caller until the shard is rewritten.
+
+    Args:
+        path (str | Path): Shard directory.
+
+    """
+    path = Path(path).resolve()
+    index_mtime = (path / SHARD_INDEX).stat().st_mtime_ns
+
+    with _open_shards_lock:
+        reader = _open_shards.get(path)
+        if reader is None or reader.index_mtime != index_mtime:
+            reader = ShardReader(path)
+            reader.index_mtime = index_mtime
+            _open_shards[path] = reader
+
+    return reader
+
+
+def close_shards(path=None):
+    """
+    Drops the shared ShardReaders of the shards under a directory, so their memory-mapped blobs are released
+    once no caller holds their segments. Call it before deleting shard directories.
+
+    Args:
+        path (str | Path, optional): Directory with shards. Defaults to every open shard.
+
+    """
+    path = Path(path).resolve() if path is not None else None
+
+    with _open_shards_lock:
+        for shard_path in list(_open_shards):
+            if path is None or shard_path == path or path in shard_path.parents:
+                del _open_shards[shard_path]
+
+
+def find_shard_segment(path):
+    """
+    Returns the ShardReader and segment name of a virtual segment path, or None for a regular file path.
+
+    Args:
+        path (str | Path): Audio path.
+
+    """
+    path = Path(path)
+    if not any(part.endswith(SHARD_SUFFIX) for part in path.parts[:-1]):
+        return None
+
+    for parent in path.parents:
+        if parent.name.endswith(SHARD_SUFFIX) and (parent / SHARD_INDEX).exists():
+            reader = open_shard(parent)
+            name = path.relative_to(parent).as_posix()
+            return (reader, name) if name in reader else None
+
+    return None
+
+
+def find_shard_audios(path):
+    """
+    Returns the virtual paths of the segments of every shard under a directory.
+
+    Args:
+        path (str | Path): Directory path.
+
+    """
+    audios = []
+    for index in sorted(Path(path).glob(f"**/*{SHARD_SUFFIX}/{SHARD_INDEX}")):
+        audios.extend(open_shard(index.parent).paths())
+
+    return audios
+
+
+def export_shards(path, output_path):
+    """
+    Writes the segments of every shard under a directory to audio files, keeping their paths relative to the shard.
+
+    Args:
+        path (str | Path): Directory with shards.
+        output_path (str | Path): Output directory.
+
+    """
+    for index in sorted(Path(path).glob(f"**/*{SHARD_SUFFIX}/{SHARD_INDEX}")):
+        open_shard(index.parent).export(output_path)
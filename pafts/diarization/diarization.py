@@ -1,25 +1,30 @@
-import uuid
-from datetime import datetime
-from pathlib import Path
 from collections import defaultdict
 
 from pafts.datasets.dataset import Dataset
+from pafts.datasets.audio_cache import audio_cache
+from pafts.datasets.shards import ShardWriter
 
-from silero_vad import load_silero_vad, read_audio, get_speech_timestamps
+from silero_vad import load_silero_vad, get_speech_timestamps
 from pydub import AudioSegment
 from pyannote.audio import Pipeline
+import librosa
+import numpy as np
+import soundfile as sf
 import torch
 
 
-def generate_unique_filename(format="wav"):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = uuid.uuid4().hex
-    return f"temp_audio_{timestamp}_{unique_id}.{format}"
+def to_channels(wave, channels):
+    """Returns a (channels, samples) copy of the wave, down-mixing and repeating it if its channel count differs."""
+    wave = np.atleast_2d(wave)
+    if wave.shape[0] == channels:
+        return wave
+    return np.repeat(librosa.to_mono(wave)[np.newaxis], channels, axis=0)
 
 
 def diarization(
         dataset: Dataset,
         hf_token,
+        use_shard=False,
 
 ):
     """
@@ -29,6 +34,8 @@ def diarization(
     Args:
         dataset (Dataset): Dataset instance.
         hf_token (str): Huggingface access token.
+        use_shard (bool): Write the segments into one memory-mapped shard (see pafts.datasets.shards)
+            instead of a wav file each. Defaults to False.
 
     Return:
         new_audios (list): List of new audio path.
@@ -49,46 +56,53 @@ def diarization(
 
     pipeline.to(device)
 
-    seg = None
-    padding = AudioSegment.silent(duration=1000)
-
+    # The audios are decoded through the shared cache at the first audio's sample rate,
+    # and concatenated with a second of silence after each
+    sr = None
+    waves = []
     for audio in dataset.audios:
-        if not seg:
-            seg = AudioSegment.from_file(audio)
-        else:
-            seg += AudioSegment.from_file(audio)
-        seg += padding
-
-    temp_file_path = dataset.output_path / generate_unique_filename()
+        wave, sr = audio_cache.load(audio, sr=sr)
+        waves.append(wave)
 
-    # create audio temp file
-    seg.export(temp_file_path, format='wav')
+    channels = max(np.atleast_2d(wave).shape[0] for wave in waves)
+    padding = np.zeros((channels, sr), dtype=np.float32)
+    seg = np.concatenate([part for wave in waves for part in (to_channels(wave, channels), padding)], axis=1)
 
-    # diarization
-    diarization_audio = pipeline(f"{temp_file_path}")
+    # diarization, run on the in-memory waveform rather than a temporary wav file
+    diarization_audio = pipeline({"waveform": torch.from_numpy(seg), "sample_rate": sr})
 
     speaker_num_list = defaultdict(int)
     new_audios = []
 
-    for i, (turn, _, speaker) in enumerate(diarization_audio.itertracks(yield_label=True)):
-        start_ms = turn.start * 1000
-        end_ms = turn.end * 1000
+    shard = ShardWriter(dataset.output_path / "diarization.shard") if use_shard else None
 
-        speaker_folder = dataset.output_path / f"speaker_{speaker}"
-        speaker_folder.mkdir(parents=True, exist_ok=True)
+    try:
+        for i, (turn, _, speaker) in enumerate(diarization_audio.itertracks(yield_label=True)):
+            start = int(turn.start * sr)
+            end = int(turn.end * sr)
 
-        segment = seg[start_ms:end_ms]
+            segment = seg[:, start:end]
+            segment_name = f"speaker_{speaker}/{speaker}_{speaker_num_list[speaker]}.wav"
 
-        output_file_path = speaker_folder / f"{speaker}_{speaker_num_list[speaker]}.wav"
-        segment.export(output_file_path, format="wav")
+            if shard is not None:
+                segment_path = shard.add(segment_name, segment, sr)
+            else:
+                segment_path = dataset.output_path / segment_name
+                segment_path.parent.mkdir(parents=True, exist_ok=True)
+                # The segment is quantized to 16-bit PCM here rather than by libsndfile, so the cached audio is exactly
+                # what decoding the file gives (int16 samples read back as float are scaled by 1 / 32768)
+                pcm = np.round(np.clip(segment, -1, 1) * 32767).astype(np.int16)
+                sf.write(segment_path, pcm.T, sr, subtype="PCM_16")
 
-        speaker_num_list[speaker] += 1  # +1
+                # STT reads the segment from the cache instead of decoding the file again
+                audio_cache.put(segment_path, pcm / 32768, sr)
 
-        new_audios.append(speaker_folder / f"{speaker}_{speaker_num_list[speaker]}.wav")
+            speaker_num_list[speaker] += 1  # +1
 
-    # delete temp file
-    if Path(temp_file_path).exists():
-        temp_file_path.unlink()
+            new_audios.append(segment_path)
+    finally:
+        if shard is not None:
+            shard.close()
 
     dataset.audios = new_audios
 
@@ -107,7 +121,9 @@ def vad(
     new_audios = []
 
     for audio in audios:
-        wav = read_audio(str(audio))
+        # silero takes 16 kHz mono samples
+        wav, _ = audio_cache.load(audio, sr=16000, mono=True)
+        wav = torch.from_numpy(np.array(wav))
 
         speech_timestamps = get_speech_timestamps(wav, model, min_silence_duration_ms=min_silence_duration_ms)
 
@@ -118,7 +134,15 @@ def vad(
             end /= 16000
             stamp.append((start, end))
 
-        audio_segment = AudioSegment.from_file(audio)
+        # The segments are cut from the cached decode instead of decoding the file again with pydub
+        wave, sr = audio_cache.load(audio)
+        wave = np.atleast_2d(wave)
+        audio_segment = AudioSegment(
+            (np.clip(wave.T, -1, 1) * 32767).astype(np.int16).tobytes(),
+            frame_rate=sr,
+            sample_width=2,
+            channels=wave.shape[0],
+        )
 
         for i, (start, end) in enumerate(stamp):
             start_ms = start * 1000
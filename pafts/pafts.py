@@ -4,6 +4,8 @@ import uuid
 from datetime import datetime
 
 from pafts.datasets.dataset import Dataset
+from pafts.datasets.audio_cache import audio_cache
+from pafts.datasets.shards import SHARD_SUFFIX, close_shards, export_shards
 from pafts.diarization.diarization import diarization
 from pafts.separator.separator import separator
 from pafts.stt.stt import STT
@@ -48,8 +50,8 @@ class PAFTS:
             output_path=output_path
         )
 
-    def separator(self):
-        separator(self._dataset)
+    def separator(self, server=None):
+        separator(self._dataset, server=server)
         return
 
     def diarization(self):
@@ -85,8 +87,8 @@ class PAFTS:
         # Stage 1: separator
         temp_dir1 = self._stage_process(separator)
 
-        # Stage 2: diarization
-        temp_dir2 = self._stage_process(diarization, hf_token=self._hf_token)
+        # Stage 2: diarization, its segments are kept in a shard which STT reads without opening a file per segment
+        temp_dir2 = self._stage_process(diarization, hf_token=self._hf_token, use_shard=True)
 
         # Stage 3: STT
         temp_dir3 = self._stage_process(STT)
@@ -94,8 +96,11 @@ class PAFTS:
         original_output.mkdir(exist_ok=True)
 
         for temp_dir in [temp_dir2, temp_dir3]:
+            # Segments kept in shards between stages are written out as audio files
+            export_shards(temp_dir, original_output)
+
             for file in temp_dir.rglob('*'):
-                if file.is_file():
+                if file.is_file() and not any(part.endswith(SHARD_SUFFIX) for part in file.relative_to(temp_dir).parts):
                     relative_path = file.relative_to(temp_dir)
                     destination = original_output / relative_path
                     destination.parent.mkdir(parents=True, exist_ok=True)
@@ -103,4 +108,6 @@ class PAFTS:
 
         # Cleanup
         for temp_dir in [temp_dir1, temp_dir2, temp_dir3]:
+            close_shards(temp_dir)
             shutil.rmtree(temp_dir, ignore_errors=True)
+        audio_cache.clear()
@@ -1,38 +1,120 @@
+import shutil
 from pathlib import Path
 
+import numpy as np
 from tqdm import tqdm
 
 from pafts.datasets.dataset import Dataset
+from pafts.datasets.audio_cache import audio_cache
+from audio_separator.separator.common_separator import CommonSeparator
 from audio_separator.separator.separator import Separator
+from audio_separator.separator.server import SeparationClient
+from audio_separator.separator.uvr_lib_v5 import spec_utils
+
+
+def find_vocal_file(output_files):
+    """
+    Returns the output file of the vocal stem, output files are named '<audio>_(<stem>)_<model>.<ext>'.
+    """
+    return next(output_file for output_file in output_files if f"_({CommonSeparator.VOCAL_STEM})_" in Path(output_file).name)
 
 
 def separator(
-        dataset: Dataset
+        dataset: Dataset,
+        server: SeparationClient = None
 ):
-    separator = Separator(output_dir=dataset.output_path)
+    # A running separation server already has the model loaded, so the stems are fetched from it instead
+    if server is not None:
+        return separator_from_server(dataset, server)
+
+    # Stems are written in the background while the next file is separated,
+    # and input files are decoded through the shared cache
+    separator = Separator(output_dir=dataset.output_path,
+                          write_workers=1,
+                          audio_loader=lambda path, sr: audio_cache.load(path, sr)[0],
+                          )
     separator.load_model()
 
     audios = dataset.audios
     new_audios = []
 
+    def save_vocal(audio, output_files, sources):
+        separator.wait_for_writes(output_files)
+        target_path = Path(dataset.output_path) / Path(audio.name)
+
+        vocal_file = find_vocal_file(output_files)
+
+        # inst unlink
+        for output_file in output_files:
+            if output_file != vocal_file:
+                (Path(dataset.output_path) / Path(output_file)).unlink()
+
+        # save vocal
+        if target_path.exists():
+            target_path.unlink()
+        Path(Path(dataset.output_path) / Path(vocal_file)).rename(target_path)
+
+        # The next stage reads the vocal from the cache instead of decoding the file again. The cached audio is
+        # what decoding the WAV file gives: the stem normalized like the writer does it, then rounded to 16-bit PCM
+        # and read back as float (libsndfile scales by 32767 when writing and by 1 / 32768 when reading).
+        vocal = spec_utils.normalize(wave=np.array(sources[CommonSeparator.VOCAL_STEM]), max_peak=separator.normalization_threshold)
+        vocal = np.round(vocal * 32767) / 32768
+        audio_cache.put(target_path, vocal.T, separator.sample_rate)
+
+        new_audios.append(target_path)
+
+    # The next files are decoded in the background while the current one is separated
+    bar = tqdm(separator.prefetch_audio(audios),
+               total=len(audios),
+               leave=True,
+               )
+
+    previous = None
+    for audio, prefetched_audio in bar:
+        output_files, sources = separator.separate(audio, return_sources=True, prefetched_audio=prefetched_audio)
+
+        if previous is not None:
+            save_vocal(*previous)
+        previous = (audio, output_files, sources)
+
+    if previous is not None:
+        save_vocal(*previous)
+
+    dataset.audios = new_audios
+
+    return new_audios
+
+
+def separator_from_server(
+        dataset: Dataset,
+        server: SeparationClient
+):
+    audios = dataset.audios
+    new_audios = []
+
     bar = tqdm(audios,
                total=len(audios),
                leave=True,
                )
 
     for audio in bar:
-        output_files = separator.separate(audio)
+        output_files = server.separate(audio)
         target_path = Path(dataset.output_path) / Path(audio.name)
+        Path(dataset.output_path).mkdir(parents=True, exist_ok=True)
+
+        vocal_file = find_vocal_file(output_files)
 
         # inst unlink
-        (Path(dataset.output_path) / Path(output_files[0])).unlink()
+        for output_file in output_files:
+            if output_file != vocal_file:
+                Path(output_file).unlink()
 
-        # save vocal
+        # save vocal, the server may write to another directory than the dataset output path
         if target_path.exists():
             target_path.unlink()
-        Path(Path(dataset.output_path) / Path(output_files[1])).rename(target_path)
+        shutil.move(vocal_file, target_path)
 
-        new_audios.append(Path(dataset.output_path) / Path(audio.name))
+        new_audios.append(target_path)
 
     dataset.audios = new_audios
 
@@ -2,11 +2,13 @@ import json
 from pathlib import Path
 from collections import defaultdict
 
+import numpy as np
 import whisper
 from whisper.tokenizer import LANGUAGES
 from tqdm import tqdm
 
 from pafts.datasets.dataset import Dataset
+from pafts.datasets.audio_cache import audio_cache
 
 whisper_model = {key: None for key in whisper._MODELS}
 
@@ -41,7 +43,9 @@ def whisper_stt(
         raise ValueError(
             f"[!] This language is not supported. Please select one of the language codes below\n{LANGUAGES}")
 
-    result = whisper_model[model_size].transcribe(str(audio))
+    # Whisper takes 16 kHz mono samples, decoded through the shared cache rather than by its own ffmpeg call
+    samples, _ = audio_cache.load(audio, sr=whisper.audio.SAMPLE_RATE, mono=True)
+    result = whisper_model[model_size].transcribe(np.array(samples, dtype=np.float32))
 
     return result['text']
 
@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import pytest
+import torch
+from torch import nn
+
+from audio_separator.separator.uvr_lib_v5.demucs.apply import apply_model, apply_model_to_chunks, get_shared_pool, TensorChunk
+
+
+class DummyModel(nn.Module):
+    """A small deterministic stand-in for a Demucs model: 2 sources, stereo, 1 second segments at 100 Hz."""
+
+    samplerate = 100
+    segment = 1.0
+    sources = ["drums", "bass"]
+    audio_channels = 2
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv1d(self.audio_channels, len(self.sources) * self.audio_channels, kernel_size=5, padding=2)
+        with torch.no_grad():
+            self.conv.weight.copy_(torch.randn(self.conv.weight.shape, generator=torch.Generator().manual_seed(0)))
+            self.conv.bias.zero_()
+
+    def forward(self, mix):
+        return self.conv(mix).view(mix.shape[0], len(self.sources), self.audio_channels, -1)
+
+
+def make_mix(length=1050):
+    return torch.randn((1, 2, length), generator=torch.Generator().manual_seed(1))
+
+
+def test_concurrent_segments_match_serial():
+    model = DummyModel()
+    mix = make_mix()
+
+    serial = apply_model(model, mix, shifts=0, split=True, overlap=0.25, num_workers=0)
+    concurrent = apply_model(model, mix, shifts=0, split=True, overlap=0.25, num_workers=4)
+
+    assert torch.equal(serial, concurrent)
+
+
+def test_concurrent_batched_shifted_segments_match_serial():
+    model = DummyModel()
+    mix = make_mix()
+    kwargs = {"shifts": 2, "split": True, "overlap": 0.25, "segment_batch_size": 3, "shift_seed": 0}
+
+    serial = apply_model(model, mix, num_workers=0, **kwargs)
+    concurrent = apply_model(model, mix, num_workers=4, **kwargs)
+
+    assert torch.equal(serial, concurrent)
+
+
+def test_concurrent_segments_run_under_autocast():
+    model = DummyModel()
+    mix = make_mix()
+
+    def autocast_context():
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+
+    # The separator enters autocast on its own thread, the pool threads must enter it again
+    with autocast_context():
+        serial = apply_model(model, mix, shifts=0, split=True, num_workers=0, autocast_context=autocast_context)
+        concurrent = apply_model(model, mix, shifts=0, split=True, num_workers=4, autocast_context=autocast_context)
+
+    fp32 = apply_model(model, mix, shifts=0, split=True, num_workers=0)
+
+    assert torch.equal(serial, concurrent)
+    assert not torch.equal(serial, fp32)
+
+
+def test_apply_model_to_chunks_on_pool_matches_serial():
+    model = DummyModel()
+    mix = make_mix()
+    chunks = [TensorChunk(mix, offset, 100) for offset in (0, 100, 200)]
+
+    serial = apply_model_to_chunks(model, chunks, torch.device("cpu"))
+    concurrent = get_shared_pool(2).submit(apply_model_to_chunks, model, chunks, torch.device("cpu")).result()
+
+    assert len(serial) == len(concurrent) == len(chunks)
+    for serial_out, concurrent_out in zip(serial, concurrent):
+        assert torch.equal(serial_out, concurrent_out)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("precision", ["fp32", "bf16"])
+def test_concurrent_separations_match_serial(num_workers, precision):
+    model = DummyModel()
+    mixes = [make_mix(length) for length in (1050, 730, 1200, 980)]
+    dtype = {"fp32": None, "bf16": torch.bfloat16}[precision]
+
+    def autocast_context():
+        return torch.autocast(device_type="cpu", dtype=dtype) if dtype is not None else nullcontext()
+
+    def separate(mix):
+        # Like DemucsSeparator.demix_demucs, each separation enters autocast on its own thread
+        with torch.no_grad(), autocast_context():
+            return apply_model(model, mix, shifts=1, shift_seed=0, split=True, overlap=0.25, segment_batch_size=2, num_workers=num_workers, autocast_context=autocast_context)
+
+    serial = [separate(mix) for mix in mixes]
+    with ThreadPoolExecutor(max_workers=len(mixes)) as executor:
+        concurrent = list(executor.map(separate, mixes * 2))
+
+    for serial_out, concurrent_out in zip(serial * 2, concurrent):
+        assert torch.equal(serial_out, concurrent_out)
@@ -0,0 +1,177 @@
+import os
+
+import librosa
+import numpy as np
+import pytest
+
+from audio_separator.separator.uvr_lib_v5 import spec_utils
+from audio_separator.separator.uvr_lib_v5.vr_network.model_param_init import ModelParameters
+
+
+def baseline_adjust_aggr(mask, is_non_accom_stem, aggressiveness):
+    """spec_utils.adjust_aggr as it was before VR mask post-processing was fused."""
+    aggr = aggressiveness["value"] * 2
+
+    if aggr != 0:
+        if is_non_accom_stem:
+            aggr = 1 - aggr
+
+        aggr = [aggr, aggr]
+
+        if aggressiveness["aggr_correction"] is not None:
+            aggr[0] += aggressiveness["aggr_correction"]["left"]
+            aggr[1] += aggressiveness["aggr_correction"]["right"]
+
+        for ch in range(2):
+            mask[ch, : aggressiveness["split_bin"]] = np.power(mask[ch, : aggressiveness["split_bin"]], 1 + aggr[ch] / 3)
+            mask[ch, aggressiveness["split_bin"] :] = np.power(mask[ch, aggressiveness["split_bin"] :], 1 + aggr[ch])
+
+    return mask
+
+
+def baseline_merge_artifacts(y_mask, thres=0.01, min_range=64, fade_size=32):
+    """spec_utils.merge_artifacts as it was before VR mask post-processing was fused, with its full-size artifact weight."""
+    mask = y_mask
+
+    try:
+        if min_range < fade_size * 2:
+            raise ValueError("min_range must be >= fade_size * 2")
+
+        idx = np.where(y_mask.min(axis=(0, 1)) > thres)[0]
+        start_idx = np.insert(idx[np.where(np.diff(idx) != 1)[0] + 1], 0, idx[0])
+        end_idx = np.append(idx[np.where(np.diff(idx) != 1)[0]], idx[-1])
+        artifact_idx = np.where(end_idx - start_idx > min_range)[0]
+        weight = np.zeros_like(y_mask)
+        if len(artifact_idx) > 0:
+            start_idx = start_idx[artifact_idx]
+            end_idx = end_idx[artifact_idx]
+            old_e = None
+            for s, e in zip(start_idx, end_idx):
+                if old_e is not None and s - old_e < fade_size:
+                    s = old_e - fade_size * 2
+
+                if s != 0:
+                    weight[:, :, s : s + fade_size] = np.linspace(0, 1, fade_size)
+                else:
+                    s -= fade_size
+
+                if e != y_mask.shape[2]:
+                    weight[:, :, e - fade_size : e] = np.linspace(1, 0, fade_size)
+                else:
+                    e += fade_size
+
+                weight[:, :, s + fade_size : e - fade_size] = 1
+                old_e = e
+
+        v_mask = 1 - y_mask
+        y_mask += weight * v_mask
+
+        mask = y_mask
+    except Exception:
+        # No frame above the threshold, the mask is returned unchanged
+        pass
+
+    return mask
+
+
+def baseline_apply_mask(mask, X_mag, X_phase, is_non_accom_stem, aggressiveness, post_process_threshold=None):
+    """VRSeparator's postprocess as it was before the series: adjust_aggr, merge_artifacts, then both stem spectrograms."""
+    mask = baseline_adjust_aggr(mask, is_non_accom_stem, aggressiveness)
+
+    if post_process_threshold is not None:
+        mask = baseline_merge_artifacts(mask, thres=post_process_threshold)
+
+    y_spec = mask * X_mag * np.exp(1.0j * X_phase)
+    v_spec = (1 - mask) * X_mag * np.exp(1.0j * X_phase)
+
+    return y_spec, v_spec
+
+
+def make_mask_inputs(with_artifacts=True, n_bins=65, n_frames=3000):
+    rng = np.random.default_rng(0)
+    mask = rng.uniform(0, 1, (2, n_bins, n_frames)).astype(np.float32)
+    if with_artifacts:
+        # Frames where the whole mask stays above the post-processing thresholds even once raised to the strongest
+        # aggressiveness exponent used below (about 2), for merge_artifacts to blend in
+        mask[:, :, 500:900] = rng.uniform(0.8, 1, (2, n_bins, 400))
+        mask[:, :, 2800:] = rng.uniform(0.8, 1, (2, n_bins, 200))
+    X_mag = rng.uniform(0, 10, (2, n_bins, n_frames)).astype(np.float32)
+    X_phase = rng.uniform(-np.pi, np.pi, (2, n_bins, n_frames)).astype(np.float32)
+    return mask, X_mag, X_phase
+
+
+@pytest.mark.parametrize("with_artifacts", [True, False])
+@pytest.mark.parametrize("is_non_accom_stem", [True, False])
+@pytest.mark.parametrize("post_process_threshold", [None, 0.2, 0.3])
+@pytest.mark.parametrize("aggression", [0.0, 0.05, 0.1])
+def test_apply_mask_chunked_matches_baseline(with_artifacts, is_non_accom_stem, post_process_threshold, aggression):
+    mask, X_mag, X_phase = make_mask_inputs(with_artifacts)
+    aggressiveness = {"value": aggression, "split_bin": 20, "aggr_correction": {"left": 0.01, "right": -0.01}}
+
+    expected_y_spec, expected_v_spec = baseline_apply_mask(mask.copy(), X_mag, X_phase, is_non_accom_stem, aggressiveness, post_process_threshold)
+    # Chunks which don't divide the number of frames, so a partial last chunk is covered too
+    y_spec, v_spec = spec_utils.apply_mask_chunked(mask.copy(), X_mag, X_phase, is_non_accom_stem, aggressiveness, post_process_threshold=post_process_threshold, chunk_frames=256)
+
+    assert y_spec.dtype == expected_y_spec.dtype
+    assert v_spec.dtype == expected_v_spec.dtype
+    np.testing.assert_array_equal(y_spec, expected_y_spec)
+    np.testing.assert_array_equal(v_spec, expected_v_spec)
+
+
+def test_artifacts_survive_aggression():
+    # Guards the fixture: with post-processing on, the artifact frames must actually be blended in
+    mask, _, _ = make_mask_inputs()
+    aggressiveness = {"value": 0.1, "split_bin": 20, "aggr_correction": {"left": 0.01, "right": -0.01}}
+    mask = baseline_adjust_aggr(mask, True, aggressiveness)
+
+    assert (mask.min(axis=(0, 1)) > 0.3).sum() > 64
+    assert not np.array_equal(baseline_merge_artifacts(mask.copy(), thres=0.3), mask)
+
+
+@pytest.mark.parametrize("with_artifacts", [True, False])
+def test_merge_artifacts_matches_baseline(with_artifacts):
+    mask, _, _ = make_mask_inputs(with_artifacts)
+
+    np.testing.assert_array_equal(spec_utils.merge_artifacts(mask.copy(), thres=0.2), baseline_merge_artifacts(mask.copy(), thres=0.2))
+
+
+VR_MODEL_PARAMS_PATH = os.path.join(os.path.dirname(spec_utils.__file__), "vr_network", "modelparams", "4band_v3.json")
+
+
+def band_spectrograms(wave, mp):
+    """Builds the spectrogram of every band from the full-rate wave, like VRSeparator.loading_mix."""
+    specs = {}
+    bands_n = len(mp.param["band"])
+    for d in range(bands_n, 0, -1):
+        bp = mp.param["band"][d]
+        if d < bands_n:
+            wave = librosa.resample(wave, orig_sr=mp.param["band"][d + 1]["sr"], target_sr=bp["sr"], res_type="polyphase")
+        specs[d] = spec_utils.wave_to_spectrogram(wave, bp["hl"], bp["n_fft"], mp, band=d)
+    return specs
+
+
+def spectrogram_round_trip(wave, mp):
+    X_spec = spec_utils.combine_spectrograms(band_spectrograms(wave, mp), mp)
+    X_mag, X_phase = spec_utils.preprocess(X_spec)
+    return X_spec, X_mag, X_phase, spec_utils.cmb_spectrogram_to_wave(X_spec, mp, res_type="polyphase")
+
+
+def test_single_precision_spectral_path_matches_double(monkeypatch):
+    mp = ModelParameters(VR_MODEL_PARAMS_PATH)
+    wave = np.random.default_rng(0).uniform(-0.5, 0.5, (2, 44100 * 2))
+
+    X_spec, X_mag, X_phase, round_trip = spectrogram_round_trip(wave.astype(np.float32), mp)
+
+    # The same path in double precision is the reference
+    monkeypatch.setattr(spec_utils, "SPEC_DTYPE", np.complex128)
+    ref_X_spec, ref_X_mag, ref_X_phase, ref_round_trip = spectrogram_round_trip(wave, mp)
+
+    assert X_spec.dtype == np.complex64 and ref_X_spec.dtype == np.complex128
+    assert X_mag.dtype == np.float32 and X_phase.dtype == np.float32
+    assert round_trip.dtype == np.float32 and ref_round_trip.dtype == np.float64
+
+    np.testing.assert_allclose(X_spec, ref_X_spec, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(X_mag, ref_X_mag, rtol=1e-4, atol=1e-4)
+    # Compared on the unit circle, as phases of +pi and -pi are the same
+    np.testing.assert_allclose(np.exp(1j * X_phase.astype(np.float64)) * X_mag, np.exp(1j * ref_X_phase) * ref_X_mag, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(round_trip, ref_round_trip, atol=1e-4)
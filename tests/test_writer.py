@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from audio_separator.separator.writer import StemWriterPool
+
+
+def failing_write(message):
+    raise ValueError(message)
+
+
+def test_write_errors_are_raised_for_their_own_stems_only():
+    pool = StemWriterPool(num_workers=2, max_pending=4)
+    written = []
+
+    pool.submit("a_(Vocals).wav", failing_write, "disk full")
+    pool.submit("b_(Vocals).wav", written.append, "b")
+
+    pool.wait(["b_(Vocals).wav"])
+    assert written == ["b"]
+
+    with pytest.raises(RuntimeError, match="a_\\(Vocals\\).wav"):
+        pool.wait(["a_(Vocals).wav"])
+
+    # Raised once, to the request which wrote the stem
+    pool.wait(["a_(Vocals).wav"])
+    pool.shutdown()
+
+
+def test_wait_only_waits_for_the_given_stems():
+    pool = StemWriterPool(num_workers=2, max_pending=4)
+    release = threading.Event()
+
+    blocked = pool.submit("slow.wav", release.wait)
+    pool.submit("fast.wav", lambda: None)
+
+    pool.wait(["fast.wav"])
+    assert not blocked.done()
+
+    release.set()
+    pool.wait()
+    assert blocked.done()
+    pool.shutdown()
+
+
+def test_shutdown_raises_unreported_errors_and_writes_later_stems_inline():
+    pool = StemWriterPool(num_workers=1, max_pending=1)
+    pool.submit("a.wav", failing_write, "disk full")
+
+    with pytest.raises(RuntimeError, match="a.wav"):
+        pool.shutdown()
+
+    written = []
+    pool.submit("b.wav", written.append, "b")
+    assert written == ["b"]